@@ -0,0 +1,111 @@
+"""Compares the per row executemany() upserts karen's commands_dump_loop used to do with MechaKaren.dump_commands(),
+which copies the counts into a temporary table and merges them with one statement per table.
+
+It needs a PostgreSQL database it can create a schema in (the schema is dropped afterwards). Half of the users in every
+dump already exist, like in a running bot.
+
+Three runs against a local PostgreSQL 16.2 (unix socket, asyncpg 0.32.0), ms per dump:
+
+   users  executemany  copy + merge
+   10000    257-373       158-172
+  100000   2714-3658     1238-1663
+
+Usage: python benchmarks/commands_dump.py [dsn] [users per dump,..]
+"""
+
+import classyjson as cj
+import asyncpg
+import asyncio
+import random
+import time
+import sys
+import os
+
+VILLAGER_BOT_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "villager-bot")
+
+sys.path.append(VILLAGER_BOT_DIR)
+os.chdir(VILLAGER_BOT_DIR)  # karen loads data/data.json relative to the working directory
+
+from karen import MechaKaren  # noqa: E402
+
+SCHEMA = "commands_dump_benchmark"
+BASE_USER_ID = 310000000000000000
+
+# the parts of setup.sql the dump touches
+SETUP = f"""
+CREATE SCHEMA {SCHEMA};
+
+CREATE TABLE {SCHEMA}.users (
+  user_id            BIGINT PRIMARY KEY,
+  bot_banned         BOOLEAN NOT NULL DEFAULT false,
+  emeralds           BIGINT NOT NULL DEFAULT 0
+);
+
+CREATE TABLE {SCHEMA}.leaderboards (
+  user_id            BIGINT PRIMARY KEY REFERENCES {SCHEMA}.users (user_id) ON DELETE CASCADE,
+  commands           BIGINT NOT NULL DEFAULT 0
+);
+"""
+
+
+async def executemany_dump(db: asyncpg.Pool, commands_dump: list) -> None:  # what commands_dump_loop() used to do
+    await db.executemany(
+        'INSERT INTO users (user_id) VALUES ($1) ON CONFLICT ("user_id") DO NOTHING',
+        [(user_id,) for user_id, _ in commands_dump],
+    )
+    await db.executemany(
+        'INSERT INTO leaderboards (user_id, commands) VALUES ($1, $2) ON CONFLICT ("user_id") DO UPDATE SET "commands" = leaderboards.commands + $2 WHERE leaderboards.user_id = $1',
+        commands_dump,
+    )
+
+
+async def bench(db: asyncpg.Pool, dump, users: int) -> float:
+    await db.execute("TRUNCATE users CASCADE")
+
+    # half of the users already have rows
+    existing = [(BASE_USER_ID + i,) for i in range(0, users * 2, 4)]
+    await db.executemany("INSERT INTO users (user_id) VALUES ($1)", existing)
+    await db.executemany("INSERT INTO leaderboards (user_id, commands) VALUES ($1, 1)", existing)
+
+    commands_dump = [(BASE_USER_ID + i, random.randint(1, 50)) for i in range(0, users * 2, 2)]
+
+    start = time.perf_counter()
+    await dump(commands_dump)
+    elapsed = time.perf_counter() - start
+
+    total = await db.fetchval("SELECT SUM(commands) FROM leaderboards")
+    assert total == len(existing) + sum(commands for _, commands in commands_dump)
+
+    return elapsed
+
+
+async def main():
+    dsn = sys.argv[1] if len(sys.argv) > 1 else "postgresql://postgres@localhost/postgres"
+    sizes = [int(size) for size in sys.argv[2].split(",")] if len(sys.argv) > 2 else [10000, 100000]
+
+    con = await asyncpg.connect(dsn)
+    await con.execute(SETUP)
+    await con.close()
+
+    db = await asyncpg.create_pool(dsn, min_size=1, max_size=3, server_settings={"search_path": SCHEMA})
+
+    karen = MechaKaren(cj.classify({"shard_count": 1, "cluster_size": 1, "manager": {"host": "", "port": 0, "auth": ""}}))
+    karen.db = db
+
+    random.seed(0)
+
+    try:
+        print(f"{'users':>8}{'executemany ms':>16}{'copy + merge ms':>17}")
+
+        for users in sizes:
+            old = await bench(db, lambda commands_dump: executemany_dump(db, commands_dump), users)
+            new = await bench(db, karen.dump_commands, users)
+
+            print(f"{users:>8}{old * 1000:>16.0f}{new * 1000:>17.0f}")
+    finally:
+        await db.execute(f"DROP SCHEMA {SCHEMA} CASCADE")
+        await db.close()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,100 @@
+"""Measures how long removing ended cooldowns blocks karen's event loop, with the full scan CooldownManager used to do
+every 20 seconds and with its timing wheel, along with how long a check takes.
+
+The cooldowns are spread so that the ones which ended are the ones which ended in the last 20 seconds, like they would
+be when the clear loop runs.
+
+Usage: python benchmarks/cooldown_expiry.py [entries]
+"""
+
+import random
+import time
+import sys
+import os
+
+VILLAGER_BOT_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "villager-bot")
+
+sys.path.append(VILLAGER_BOT_DIR)
+os.chdir(VILLAGER_BOT_DIR)
+
+from util.cooldowns import CooldownManager, CLEAR_BATCH_SIZE  # noqa: E402
+from util.setup import load_data  # noqa: E402
+
+CLEAR_INTERVAL = 20  # seconds between runs of CooldownManager._clear_dead()
+
+
+def fill(entries: int) -> CooldownManager:
+    rates = load_data().cooldown_rates
+    commands = list(rates)
+
+    manager = CooldownManager(rates)
+    now = time.time()
+
+    random.seed(0)
+
+    for user_id in range(entries):
+        command = random.choice(commands)
+        manager.add_cooldown(command, user_id, now - random.uniform(0, rates[command] + CLEAR_INTERVAL))
+
+    return manager
+
+
+def full_scan(manager: CooldownManager) -> None:  # what _clear_dead() did before the timing wheel
+    for command, users in list(manager.cooldowns.items()):
+        for user_id, started in list(users.items()):
+            if manager.rates[command] - (time.time() - manager.cooldowns[command].get(user_id, 0)) <= 0:
+                del manager.cooldowns[command][user_id]
+
+
+def count(manager: CooldownManager) -> int:
+    return sum(len(users) for users in manager.cooldowns.values())
+
+
+def bench_check(manager: CooldownManager, entries: int, checks: int = 200000) -> float:
+    user_ids = [random.randrange(entries) for _ in range(checks)]
+    commands = [random.choice(list(manager.rates)) for _ in range(checks)]
+
+    start = time.perf_counter()
+
+    for command, user_id in zip(commands, user_ids):
+        manager.check(command, user_id)
+
+    return (time.perf_counter() - start) / checks * 1e6
+
+
+def main():
+    entries = int(sys.argv[1]) if len(sys.argv) > 1 else 1000000
+
+    manager = fill(entries)
+    before = count(manager)
+
+    start = time.perf_counter()
+    full_scan(manager)
+    scan_stall = time.perf_counter() - start
+
+    ended = before - count(manager)
+
+    manager = fill(entries)
+
+    # _clear_dead() yields to the event loop after every CLEAR_BATCH_SIZE ended cooldowns
+    batches = []
+
+    while True:
+        start = time.perf_counter()
+        done = manager.clear_ended(CLEAR_BATCH_SIZE)
+        batches.append(time.perf_counter() - start)
+
+        if done:
+            break
+
+    ended = max(ended, before - count(manager))  # a few more can end while the second manager is filled
+
+    print(f"{entries} cooldowns, {ended} ended in the last {CLEAR_INTERVAL} seconds")
+    print(f"{'':<14}{'longest stall ms':>18}{'total ms':>12}")
+    print(f"{'full scan':<14}{scan_stall * 1000:>18.2f}{scan_stall * 1000:>12.2f}")
+    print(f"{'timing wheel':<14}{max(batches) * 1000:>18.2f}{sum(batches) * 1000:>12.2f}")
+    print(f"check: {bench_check(manager, entries):.2f} us")
+
+
+if __name__ == "__main__":
+    main()
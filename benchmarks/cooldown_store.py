@@ -0,0 +1,80 @@
+"""Compares the memory and add_cooldown/check throughput of CooldownManager's dicts of floats and
+CompactCooldownManager's CooldownTable, with each user on cooldown for a few commands.
+
+Usage: python benchmarks/cooldown_store.py [users] [commands per user]
+"""
+
+import tracemalloc
+import random
+import numpy
+import time
+import sys
+import os
+
+# normalized, pyximport can't build modules whose paths contain ".."
+VILLAGER_BOT_DIR = os.path.normpath(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "villager-bot"))
+
+sys.path.append(VILLAGER_BOT_DIR)
+os.chdir(VILLAGER_BOT_DIR)
+
+import pyximport  # noqa: E402
+
+pyximport.install(language_level=3, setup_args={"include_dirs": numpy.get_include()})
+
+from util.cooldowns import CooldownManager, CompactCooldownManager  # noqa: E402
+from util.setup import load_data  # noqa: E402
+
+BASE_USER_ID = 310000000000000000  # so user ids are snowflake sized like real ones
+CHECKS = 500000
+
+
+def bench(manager_cls: type, rates: dict, users: int, commands_per_user: int) -> tuple:
+    commands = list(rates)
+
+    random.seed(0)
+    user_commands = [random.sample(commands, commands_per_user) for _ in range(users)]
+
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+
+    start = time.perf_counter()
+    manager = manager_cls(rates)
+
+    for i, sampled in enumerate(user_commands):
+        for command in sampled:
+            manager.add_cooldown(command, BASE_USER_ID + i)
+
+    add_time = time.perf_counter() - start
+    memory = tracemalloc.get_traced_memory()[0] - before
+
+    tracemalloc.stop()
+
+    checks = [(random.choice(commands), BASE_USER_ID + random.randrange(users * 2)) for _ in range(CHECKS)]
+
+    start = time.perf_counter()
+
+    for command, user_id in checks:
+        manager.get_remaining(command, user_id)
+
+    get_time = time.perf_counter() - start
+
+    return memory, add_time / (users * commands_per_user) * 1e6, get_time / CHECKS * 1e6
+
+
+def main():
+    users = int(sys.argv[1]) if len(sys.argv) > 1 else 1000000
+    commands_per_user = int(sys.argv[2]) if len(sys.argv) > 2 else 3
+
+    rates = load_data().cooldown_rates
+
+    print(f"{users} users on cooldown for {commands_per_user} commands each ({users * commands_per_user} cooldowns)")
+    print(f"{'store':<10}{'MiB':>10}{'bytes/cooldown':>16}{'add us':>10}{'lookup us':>11}")
+
+    for name, manager_cls in (("dicts", CooldownManager), ("table", CompactCooldownManager)):
+        memory, add_us, get_us = bench(manager_cls, rates, users, commands_per_user)
+        per_cooldown = memory / (users * commands_per_user)
+        print(f"{name:<10}{memory / 1024 / 1024:>10.1f}{per_cooldown:>16.1f}{add_us:>10.2f}{get_us:>11.2f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,117 @@
+"""Compares the json and binpack ipc codecs, both in isolation and over a loopback connection.
+
+Usage: python benchmarks/ipc_codec.py [iterations]
+"""
+
+import asyncio
+import time
+import sys
+import os
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "villager-bot"))
+
+from util.ipc import CODECS, PacketType, JsonPacketStream  # noqa: E402
+from util import binpack  # noqa: E402
+
+USER_ID = 536986067140608041
+CHANNEL_ID = 643648150778675202
+
+# representative payloads for the packet types which are sent the most
+PAYLOADS = {
+    "COOLDOWN": {"type": PacketType.COOLDOWN, "id": "c1234", "command": "mine", "user_id": USER_ID},
+    "COOLDOWN_RESPONSE": {"type": PacketType.COOLDOWN_RESPONSE, "id": "c1234", "can_run": False, "remaining": 1.2345678},
+    "COMMAND_RAN": {"type": PacketType.COMMAND_RAN, "user_id": USER_ID},
+    "CONCURRENCY_ACQUIRE": {"type": PacketType.CONCURRENCY_ACQUIRE, "command": "fish", "user_id": USER_ID},
+    "EVAL": {"type": PacketType.EVAL, "id": "c1235", "code": f"active_effects.get({USER_ID})"},
+    "EVAL_RESPONSE (set)": {
+        "type": PacketType.EVAL_RESPONSE,
+        "id": "c1235",
+        "result": {"haste ii potion", "luck potion", "seaweed"},
+        "success": True,
+    },
+    "MINE_COMMAND": {"type": PacketType.MINE_COMMAND, "id": "c1236", "user_id": USER_ID, "addition": 1},
+    "REMINDER": {
+        "type": PacketType.REMINDER,
+        "id": "b12",
+        "channel_id": CHANNEL_ID,
+        "user_id": USER_ID,
+        "message_id": 912345678901234567,
+        "reminder": "go touch grass",
+    },
+    "BROADCAST_RESPONSE (stats)": {
+        "type": PacketType.BROADCAST_RESPONSE,
+        "id": "c1237",
+        "responses": [
+            {
+                "type": PacketType.BROADCAST_RESPONSE,
+                "id": "b13",
+                "stats": [123456789, 24, 512, 2500, 900000, 12345, 678, 0.1, 9],
+            }
+        ]
+        * 8,
+    },
+}
+
+
+def bench_codec(codec: str, payload: dict, iterations: int) -> tuple:
+    dumps, loads = CODECS[codec]
+
+    encoded = dumps(payload)
+
+    start = time.perf_counter()
+    for _ in range(iterations):
+        dumps(payload)
+    encode_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    for _ in range(iterations):
+        loads(encoded)
+    decode_time = time.perf_counter() - start
+
+    return len(encoded), encode_time / iterations * 1e6, decode_time / iterations * 1e6
+
+
+async def bench_loopback(codec: str, payload: dict, iterations: int) -> float:
+    # the server echoes every packet back, so this measures request/response round trips
+    async def handle_connection(reader, writer):
+        stream = JsonPacketStream(reader, writer)
+        stream.set_codec(codec)
+
+        for _ in range(iterations):
+            await stream.write_packet(await stream.read_packet())
+
+    server = await asyncio.start_server(handle_connection, "127.0.0.1", 0)
+    port = server.sockets[0].getsockname()[1]
+
+    stream = JsonPacketStream(*await asyncio.open_connection("127.0.0.1", port))
+    stream.set_codec(codec)
+
+    start = time.perf_counter()
+    for _ in range(iterations):
+        await stream.write_packet(payload)
+        await stream.read_packet()
+    elapsed = time.perf_counter() - start
+
+    await stream.close()
+    server.close()
+    await server.wait_closed()
+
+    return iterations / elapsed
+
+
+def main():
+    iterations = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+
+    print(f"binpack implementation: {'msgpack' if binpack.msgpack else 'pure python'}\n")
+    print(f"{'payload':<28}{'codec':<9}{'bytes':>7}{'encode us':>11}{'decode us':>11}{'round trips/s':>15}")
+
+    for name, payload in PAYLOADS.items():
+        for codec in CODECS:
+            size, encode_us, decode_us = bench_codec(codec, payload, iterations)
+            rate = asyncio.run(bench_loopback(codec, payload, iterations))
+
+            print(f"{name:<28}{codec:<9}{size:>7}{encode_us:>11.2f}{decode_us:>11.2f}{rate:>15.0f}")
+
+
+if __name__ == "__main__":
+    main()
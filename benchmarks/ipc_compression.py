@@ -0,0 +1,119 @@
+"""Compares ipc round trips and bytes sent with and without compression, for a small COOLDOWN packet and for
+eval packets carrying data.json and the english translation file (like big exec/lookup/stats payloads). The
+connection is over loopback, where compression is skipped, so the "remote" rows treat the peer as remote to measure
+what compressing costs.
+
+Usage: python benchmarks/ipc_compression.py [requests]
+"""
+
+import asyncio
+import time
+import sys
+import os
+
+VILLAGER_BOT_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "villager-bot")
+
+sys.path.append(VILLAGER_BOT_DIR)
+
+from util.ipc import (  # noqa: E402
+    Client,
+    Server,
+    PacketType,
+    PacketHandlerRegistry,
+    handle_packet,
+    DISPATCH_INLINE,
+    REMOTE_COMPRESSION_THRESHOLD,
+    CooldownPacket,
+    CooldownResponsePacket,
+    EvalPacket,
+    EvalResponsePacket,
+)
+
+HOST = "127.0.0.1"
+PORT = 42469
+AUTH = "benchmark"
+
+
+class Karen(PacketHandlerRegistry):
+    @handle_packet(PacketType.MISSING_PACKET)
+    async def handle_missing_packet(self, packet):
+        pass
+
+    @handle_packet(PacketType.COOLDOWN, dispatch=DISPATCH_INLINE)
+    def handle_cooldown_packet(self, packet):
+        return CooldownResponsePacket(can_run=True)
+
+    @handle_packet(PacketType.EVAL, dispatch=DISPATCH_INLINE)
+    def handle_eval_packet(self, packet):  # echoes the code back, so the payload crosses the connection both ways
+        return EvalResponsePacket(result=packet.code, success=True)
+
+
+class Cluster(PacketHandlerRegistry):
+    @handle_packet(PacketType.MISSING_PACKET)
+    async def handle_missing_packet(self, packet):
+        pass
+
+
+def read_file(*path: str) -> str:
+    with open(os.path.join(VILLAGER_BOT_DIR, *path), "r", encoding="utf8") as f:
+        return f.read()
+
+
+async def bench(compression_threshold: object, remote: bool, make_packet, requests: int) -> tuple:
+    server = Server(HOST, PORT, AUTH, Karen().get_packet_handlers(), compression_threshold=compression_threshold)
+    await server.start()
+
+    client = Client(HOST, PORT, Cluster().get_packet_handlers(), compression_threshold=compression_threshold)
+    await client.connect(AUTH)
+
+    if remote:
+        for stream in (client._stream, *server.connections):
+            stream.peer_local = False
+
+    latencies = []
+
+    for _ in range(requests):
+        packet = make_packet()
+
+        start = time.perf_counter()
+        await client.request(packet)
+        latencies.append(time.perf_counter() - start)
+
+    sent_bytes = sum(m.sent_bytes for m in client.metrics.packets.values()) + sum(
+        m.sent_bytes for m in server.metrics.packets.values()
+    )
+
+    await client.close()
+    await server.close()
+
+    latencies.sort()
+
+    return latencies[len(latencies) // 2] * 1e6, sent_bytes / requests / 1024
+
+
+async def main():
+    requests = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+
+    data_json = read_file("data", "data.json")
+    en_json = read_file("data", "text", "en.json")
+
+    payloads = (
+        ("COOLDOWN", lambda: CooldownPacket(command="mine", user_id=536986067140608041)),
+        (f"data.json ({len(data_json) // 1024} KiB)", lambda: EvalPacket(code=data_json)),
+        (f"en.json ({len(en_json) // 1024} KiB)", lambda: EvalPacket(code=en_json)),
+    )
+
+    print(f"{'payload':<24}{'compression':<20}{'p50 us':>10}{'KiB/round trip':>16}")
+
+    for name, make_packet in payloads:
+        for compression_name, threshold, remote in (
+            ("off", None, False),
+            (f">= {REMOTE_COMPRESSION_THRESHOLD} B", REMOTE_COMPRESSION_THRESHOLD, False),
+            (f">= {REMOTE_COMPRESSION_THRESHOLD} B remote", REMOTE_COMPRESSION_THRESHOLD, True),
+        ):
+            p50, size = await bench(threshold, remote, make_packet, requests)
+            print(f"{name:<24}{compression_name:<20}{p50:>10.1f}{size:>16.2f}")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,292 @@
+"""Load tests karen's ipc server with simulated clusters, no discord token or database needed.
+
+Karen (MechaKaren with its real packet handlers) runs in this process, and every simulated cluster
+runs in its own process with an ipc Client, replaying a mix of the packets real clusters send.
+
+Usage: python benchmarks/ipc_load.py [--clusters 1,2,4,8] [--duration 5] [--concurrency 16]
+"""
+
+from concurrent.futures import ProcessPoolExecutor
+from collections import defaultdict
+import classyjson as cj
+import argparse
+import asyncio
+import random
+import time
+import sys
+import os
+
+VILLAGER_BOT_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "villager-bot")
+
+sys.path.append(VILLAGER_BOT_DIR)
+os.chdir(VILLAGER_BOT_DIR)  # karen loads data/data.json relative to the working directory
+
+from util.ipc import (  # noqa: E402
+    Client,
+    RequestTimeoutError,
+    PacketType,
+    PacketHandlerRegistry,
+    handle_packet,
+    DISPATCH_INLINE,
+    AdmitPacket,
+    CooldownPacket,
+    ConcurrencyCheckPacket,
+    ConcurrencyAcquirePacket,
+    ConcurrencyReleasePacket,
+    CommandRanPacket,
+)
+from util.cooldowns import CooldownLeases, DEFAULT_LEASE_DURATION  # noqa: E402
+from util.setup import load_data  # noqa: E402
+from karen import MechaKaren  # noqa: E402
+
+HOST = "127.0.0.1"
+PORT = 42269
+AUTH = "benchmark"
+
+USERS = 5000  # simulated users per cluster, random ones are picked for every packet
+SHARED_USERS = 0.05  # fraction of packets for users of other clusters, like users in guilds on multiple clusters
+COMMANDS = ("mine", "fish", "use", "heal", "sell")  # econ commands with karen cooldowns
+CONCURRENCY_LIMITED = frozenset({"mine", "fish", "sell"})
+
+# (operation, weight), roughly the mix of packets sent by a cluster while handling commands
+WORKLOAD = (
+    ("ADMIT", 40),  # checking an econ command with karen, like VillagerBotCluster.check_global
+    ("COMMAND_RAN", 35),  # other commands
+    ("EVAL", 20),  # the active_effects lookups done by econ commands
+    ("BROADCAST_REQUEST", 5),
+)
+
+
+class SimulatedCluster(PacketHandlerRegistry):
+    def __init__(self, guild_count: int):
+        self.guild_count = guild_count
+        self.cooldown_leases = CooldownLeases(load_data().cooldown_rates)
+
+    @handle_packet(PacketType.MISSING_PACKET)
+    async def handle_missing_packet(self, packet):
+        pass
+
+    @handle_packet(PacketType.EVAL)
+    async def handle_eval_packet(self, packet):
+        return {"result": self.guild_count, "success": True}
+
+    @handle_packet(PacketType.COOLDOWN_LEASE_REVOKE, dispatch=DISPATCH_INLINE)
+    def handle_cooldown_lease_revoke_packet(self, packet):
+        return {"cooldowns": self.cooldown_leases.revoke(packet.user_id)}
+
+
+async def admit(client: Client, cooldown_leases: CooldownLeases, command: str, user_id: int) -> bool:
+    check_cooldown = True
+    cooldown_info = cooldown_leases.check(command, user_id)
+
+    if cooldown_info is not None:
+        if not cooldown_info["can_run"]:
+            return False
+
+        check_cooldown = False
+
+    requested_at = time.monotonic()
+    response = await client.request(
+        AdmitPacket(
+            command=command,
+            user_id=user_id,
+            cooldown=check_cooldown,
+            concurrency=command in CONCURRENCY_LIMITED,
+            econ=True,
+        )
+    )
+
+    if check_cooldown:
+        cooldown_leases.update(user_id, response, requested_at)
+
+    return response.can_run
+
+
+async def admit_separately(client: Client, cooldown_leases: CooldownLeases, command: str, user_id: int) -> bool:
+    """Checks an econ command with a request per check, like check_global did before ADMIT packets"""
+
+    cooldown_info = cooldown_leases.check(command, user_id)
+
+    if cooldown_info is None:
+        requested_at = time.monotonic()
+        cooldown_info = await client.request(CooldownPacket(command=command, user_id=user_id))
+        cooldown_leases.update(user_id, cooldown_info, requested_at)
+
+    if not cooldown_info.get("can_run"):  # a dict when checked locally, a packet otherwise
+        return False
+
+    if command in CONCURRENCY_LIMITED:
+        if not (await client.request(ConcurrencyCheckPacket(command=command, user_id=user_id))).can_run:
+            return False
+
+    if (await client.eval(f"econ_paused_users.get({user_id})")).result is not None:
+        return False
+
+    await client.send(CommandRanPacket(user_id=user_id))
+
+    return True
+
+
+async def run_cluster_load(
+    port: int, cluster_id: int, clusters: int, duration: float, concurrency: int, batch_window: object, separate: bool
+) -> dict:
+    cluster = SimulatedCluster(cluster_id)
+    cooldown_leases = cluster.cooldown_leases
+
+    client = Client(HOST, port, cluster.get_packet_handlers(), batch_window=batch_window)
+    await client.connect(AUTH)
+
+    operations, weights = zip(*WORKLOAD)
+    latencies = defaultdict(list)  # {operation: [seconds, seconds,..]}
+    sent = defaultdict(int)  # {operation: packets}
+    timeouts = defaultdict(int)  # {operation: requests}
+
+    deadline = time.monotonic() + duration
+
+    async def worker():
+        while time.monotonic() < deadline:
+            operation = random.choices(operations, weights)[0]
+
+            if random.random() < SHARED_USERS:
+                user_id = random.randrange(USERS * clusters)
+            else:
+                user_id = cluster_id * USERS + random.randrange(USERS)
+
+            start = time.perf_counter()
+
+            try:
+                if operation == "ADMIT":
+                    command = random.choice(COMMANDS)
+
+                    if await (admit_separately if separate else admit)(client, cooldown_leases, command, user_id):
+                        if command in CONCURRENCY_LIMITED:  # the command is invoked and finishes running
+                            await client.send(ConcurrencyAcquirePacket(command=command, user_id=user_id))
+                            await client.send(ConcurrencyReleasePacket(command=command, user_id=user_id))
+                elif operation == "COMMAND_RAN":
+                    await client.send(CommandRanPacket(user_id=user_id))
+                    sent[operation] += 1
+                    await asyncio.sleep(0)
+                    continue
+                elif operation == "EVAL":
+                    await client.eval(f"active_effects.get({user_id})")
+                else:
+                    await client.broadcast({"type": PacketType.EVAL, "code": "len(bot.guilds)"})
+            except RequestTimeoutError:
+                timeouts[operation] += 1
+                continue
+
+            latencies[operation].append(time.perf_counter() - start)
+            sent[operation] += 1
+
+    await asyncio.gather(*[worker() for _ in range(concurrency)])
+    await client.close()
+
+    return {
+        "latencies": dict(latencies),
+        "sent": dict(sent),
+        "timeouts": dict(timeouts),
+        "cooldowns": cooldown_leases.get_stats(),
+    }
+
+
+def run_cluster(*args) -> dict:
+    return asyncio.run(run_cluster_load(*args))
+
+
+def percentile(sorted_values: list, p: float) -> float:
+    return sorted_values[min(len(sorted_values) - 1, int(len(sorted_values) * p))]
+
+
+async def bench(pp: ProcessPoolExecutor, clusters: int, args: argparse.Namespace) -> None:
+    # the worker processes inherit karen's listening socket when they're forked, so every run needs its own port
+    port = PORT + clusters
+
+    manager = {
+        "host": HOST,
+        "port": port,
+        "auth": AUTH,
+        "batch_window": args.batch_window,
+        "cooldown_lease_duration": None if args.no_leases else DEFAULT_LEASE_DURATION,
+    }
+    secrets = cj.classify({"shard_count": clusters, "cluster_size": 1, "manager": manager})
+
+    karen = MechaKaren(secrets)
+    await karen.server.start()
+    karen.cooldowns.start()
+
+    loop = asyncio.get_event_loop()
+
+    start = time.perf_counter()
+    results = await asyncio.gather(
+        *[
+            loop.run_in_executor(
+                pp, run_cluster, port, i, clusters, args.duration, args.concurrency, args.batch_window, args.no_admit
+            )
+            for i in range(clusters)
+        ]
+    )
+    elapsed = time.perf_counter() - start
+
+    karen.cooldowns.stop()
+    await karen.server.close()
+
+    latencies = defaultdict(list)
+    total_sent = 0
+    total_timeouts = 0
+    local_checks = 0
+    remote_checks = 0
+
+    for result in results:
+        for operation, values in result["latencies"].items():
+            latencies[operation].extend(values)
+
+        total_sent += sum(result["sent"].values())
+        total_timeouts += sum(result["timeouts"].values())
+        local_checks += result["cooldowns"]["local_checks"]
+        remote_checks += result["cooldowns"]["remote_checks"]
+
+    # elapsed includes process startup, so packets/s is slightly pessimistic
+    row = f"{clusters:>8}{total_sent / elapsed:>12.0f}"
+
+    for operation, _ in WORKLOAD:
+        values = sorted(latencies[operation])
+
+        if values:
+            row += f"{percentile(values, 0.5) * 1000:>10.2f}{percentile(values, 0.99) * 1000:>10.2f}"
+        else:
+            row += f"{'-':>10}{'-':>10}"
+
+    row += f"{local_checks / max(local_checks + remote_checks, 1):>9.1%}"
+
+    if total_timeouts:
+        row += f"  ({total_timeouts} timed out)"
+
+    print(row)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Load tests karen's ipc server with simulated clusters")
+    parser.add_argument("--clusters", default="1,2,4,8", help="comma separated cluster counts to test")
+    parser.add_argument("--duration", type=float, default=5, help="seconds each cluster sends packets for")
+    parser.add_argument("--concurrency", type=int, default=16, help="concurrent workers per cluster")
+    parser.add_argument("--batch-window", type=float, default=0, help="ipc batch window, negative disables batching")
+    parser.add_argument("--no-leases", action="store_true", help="check every cooldown with karen, like before leases")
+    parser.add_argument("--no-admit", action="store_true", help="check commands with a request per check, not ADMIT")
+    args = parser.parse_args()
+
+    if args.batch_window < 0:
+        args.batch_window = None
+
+    cluster_counts = [int(c) for c in args.clusters.split(",")]
+
+    # COMMAND_RAN is one-way, so there's no latency to show for it
+    print(f"{'':>20}" + "".join(f"{operation:>20}" for operation, _ in WORKLOAD))
+    print(f"{'clusters':>8}{'packets/s':>12}" + f"{'p50 ms':>10}{'p99 ms':>10}" * len(WORKLOAD) + f"{'local cd':>9}")
+
+    with ProcessPoolExecutor(max(cluster_counts)) as pp:
+        for clusters in cluster_counts:
+            asyncio.run(bench(pp, clusters, args))
+
+
+if __name__ == "__main__":
+    main()
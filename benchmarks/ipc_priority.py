@@ -0,0 +1,130 @@
+"""Measures COOLDOWN round trips while bulk packets (like big eval/exec payloads and their responses) are being sent
+in both directions on the same connection, with and without splitting bulk packets into chunks.
+
+Usage: python benchmarks/ipc_priority.py [bulk packet size in KiB] [requests]
+"""
+
+import asyncio
+import time
+import sys
+import os
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "villager-bot"))
+
+from util.ipc import (  # noqa: E402
+    Client,
+    Server,
+    PacketType,
+    PacketHandlerRegistry,
+    handle_packet,
+    DISPATCH_INLINE,
+    DEFAULT_CHUNK_SIZE,
+    CooldownPacket,
+    CooldownResponsePacket,
+)
+from util.cooldowns import CooldownManager  # noqa: E402
+
+HOST = "127.0.0.1"
+PORT = 42369
+AUTH = "benchmark"
+USER_ID = 536986067140608041
+
+
+class Karen(PacketHandlerRegistry):
+    def __init__(self):
+        self.cooldowns = CooldownManager({"mine": 0.1})
+
+    @handle_packet(PacketType.MISSING_PACKET)
+    async def handle_missing_packet(self, packet):
+        pass
+
+    @handle_packet(PacketType.COOLDOWN, dispatch=DISPATCH_INLINE)
+    def handle_cooldown_packet(self, packet):
+        return CooldownResponsePacket(**self.cooldowns.check(packet.command, packet.user_id))
+
+    @handle_packet(PacketType.EXEC)
+    async def handle_exec_packet(self, packet):
+        return {"type": PacketType.EXEC_RESPONSE, "result": None, "success": True}
+
+
+class Cluster(PacketHandlerRegistry):
+    @handle_packet(PacketType.MISSING_PACKET)
+    async def handle_missing_packet(self, packet):
+        pass
+
+    @handle_packet(PacketType.EXEC)
+    async def handle_exec_packet(self, packet):
+        pass
+
+
+def percentile(sorted_values: list, p: float) -> float:
+    return sorted_values[min(len(sorted_values) - 1, int(len(sorted_values) * p))]
+
+
+async def bench(chunk_size: object, bulk_size: int, requests: int) -> tuple:
+    server = Server(HOST, PORT, AUTH, Karen().get_packet_handlers(), batch_window=0, chunk_size=chunk_size)
+    await server.start()
+
+    client = Client(HOST, PORT, Cluster().get_packet_handlers(), batch_window=0, chunk_size=chunk_size)
+    await client.connect(AUTH)
+
+    bulk_packet = {"type": PacketType.EXEC, "code": "#" * bulk_size}
+    bulk_sent = 0
+    done = False
+
+    async def send_bulk_to_karen():
+        nonlocal bulk_sent
+
+        while not done:
+            await client.request(dict(bulk_packet))
+            bulk_sent += 1
+
+    async def send_bulk_to_cluster():
+        nonlocal bulk_sent
+
+        while not done:
+            await server.connections[0].write_packet(bulk_packet)
+            bulk_sent += 1
+
+    bulk_tasks = [asyncio.create_task(send_bulk_to_karen()), asyncio.create_task(send_bulk_to_cluster())]
+
+    latencies = []
+    start = time.perf_counter()
+
+    for i in range(requests):
+        request_start = time.perf_counter()
+        await client.request(CooldownPacket(command="mine", user_id=USER_ID + i))
+        latencies.append(time.perf_counter() - request_start)
+
+    elapsed = time.perf_counter() - start
+
+    done = True
+    await asyncio.gather(*bulk_tasks)
+
+    await client.close()
+    await server.close()
+
+    latencies.sort()
+
+    return (
+        percentile(latencies, 0.5) * 1000,
+        percentile(latencies, 0.99) * 1000,
+        latencies[-1] * 1000,
+        bulk_sent * bulk_size / elapsed / 1024 / 1024,
+    )
+
+
+async def main():
+    bulk_size = int(sys.argv[1]) * 1024 if len(sys.argv) > 1 else 1024 * 1024
+    requests = int(sys.argv[2]) if len(sys.argv) > 2 else 2000
+
+    print(f"bulk packets of {bulk_size // 1024} KiB in both directions")
+    print(f"{'chunks':<10}{'p50 ms':>9}{'p99 ms':>9}{'max ms':>9}{'bulk MiB/s':>12}")
+
+    for name, chunk_size in (("off", None), (f"{DEFAULT_CHUNK_SIZE // 1024} KiB", DEFAULT_CHUNK_SIZE)):
+        p50, p99, latency_max, bulk_throughput = await bench(chunk_size, bulk_size, requests)
+        print(f"{name:<10}{p50:>9.2f}{p99:>9.2f}{latency_max:>9.2f}{bulk_throughput:>12.1f}")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
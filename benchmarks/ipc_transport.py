@@ -0,0 +1,117 @@
+"""Compares karen's tcp and unix socket transports using COOLDOWN request/response round trips. The transports are
+measured in alternating order over several rounds and the medians are printed, single runs on loopback are too noisy
+(and favour whichever transport runs second) to tell them apart.
+
+Usage: python benchmarks/ipc_transport.py [requests] [rounds]
+"""
+
+import statistics
+import tempfile
+import asyncio
+import time
+import sys
+import os
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "villager-bot"))
+
+from util.ipc import (  # noqa: E402
+    Client,
+    Server,
+    PacketType,
+    PacketHandlerRegistry,
+    handle_packet,
+    CooldownPacket,
+    CooldownResponsePacket,
+    UNIX_SOCKETS_SUPPORTED,
+)
+from util.cooldowns import CooldownManager  # noqa: E402
+
+HOST = "127.0.0.1"
+PORT = 42169
+AUTH = "benchmark"
+USER_ID = 536986067140608041
+CONCURRENCY = 100
+
+
+class Karen(PacketHandlerRegistry):
+    def __init__(self):
+        self.cooldowns = CooldownManager({"mine": 0.1})
+
+    @handle_packet(PacketType.MISSING_PACKET)
+    async def handle_missing_packet(self, packet):
+        pass
+
+    @handle_packet(PacketType.COOLDOWN)
+    async def handle_cooldown_packet(self, packet):
+        return CooldownResponsePacket(**self.cooldowns.check(packet.command, packet.user_id))
+
+
+class Cluster(PacketHandlerRegistry):
+    @handle_packet(PacketType.MISSING_PACKET)
+    async def handle_missing_packet(self, packet):
+        pass
+
+
+def percentile(sorted_values: list, p: float) -> float:
+    return sorted_values[min(len(sorted_values) - 1, int(len(sorted_values) * p))]
+
+
+async def bench(unix_socket: str, requests: int) -> tuple:
+    client = Client(HOST, PORT, Cluster().get_packet_handlers(), batch_window=0, unix_socket=unix_socket)
+    await client.connect(AUTH)
+
+    # latency, one request at a time
+    latencies = []
+    for i in range(requests):
+        start = time.perf_counter()
+        await client.request(CooldownPacket(command="mine", user_id=USER_ID + i))
+        latencies.append(time.perf_counter() - start)
+
+    latencies.sort()
+
+    # throughput, CONCURRENCY requests in flight at once
+    start = time.perf_counter()
+    for i in range(0, requests, CONCURRENCY):
+        await client.request_many(
+            [CooldownPacket(command="mine", user_id=USER_ID + j) for j in range(i, min(i + CONCURRENCY, requests))]
+        )
+    throughput = requests / (time.perf_counter() - start)
+
+    transport = "unix" if client.uses_unix_socket else "tcp"
+    await client.close()
+
+    return transport, percentile(latencies, 0.5) * 1e6, percentile(latencies, 0.99) * 1e6, throughput
+
+
+async def main():
+    requests = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+    rounds = int(sys.argv[2]) if len(sys.argv) > 2 else 5
+
+    with tempfile.TemporaryDirectory() as tmp:
+        unix_socket = os.path.join(tmp, "karen.sock")
+
+        server = Server(HOST, PORT, AUTH, Karen().get_packet_handlers(), batch_window=0, unix_socket=unix_socket)
+        await server.start()
+
+        paths = [None, unix_socket] if UNIX_SOCKETS_SUPPORTED else [None]
+        results = {}  # {transport: [(p50, p99, throughput), ..]}
+
+        for _ in range(rounds):
+            for path in paths:
+                transport, *result = await bench(path, requests)
+                results.setdefault(transport, []).append(result)
+
+            paths.reverse()
+
+        await server.close()
+
+    print(f"{'transport':<11}{'p50 us':>9}{'p99 us':>9}{'requests/s':>12}{'min-max requests/s':>22}")
+
+    for transport, runs in results.items():
+        p50, p99, throughput = (statistics.median(values) for values in zip(*runs))
+        lowest, highest = min(run[2] for run in runs), max(run[2] for run in runs)
+        print(f"{transport:<11}{p50:>9.1f}{p99:>9.1f}{throughput:>12.0f}{f'{lowest:.0f}-{highest:.0f}':>22}")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
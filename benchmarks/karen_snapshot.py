@@ -0,0 +1,123 @@
+"""Measures writing and restoring a snapshot of karen's state with a million entries (cooldowns, some of which already
+ended, mine command and pillage counters and potion effects), followed by delta snapshots.
+
+Usage: python benchmarks/karen_snapshot.py [entries] [deltas]
+"""
+
+from collections import defaultdict
+from types import SimpleNamespace
+import tempfile
+import random
+import time
+import sys
+import os
+
+VILLAGER_BOT_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "villager-bot")
+
+sys.path.append(VILLAGER_BOT_DIR)
+os.chdir(VILLAGER_BOT_DIR)
+
+from util.cooldowns import CooldownManager  # noqa: E402
+from util.snapshots import KarenSnapshots, FRAME_FULL, FRAME_DELTA, SECTION_MINE_COMMANDS  # noqa: E402
+from util.setup import load_data  # noqa: E402
+
+BASE_USER_ID = 310000000000000000
+EFFECTS = ("haste i potion", "haste ii potion", "luck potion", "seaweed")
+
+
+def make_share() -> SimpleNamespace:  # the parts of MechaKaren.Share which are snapshotted
+    return SimpleNamespace(
+        mine_commands=defaultdict(int), pillages=defaultdict(int), active_effects=defaultdict(set), effect_ends={}
+    )
+
+
+def fill(cooldowns: CooldownManager, share: SimpleNamespace, entries: int) -> None:
+    commands = list(cooldowns.rates)
+    now = time.time()
+
+    for i in range(entries):
+        user_id = BASE_USER_ID + i
+        kind = i % 10
+
+        if kind < 7:  # cooldowns, about a third of them already ended
+            command = random.choice(commands)
+            cooldowns.add_cooldown(command, user_id, now - random.uniform(0, cooldowns.rates[command] * 1.5))
+        elif kind < 9:
+            share.mine_commands[user_id] = random.randint(1, 99)
+        elif i % 100 == 9:
+            effect = random.choice(EFFECTS)
+            share.active_effects[user_id].add(effect)
+            share.effect_ends[(user_id, effect)] = now + random.uniform(-60, 30 * 60)
+        else:
+            share.pillages[user_id] = random.randint(1, 20)
+
+
+def change(snapshots: KarenSnapshots, entries: int, count: int) -> None:  # what karen's handlers do between snapshots
+    commands = list(snapshots.cooldowns.rates)
+
+    for _ in range(count):
+        user_id = BASE_USER_ID + random.randrange(entries)
+
+        if random.random() < 0.8:
+            snapshots.cooldowns.add_cooldown(random.choice(commands), user_id)
+        else:
+            snapshots.share.mine_commands[user_id] += 1
+            snapshots.track(SECTION_MINE_COMMANDS, user_id)
+
+
+def timed(function, *args):
+    start = time.perf_counter()
+    result = function(*args)
+
+    return result, (time.perf_counter() - start) * 1000
+
+
+def main():
+    entries = int(sys.argv[1]) if len(sys.argv) > 1 else 1000000
+    deltas = int(sys.argv[2]) if len(sys.argv) > 2 else 10
+
+    rates = load_data().cooldown_rates
+    random.seed(0)
+
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, "karen.snapshot")
+
+        cooldowns = CooldownManager(rates)
+        share = make_share()
+        fill(cooldowns, share, entries)
+
+        snapshots = KarenSnapshots(path, cooldowns, share)  # after filling, so filling isn't tracked as changes
+
+        frame, collect_ms = timed(snapshots.collect, True)
+        size, write_ms = timed(snapshots.file.write, frame)
+
+        assert frame.kind == FRAME_FULL
+
+        print(f"{entries} entries")
+        print(f"full snapshot: {size / 1024 / 1024:.1f} MiB, collected in {collect_ms:.0f}ms on the event loop, ", end="")
+        print(f"encoded and written in {write_ms:.0f}ms off it")
+
+        delta_sizes = []
+
+        for _ in range(deltas):
+            change(snapshots, entries, entries // 100)
+
+            frame = snapshots.collect(False)
+            assert frame.kind == FRAME_DELTA
+
+            delta_sizes.append(snapshots.file.write(frame))
+
+        print(f"{deltas} deltas of {entries // 100} changes: {sum(delta_sizes) / len(delta_sizes) / 1024:.0f} KiB each")
+
+        restored = KarenSnapshots(path, CooldownManager(rates), make_share())
+
+        loaded, load_ms = timed(restored.file.load)
+        names, records, torn = loaded
+        counts, apply_ms = timed(restored.restore_records, names, records, time.time())
+
+        print(f"restore: read and merged {len(records)} records in {load_ms:.0f}ms, applied in {apply_ms:.0f}ms")
+        print("restored " + ", ".join(f"{count} {section}" for section, count in counts.items()))
+
+
+if __name__ == "__main__":
+    main()
@@ -14,12 +14,16 @@ CREATE TABLE IF NOT EXISTS users ( -- used for economy data
   emeralds           BIGINT NOT NULL DEFAULT 0, -- the amount of emeralds the user has
   vault_balance      INT NOT NULL DEFAULT 0, -- the amount of emerald blocks in their vault
   vault_max          INT NOT NULL DEFAULT 1, -- the maximum amount of emerald blocks in their vault
-  health             SMALLINT NOT NULL DEFAULT 20, -- the amount of health the user currently has
+  health             SMALLINT NOT NULL DEFAULT 20, -- the amount of health the user had at health_updated_at
+  health_updated_at  TIMESTAMPTZ NOT NULL DEFAULT NOW(), -- when health was last changed, health regenerates from then on
   vote_streak        INT NOT NULL DEFAULT 0, -- the current vote streak of the user
   last_vote          TIMESTAMPTZ, -- the time at which the last user voted
   give_alert         BOOLEAN NOT NULL DEFAULT true -- whether users should be alerted if someone gives them items or emeralds or not
 );
 
+-- for databases created before health regenerated lazily
+ALTER TABLE users ADD COLUMN IF NOT EXISTS health_updated_at TIMESTAMPTZ NOT NULL DEFAULT NOW();
+
 CREATE TABLE IF NOT EXISTS items (
   user_id            BIGINT REFERENCES users (user_id) ON DELETE CASCADE, -- the discord user id / snowflake
   name               VARCHAR(50) NOT NULL, -- the name of the item
@@ -81,11 +85,18 @@ CREATE TABLE IF NOT EXISTS give_logs (
 CREATE TABLE IF NOT EXISTS reminders (
   user_id            BIGINT NOT NULL, -- the discord user id / snowflake
   channel_id         BIGINT NOT NULL, -- the channel id where the reminder command was summoned
+  guild_id           BIGINT, -- the guild of the channel, null for dms, used to send the reminder only to its shard's cluster
   message_id         BIGINT NOT NULL, -- the message where the reminder command was summoned
   reminder           TEXT NOT NULL, -- the actual text for the reminder
   at                 TIMESTAMPTZ -- the time at which the user should be reminded
 );
 
+-- for databases created before reminders were routed to their shard's cluster
+ALTER TABLE reminders ADD COLUMN IF NOT EXISTS guild_id BIGINT;
+
+CREATE INDEX IF NOT EXISTS reminders_at_idx ON reminders (at); -- karen loads the reminders which are due soon
+CREATE INDEX IF NOT EXISTS reminders_message_id_idx ON reminders (message_id); -- delivered reminders are deleted by message
+
 CREATE TABLE IF NOT EXISTS warnings (
   user_id            BIGINT NOT NULL,  -- the discord user id / snowflake
   guild_id           BIGINT NOT NULL, -- the guild where the user was warned
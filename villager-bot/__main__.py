@@ -19,6 +19,7 @@ if pyximport:
     # if not all pyx files are imported here, each forked process / shard group will try to compile
     # them and fail because they are all trying at the same time to access and write the same files
     from util import tiler  # noqa: F401
+    from util import cooldown_table  # noqa: F401
 
 from karen import MechaKaren  # noqa: E402
 
@@ -1,4 +1,5 @@
 from concurrent.futures import ThreadPoolExecutor
+from typing import Optional
 from statcord import StatcordClusterClient
 from collections import defaultdict
 from classyjson import ClassyDict
@@ -11,26 +12,46 @@ import psutil
 import random
 import arrow
 import numpy
+import time
 
 from trusted_contributors import discord_ids
 
 from util.setup import villager_bot_intents, setup_logging, setup_database_pool
-from util.cooldowns import CommandOnKarenCooldown, MaxKarenConcurrencyReached
-from util.ipc import Client, PacketType, PacketHandlerRegistry, handle_packet
+from util.cooldowns import CommandOnKarenCooldown, MaxKarenConcurrencyReached, CooldownLeases
+from util.ipc import (
+    Client,
+    PacketType,
+    PacketHandlerRegistry,
+    RequestTimeoutError,
+    ConnectionLostError,
+    handle_packet,
+    DISPATCH_INLINE,
+    DEFAULT_REQUEST_TIMEOUT,
+    DEFAULT_COMPRESSION_THRESHOLD,
+    AdmitPacket,
+    CooldownAddPacket,
+    ConcurrencyAcquirePacket,
+    ConcurrencyReleasePacket,
+    CommandRanPacket,
+    ShardReadyPacket,
+    TOPIC_BAN_LIST,
+    TOPIC_DATA_RELOAD,
+)
+from util.ring import RingBuffer
 from util.misc import TTLPreventDuplicate, update_support_member_role
 from util.setup import load_text, load_secrets, load_data
 from util.code import execute_code, format_exception
 from util.ctx import BetterContext
 
 
-def run_cluster(shard_count: int, shard_ids: list, max_db_pool_size: int) -> None:
+def run_cluster(shard_count: int, shard_ids: list, max_db_pool_size: int, ring_path: Optional[str] = None) -> None:
     # add cython support, with numpy header files
     pyximport.install(language_level=3, setup_args={"include_dirs": numpy.get_include()})
 
     # for some reason, asyncio tries to use the event loop from the main process
     asyncio.set_event_loop(asyncio.new_event_loop())
 
-    cluster = VillagerBotCluster(shard_count, shard_ids, max_db_pool_size)
+    cluster = VillagerBotCluster(shard_count, shard_ids, max_db_pool_size, ring_path)
 
     try:
         cluster.run()
@@ -41,7 +62,7 @@ def run_cluster(shard_count: int, shard_ids: list, max_db_pool_size: int) -> Non
 
 
 class VillagerBotCluster(commands.AutoShardedBot, PacketHandlerRegistry):
-    def __init__(self, shard_count: int, shard_ids: list, max_db_pool_size: int):
+    def __init__(self, shard_count: int, shard_ids: list, max_db_pool_size: int, ring_path: Optional[str] = None):
         commands.AutoShardedBot.__init__(
             self,
             # status=discord.Status.invisible,
@@ -82,7 +103,23 @@ class VillagerBotCluster(commands.AutoShardedBot, PacketHandlerRegistry):
         #     self.cog_list.append("cogs.core.topgg")
 
         self.logger = setup_logging(self.shard_ids)
-        self.ipc = Client(self.k.manager.host, self.k.manager.port, self.get_packet_handlers())  # ipc client
+        self.cooldown_leases = CooldownLeases(self.d.cooldown_rates)  # karen cooldowns this cluster can check by itself
+        self.ipc = Client(
+            self.k.manager.host,
+            self.k.manager.port,
+            self.get_packet_handlers(),
+            batch_window=self.k.manager.get("batch_window"),
+            unix_socket=self.k.manager.get("unix_socket"),
+            compression_threshold=self.k.manager.get("compression_threshold", DEFAULT_COMPRESSION_THRESHOLD),
+            request_timeout=self.k.manager.get("request_timeout", DEFAULT_REQUEST_TIMEOUT),
+            ring=(None if ring_path is None else RingBuffer.attach(ring_path)),
+            logger=self.logger,
+            shard_ids=self.shard_ids,  # so karen can send packets for a guild only to this cluster
+        )  # ipc client
+        self.ipc.reconnect_handlers.append(self.announce_ready_shards)
+        self.ipc.disconnect_handlers.append(self.cooldown_leases.clear_leases)
+        self.ipc.subscribe(TOPIC_BAN_LIST, self.handle_ban_list_message)
+        self.ipc.subscribe(TOPIC_DATA_RELOAD, self.handle_data_reload_message)
         self.aiohttp = aiohttp.ClientSession()
         self.statcord = None  # StatcordClusterClient instance
         self.db = None  # asyncpg database connection pool
@@ -130,6 +167,7 @@ class VillagerBotCluster(commands.AutoShardedBot, PacketHandlerRegistry):
         await self.ipc.connect(self.k.manager.auth)
         self.db = await setup_database_pool(self.k, self.max_db_pool_size)
         asyncio.create_task(self.prevent_spawn_duplicates.run())
+        self.cooldown_leases.start()
 
         # self.statcord = StatcordClusterClient(self, self.k.statcord, ".".join(map(str, self.shard_ids)))
 
@@ -138,6 +176,24 @@ class VillagerBotCluster(commands.AutoShardedBot, PacketHandlerRegistry):
 
         await super().start(*args, **kwargs)
 
+    async def announce_ready_shards(self):  # karen loses track of which shards are online if it restarts
+        for shard_id, shard in self.shards.items():
+            if not shard.is_closed():
+                await self.ipc.send(ShardReadyPacket(shard_id=shard_id))
+
+    def handle_ban_list_message(self, message: dict):
+        if message["banned"]:
+            self.ban_cache.add(message["user_id"])
+        else:
+            self.ban_cache.discard(message["user_id"])
+
+    async def handle_data_reload_message(self, message: None):
+        await self.reload_data()
+
+    async def reload_data(self) -> None:  # the files are read and parsed in the thread pool, not on the event loop
+        self.l = await self.loop.run_in_executor(self.tp, load_text)
+        self.d = await self.loop.run_in_executor(self.tp, load_data)
+
     async def close(self, *args, **kwargs):
         await self.ipc.close()
         await self.db.close()
@@ -213,30 +269,63 @@ class VillagerBotCluster(commands.AutoShardedBot, PacketHandlerRegistry):
             ctx.failure_reason = "disabled"
             return False
 
-        # handle cooldowns that need to be synced between shard groups / processes (aka karen cooldowns)
-        if command in self.d.cooldown_rates:
-            cooldown_info = await self.ipc.request({"type": PacketType.COOLDOWN, "command": command, "user_id": ctx.author.id})
+        # karen cooldowns are synced between clusters, a cluster holding a lease on the user's cooldowns checks them itself
+        check_cooldown = command in self.d.cooldown_rates
 
-            if not cooldown_info.can_run:
-                ctx.custom_error = CommandOnKarenCooldown(cooldown_info.remaining)
-                return False
+        if check_cooldown:
+            cooldown_info = self.cooldown_leases.check(command, ctx.author.id)
 
-        if command in self.d.concurrency_limited:
-            res = await self.ipc.request({"type": PacketType.CONCURRENCY_CHECK, "command": command, "user_id": ctx.author.id})
+            if cooldown_info is not None:
+                if not cooldown_info["can_run"]:
+                    ctx.custom_error = CommandOnKarenCooldown(cooldown_info["remaining"])
+                    return False
 
-            if not res.can_run:
-                ctx.custom_error = MaxKarenConcurrencyReached()
+                check_cooldown = False
+
+                # karen is told about the cooldown too, otherwise it'd be lost if the lease expires or this cluster
+                # disconnects before the lease is revoked (which is when karen merges the cluster's cooldowns)
+                await self.ipc.send(CooldownAddPacket(command=command, user_id=ctx.author.id))
+
+        check_concurrency = command in self.d.concurrency_limited
+        check_econ_paused = ctx.command.cog_name == "Econ"
+
+        # everything karen has to check is done in one request, which also counts the command if it can run
+        ask_karen = check_cooldown or check_concurrency or check_econ_paused
+
+        if ask_karen:
+            try:
+                requested_at = time.monotonic()
+                res = await self.ipc.request(
+                    AdmitPacket(
+                        command=command,
+                        user_id=ctx.author.id,
+                        cooldown=check_cooldown,
+                        concurrency=check_concurrency,
+                        econ=check_econ_paused,
+                    )
+                )
+            except (
+                RequestTimeoutError,
+                ConnectionLostError,
+            ) as e:  # karen didn't respond in time, so the command can't be safely ran
+                self.logger.warning(str(e))
+                ctx.failure_reason = "karen_timeout"
                 return False
 
-        # handle paused econ users
-        if ctx.command.cog_name == "Econ":
-            # check if user has paused econ
-            res = await self.ipc.eval(f"econ_paused_users.get({ctx.author.id})")
+            if check_cooldown:
+                self.cooldown_leases.update(ctx.author.id, res, requested_at)
+
+            if not res.can_run:
+                if res.concurrency_limited:
+                    ctx.custom_error = MaxKarenConcurrencyReached()
+                elif res.econ_paused:
+                    ctx.failure_reason = "econ_paused"
+                else:
+                    ctx.custom_error = CommandOnKarenCooldown(res.remaining)
 
-            if res.result is not None:
-                ctx.failure_reason = "econ_paused"
                 return False
 
+        if ctx.command.cog_name == "Econ":
             if random.randint(0, self.d.mob_chance) == 0:  # spawn mob?
                 if self.d.cooldown_rates.get(command, 0) >= 2:
                     if not self.prevent_spawn_duplicates.check(ctx.channel.id):
@@ -245,26 +334,34 @@ class VillagerBotCluster(commands.AutoShardedBot, PacketHandlerRegistry):
             elif random.randint(0, self.d.tip_chance) == 0:  # send tip?
                 asyncio.create_task(self.send_tip(ctx))
 
-        asyncio.create_task(self.ipc.send({"type": PacketType.COMMAND_RAN, "user_id": ctx.author.id}))
+        if not ask_karen:  # otherwise the ADMIT packet counted it
+            asyncio.create_task(self.ipc.send(CommandRanPacket(user_id=ctx.author.id)))
 
         return True
 
     async def before_command_invoked(self, ctx):
         try:
             if str(ctx.command) in self.d.concurrency_limited:
-                await self.ipc.send(
-                    {"type": PacketType.CONCURRENCY_ACQUIRE, "command": str(ctx.command), "user_id": ctx.author.id}
-                )
+                await self.ipc.send(ConcurrencyAcquirePacket(command=str(ctx.command), user_id=ctx.author.id))
+                ctx.concurrency_acquired = True
         except Exception as e:
             self.logger.error(format_exception(e))
             raise
 
+    async def release_concurrency(self, ctx) -> None:
+        # only a command which acquired a slot releases one, and only once since after_command_invoked() and
+        # on_command_error() are both called for commands which raised
+        if getattr(ctx, "concurrency_acquired", False):
+            ctx.concurrency_acquired = False
+
+            try:
+                await self.ipc.send(ConcurrencyReleasePacket(command=str(ctx.command), user_id=ctx.author.id))
+            except ConnectionLostError:  # karen already freed the slots this connection held when it was lost
+                pass
+
     async def after_command_invoked(self, ctx):
         try:
-            if str(ctx.command) in self.d.concurrency_limited:
-                await self.ipc.send(
-                    {"type": PacketType.CONCURRENCY_RELEASE, "command": str(ctx.command), "user_id": ctx.author.id}
-                )
+            await self.release_concurrency(ctx)
         except Exception as e:
             self.logger.error(format_exception(e))
             raise
@@ -304,29 +401,49 @@ class VillagerBotCluster(commands.AutoShardedBot, PacketHandlerRegistry):
 
         return {"result": result, "success": success}
 
+    @handle_packet(PacketType.DATA_RELOAD)
+    async def handle_data_reload_packet(self, packet: ClassyDict):
+        try:
+            await self.reload_data()
+        except Exception as e:
+            result = format_exception(e)
+            self.logger.error(result)
+
+            return {"result": result, "success": False}
+
+        return {"result": None, "success": True}
+
     @handle_packet(PacketType.REMINDER)
     async def handle_reminder_packet(self, packet: ClassyDict):
-        success = False
-        channel = self.get_channel(packet.channel_id)
+        # every cluster gets the batch, the reminders in channels other clusters can see are skipped
+        sent = await asyncio.gather(*[self.send_reminder(reminder) for reminder in packet.reminders])
 
-        if channel is not None:
-            user = self.get_user(packet.user_id)
+        return {"delivered": [reminder.message_id for reminder, success in zip(packet.reminders, sent) if success]}
 
-            if user is not None:
-                lang = self.get_language(channel)
+    async def send_reminder(self, reminder: ClassyDict) -> bool:
+        channel = self.get_channel(reminder.channel_id)
 
-                try:
-                    message = await channel.fetch_message(packet.message_id)
-                    await message.reply(lang.useful.remind.reminder.format(user.mention, packet.reminder), mention_author=True)
-                    success = True
-                except Exception:
-                    try:
-                        await channel.send(lang.useful.remind.reminder.format(user.mention, packet.reminder))
-                        success = True
-                    except Exception as e:
-                        self.logger.error(format_exception(e))
+        if channel is None:
+            return False
 
-        return {"success": success}
+        user = self.get_user(reminder.user_id)
+
+        if user is None:
+            return False
+
+        lang = self.get_language(channel)
+
+        try:
+            message = await channel.fetch_message(reminder.message_id)
+            await message.reply(lang.useful.remind.reminder.format(user.mention, reminder.reminder), mention_author=True)
+        except Exception:
+            try:
+                await channel.send(lang.useful.remind.reminder.format(user.mention, reminder.reminder))
+            except Exception as e:
+                self.logger.error(format_exception(e))
+                return False
+
+        return True
 
     @handle_packet(PacketType.FETCH_STATS)
     async def handle_fetch_stats_packet(self, packet: ClassyDict):
@@ -350,6 +467,18 @@ class VillagerBotCluster(commands.AutoShardedBot, PacketHandlerRegistry):
             ],
         }
 
+    @handle_packet(PacketType.FETCH_IPC_METRICS)
+    async def handle_fetch_ipc_metrics_packet(self, packet: ClassyDict):
+        return {
+            "metrics": self.ipc.metrics.to_dict(),
+            "dispatch": self.ipc.pool.get_stats(),
+            "cooldowns": self.cooldown_leases.get_stats(),
+        }
+
+    @handle_packet(PacketType.COOLDOWN_LEASE_REVOKE, dispatch=DISPATCH_INLINE)
+    def handle_cooldown_lease_revoke_packet(self, packet: ClassyDict):
+        return {"cooldowns": self.cooldown_leases.revoke(packet.user_id)}
+
     @handle_packet(PacketType.UPDATE_SUPPORT_SERVER_ROLES)
     async def handle_update_support_server_roles_packet(self, packet: ClassyDict):
         success = False
@@ -8,7 +8,7 @@ import math
 import numpy as np
 
 from util.misc import lb_logic, format_required, make_health_bar, calc_total_wealth, emojify_item, SuppressCtxManager
-from util.ipc import PacketType
+from util.ipc import PacketType, MineCommandPacket, ActiveEffectPacket
 
 
 class Econ(commands.Cog):
@@ -42,7 +42,7 @@ class Econ(commands.Cog):
 
     async def math_problem(self, ctx, addition=1):
         # simultaneously updates the value in Karen and retrivies the current value
-        res = await self.ipc.request({"type": PacketType.MINE_COMMAND, "user_id": ctx.author.id, "addition": addition})
+        res = await self.ipc.request(MineCommandPacket(user_id=ctx.author.id, addition=addition))
         mine_commands = res.current
 
         if mine_commands >= 100:
@@ -735,7 +735,9 @@ class Econ(commands.Cog):
         await self.db.add_item(ctx.author.id, shop_item.db_entry[0], shop_item.db_entry[1], amount, shop_item.db_entry[2])
 
         if shop_item.db_entry[0].endswith("Pickaxe") or shop_item.db_entry[0] == "Bane Of Pillagers Amulet":
-            await self.ipc.broadcast({"type": PacketType.UPDATE_SUPPORT_SERVER_ROLES, "user": ctx.author.id})
+            await self.ipc.broadcast(
+                {"type": PacketType.UPDATE_SUPPORT_SERVER_ROLES, "user": ctx.author.id}, guild_id=self.d.support_server_id
+            )
         elif shop_item.db_entry[0] == "Rich Person Trophy":
             await self.db.rich_trophy_wipe(ctx.author.id)
 
@@ -801,7 +803,9 @@ class Econ(commands.Cog):
         await self.db.remove_item(ctx.author.id, db_item["name"], amount)
 
         if db_item["name"].endswith("Pickaxe") or db_item["name"] == "Bane Of Pillagers Amulet":
-            await self.ipc.broadcast({"type": PacketType.UPDATE_SUPPORT_SERVER_ROLES, "user": ctx.author.id})
+            await self.ipc.broadcast(
+                {"type": PacketType.UPDATE_SUPPORT_SERVER_ROLES, "user": ctx.author.id}, guild_id=self.d.support_server_id
+            )
 
         await ctx.reply_embed(
             ctx.l.econ.sell.you_done_sold.format(
@@ -1299,13 +1303,13 @@ class Econ(commands.Cog):
                 return
 
             await self.db.remove_item(ctx.author.id, thing, 1)
-            await self.ipc.eval(f"active_effects[{ctx.author.id}].add('haste i potion')")
+            await self.ipc.send(ActiveEffectPacket(user_id=ctx.author.id, effect="haste i potion", duration=60 * 6))
             await ctx.reply_embed(ctx.l.econ.use.chug.format("Haste I Potion", 6))
 
             await asyncio.sleep(60 * 6)
 
             await self.bot.send_embed(ctx.author, ctx.l.econ.use.done.format("Haste I Potion"))
-            await self.ipc.eval(f"active_effects[{ctx.author.id}].remove('haste i potion')")
+            await self.ipc.eval(f"active_effects[{ctx.author.id}].discard('haste i potion')")
             return
 
         if thing == "haste ii potion":
@@ -1314,13 +1318,13 @@ class Econ(commands.Cog):
                 return
 
             await self.db.remove_item(ctx.author.id, thing, 1)
-            await self.ipc.eval(f"active_effects[{ctx.author.id}].add('haste ii potion')")
+            await self.ipc.send(ActiveEffectPacket(user_id=ctx.author.id, effect="haste ii potion", duration=60 * 4.5))
             await ctx.reply_embed(ctx.l.econ.use.chug.format("Haste II Potion", 4.5))
 
             await asyncio.sleep(60 * 4.5)
 
             await self.bot.send_embed(ctx.author, ctx.l.econ.use.done.format("Haste II Potion"))
-            await self.ipc.eval(f"active_effects[{ctx.author.id}].remove('haste ii potion')")
+            await self.ipc.eval(f"active_effects[{ctx.author.id}].discard('haste ii potion')")
             return
 
         if thing == "luck potion":
@@ -1329,13 +1333,13 @@ class Econ(commands.Cog):
                 return
 
             await self.db.remove_item(ctx.author.id, thing, 1)
-            await self.ipc.eval(f"active_effects[{ctx.author.id}].add('luck potion')")
+            await self.ipc.send(ActiveEffectPacket(user_id=ctx.author.id, effect="luck potion", duration=60 * 4.5))
             await ctx.reply_embed(ctx.l.econ.use.chug.format("Luck Potion", 4.5))
 
             await asyncio.sleep(60 * 4.5)
 
             await self.bot.send_embed(ctx.author, ctx.l.econ.use.done.format("Luck Potion"))
-            await self.ipc.eval(f"active_effects[{ctx.author.id}].remove('luck potion')")
+            await self.ipc.eval(f"active_effects[{ctx.author.id}].discard('luck potion')")
             return
 
         if thing == "seaweed":
@@ -1344,13 +1348,13 @@ class Econ(commands.Cog):
                 return
 
             await self.db.remove_item(ctx.author.id, thing, 1)
-            await self.ipc.eval(f"active_effects[{ctx.author.id}].add('seaweed')")
+            await self.ipc.send(ActiveEffectPacket(user_id=ctx.author.id, effect="seaweed", duration=60 * 30))
             await ctx.reply_embed(ctx.l.econ.use.smoke_seaweed.format(30))
 
             await asyncio.sleep(60 * 30)
 
             await self.bot.send_embed(ctx.author, ctx.l.econ.use.seaweed_done)
-            await self.ipc.eval(f"active_effects[{ctx.author.id}].remove('seaweed')")
+            await self.ipc.eval(f"active_effects[{ctx.author.id}].discard('seaweed')")
             return
 
         if thing == "vault potion":
@@ -11,7 +11,8 @@ import os
 
 from util.code import execute_code, format_exception
 from util.misc import SuppressCtxManager
-from util.ipc import PacketType
+from util.metrics import summarize, merge_metrics
+from util.ipc import PacketType, TOPIC_BAN_LIST
 
 
 class Owner(commands.Cog):
@@ -42,14 +43,7 @@ class Owner(commands.Cog):
     async def update_data(self, ctx):
         """Reloads data from data.json and text from the translation files"""
 
-        code = """
-        from util.setup import load_text, load_data
-
-        bot.l = load_text()
-        bot.d = load_data()
-        """
-
-        res = await self.ipc.broadcast({"type": PacketType.EXEC, "code": code})
+        res = await self.ipc.broadcast({"type": PacketType.DATA_RELOAD})
         failed = False
 
         for data in res.responses:
@@ -132,6 +126,56 @@ class Owner(commands.Cog):
         else:
             await ctx.reply_embed(guilds)
 
+    @commands.command(name="ipcmetrics", aliases=["ipcstats"])
+    @commands.is_owner()
+    async def ipc_metrics(self, ctx, sort_by: str = "handler_latency"):
+        """Shows the packet types karen and the clusters spend the most time on"""
+
+        res, karen_res = await asyncio.gather(
+            self.ipc.broadcast({"type": PacketType.FETCH_IPC_METRICS}),
+            self.ipc.request({"type": PacketType.FETCH_IPC_METRICS}),
+        )
+
+        clusters = merge_metrics(*[r.metrics for r in res.responses])
+        clusters_dispatch = {k: sum(r.dispatch[k] for r in res.responses) for k in karen_res.dispatch}
+
+        local_checks = sum(r.cooldowns.local_checks for r in res.responses)
+        remote_checks = sum(r.cooldowns.remote_checks for r in res.responses)
+
+        body = (
+            f"cooldowns: {local_checks / max(local_checks + remote_checks, 1):.1%} checked by clusters "
+            f"({local_checks} local, {remote_checks} by karen), {karen_res.cooldowns.leases} leases held, "
+            f"{karen_res.cooldowns.leases_revoked} revoked\n"
+            f"concurrency: {karen_res.concurrency.slots} slots held, {karen_res.concurrency.expired} stuck slots reclaimed "
+            f"after their lease expired, {karen_res.concurrency.disconnected} after their cluster disconnected\n"
+            f"reminders: {karen_res.reminders.scheduled} scheduled, {karen_res.reminders.in_flight} being delivered, "
+            f"{karen_res.reminders.delivered} delivered, {karen_res.reminders.dropped} undeliverable\n"
+            f"routing: {karen_res.broadcasts.routed} packets sent only to their shard's cluster, "
+            f"{karen_res.broadcasts.unrouted} broadcast because it wasn't connected\n\n"
+        )
+
+        for name, metrics, dispatch in (
+            ("karen", karen_res.metrics, karen_res.dispatch),
+            (f"clusters ({len(res.responses)})", clusters, clusters_dispatch),
+        ):
+            body += (
+                f"{name}: {dispatch['running']}/{dispatch['workers']} handlers running, "
+                f"{dispatch['queued']} queued (max {dispatch['queued_max']}), "
+                f"{dispatch['backpressure_waits']} backpressure waits, {dispatch['errors']} errors\n"
+            )
+            body += f"{'type':<28}{'recv':>8}{'sent':>8}{'KiB':>8}"
+            body += "".join(f"{column:>9}" for column in ("queue50", "hndl50", "hndl99", "req99")) + "\n"
+
+            for row in summarize(metrics, sort_by, 8):
+                packet_type, received, sent, size = row[:4]
+
+                body += f"{packet_type[:27]:<28}{received:>8}{sent:>8}{size // 1024:>8}"
+                body += "".join(f"{latency * 1000:>8.2f}m" for latency in row[4:]) + "\n"
+
+            body += "\n"
+
+        await ctx.reply(f"```\n{body[:2000-8]}```")
+
     @commands.command(name="setbal")
     @commands.is_owner()
     async def set_user_bal(self, ctx, user: Union[discord.User, int], balance: int):
@@ -152,7 +196,7 @@ class Owner(commands.Cog):
             uid = user
 
         await self.db.update_user(uid, bot_banned=True)
-        await self.ipc.broadcast({"type": PacketType.EVAL, "code": f"self.ban_cache.add({uid})"})
+        await self.ipc.publish(TOPIC_BAN_LIST, {"user_id": uid, "banned": True})
 
         await ctx.message.add_reaction(self.d.emojis.yes)
 
@@ -165,7 +209,7 @@ class Owner(commands.Cog):
             uid = user
 
         await self.db.update_user(uid, bot_banned=False)
-        await self.ipc.broadcast({"type": PacketType.EVAL, "code": f"self.ban_cache.remove({uid})"})
+        await self.ipc.publish(TOPIC_BAN_LIST, {"user_id": uid, "banned": False})
 
         await ctx.message.add_reaction(self.d.emojis.yes)
 
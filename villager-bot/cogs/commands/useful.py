@@ -9,7 +9,7 @@ import arrow
 import time
 
 from util.misc import SuppressCtxManager
-from util.ipc import PacketType
+from util.ipc import PacketType, ReminderAddPacket
 
 
 class BanCacheEntry:
@@ -586,7 +586,20 @@ class Useful(commands.Cog):
             await ctx.reply_embed(ctx.l.useful.remind.time_max)
             return
 
-        await self.db.add_reminder(ctx.author.id, ctx.channel.id, ctx.message.id, " ".join(args[i:])[:499], at.datetime)
+        reminder = " ".join(args[i:])[:499]
+        guild_id = None if ctx.guild is None else ctx.guild.id
+
+        await self.db.add_reminder(ctx.author.id, ctx.channel.id, guild_id, ctx.message.id, reminder, at.datetime)
+        await self.ipc.send(  # so karen can schedule it without waiting for its next load from the database
+            ReminderAddPacket(
+                user_id=ctx.author.id,
+                channel_id=ctx.channel.id,
+                guild_id=guild_id,
+                message_id=ctx.message.id,
+                reminder=reminder,
+                at=at.datetime.timestamp(),
+            )
+        )
         await ctx.reply_embed(ctx.l.useful.remind.remind.format(self.bot.d.emojis.yes, at.humanize(locale=ctx.l.lang)))
 
     @commands.command(name="snipe")
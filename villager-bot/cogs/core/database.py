@@ -1,11 +1,21 @@
 from collections import defaultdict
 from discord.ext import commands
 from contextlib import suppress
-from datetime import datetime
-from typing import List, Set
+from datetime import datetime, timezone
+from typing import List, Optional, Set
 import asyncio
 import asyncpg
 
+MAX_HEALTH = 20
+HEALTH_REGEN_INTERVAL = 32  # seconds it takes to regenerate one health point
+
+
+def regenerate_health(health: int, updated_at: datetime, now: datetime) -> int:
+    if health >= MAX_HEALTH:
+        return health
+
+    return min(MAX_HEALTH, health + int((now - updated_at).total_seconds() // HEALTH_REGEN_INTERVAL))
+
 
 class Database(commands.Cog):
     def __init__(self, bot):
@@ -34,11 +44,14 @@ class Database(commands.Cog):
     async def fetch_user_reminder_count(self, user_id: int) -> int:
         return await self.db.fetchval("SELECT COUNT(*) FROM reminders WHERE user_id = $1", user_id)
 
-    async def add_reminder(self, user_id: int, channel_id: int, message_id: int, reminder: str, at: datetime) -> None:
+    async def add_reminder(
+        self, user_id: int, channel_id: int, guild_id: Optional[int], message_id: int, reminder: str, at: datetime
+    ) -> None:
         await self.db.execute(
-            "INSERT INTO reminders (user_id, channel_id, message_id, reminder, at) VALUES ($1, $2, $3, $4, $5)",
+            "INSERT INTO reminders (user_id, channel_id, guild_id, message_id, reminder, at) VALUES ($1, $2, $3, $4, $5, $6)",
             user_id,
             channel_id,
+            guild_id,
             message_id,
             reminder,
             at,
@@ -117,7 +130,7 @@ class Database(commands.Cog):
         else:
             await self.db.execute("INSERT INTO disabled_commands (guild_id, command) VALUES ($1, $2)", guild_id, command)
 
-    async def fetch_user(self, user_id: int) -> asyncpg.Record:
+    async def fetch_user(self, user_id: int) -> dict:
         user = await self.db.fetchrow("SELECT * FROM users WHERE user_id = $1", user_id)
 
         if user is None:
@@ -128,11 +141,18 @@ class Database(commands.Cog):
 
             return await self.fetch_user(user_id)
 
+        # health isn't written as it regenerates, it's calculated from when it was last changed instead
+        user = dict(user)
+        user["health"] = regenerate_health(user["health"], user["health_updated_at"], datetime.now(timezone.utc))
+
         return user
 
     async def update_user(self, user_id: int, **kwargs) -> None:
         db_user = await self.fetch_user(user_id)  # ensures user exists + we use db_user for updating badges
 
+        if "health" in kwargs:  # health regenerates from now on
+            kwargs["health_updated_at"] = datetime.now(timezone.utc)
+
         values = []
         sql = []
 
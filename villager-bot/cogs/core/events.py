@@ -8,7 +8,12 @@ import sys
 from util.cooldowns import CommandOnKarenCooldown, MaxKarenConcurrencyReached
 from util.misc import update_support_member_role
 from util.code import format_exception
-from util.ipc import PacketType
+from util.ipc import (
+    PacketType,
+    ShardReadyPacket,
+    ShardDisconnectPacket,
+    CooldownAddPacket,
+)
 
 
 IGNORED_ERRORS = (commands.CommandNotFound, commands.NotOwner)
@@ -76,12 +81,12 @@ class Events(commands.Cog):
 
     @commands.Cog.listener()
     async def on_shard_ready(self, shard_id: int):
-        await self.ipc.send({"type": PacketType.SHARD_READY, "shard_id": shard_id})
+        await self.ipc.send(ShardReadyPacket(shard_id=shard_id))
         self.bot.logger.info(f"Shard {shard_id} \u001b[36;1mREADY\u001b[0m")
 
     @commands.Cog.listener()
     async def on_shard_disconnect(self, shard_id: int):
-        await self.ipc.send({"type": PacketType.SHARD_DISCONNECT, "shard_id": shard_id})
+        await self.ipc.send(ShardDisconnectPacket(shard_id=shard_id))
 
     @commands.Cog.listener()
     async def on_ready(self):
@@ -278,7 +283,8 @@ class Events(commands.Cog):
 
         if seconds <= 0.05:
             if karen_cooldown:
-                await self.ipc.send({"type": PacketType.COOLDOWN_ADD, "command": ctx.command.name, "user_id": ctx.author.id})
+                self.bot.cooldown_leases.add_cooldown(ctx.command.name, ctx.author.id)
+                await self.ipc.send(CooldownAddPacket(command=ctx.command.name, user_id=ctx.author.id))
 
             await ctx.reinvoke()
             return
@@ -313,10 +319,7 @@ class Events(commands.Cog):
         if hasattr(ctx, "custom_error"):
             e = ctx.custom_error
 
-        if not isinstance(e, MaxKarenConcurrencyReached):
-            await self.ipc.send(
-                {"type": PacketType.CONCURRENCY_RELEASE, "command": str(ctx.command), "user_id": ctx.author.id}
-            )
+        await self.bot.release_concurrency(ctx)
 
         if isinstance(e, commands.CommandOnCooldown):
             await self.handle_cooldown(ctx, e.retry_after, False)
@@ -344,7 +347,7 @@ class Events(commands.Cog):
             elif failure_reason == "not_ready":
                 await self.bot.wait_until_ready()
                 await ctx.reply_embed(ctx.l.misc.errors.not_ready, ignore_exceptions=True)
-            elif failure_reason == "econ_paused":
+            elif failure_reason == "econ_paused" or failure_reason == "karen_timeout":
                 await ctx.reply_embed(ctx.l.misc.errors.nrn_buddy, ignore_exceptions=True)
             elif failure_reason == "disabled":
                 await ctx.reply_embed(ctx.l.misc.errors.disabled, ignore_exceptions=True)
@@ -123,7 +123,7 @@ class MobSpawner(commands.Cog):
                 continue
 
             db_user = await self.db.fetch_user(user.id)
-            user_health = db_user["health"]
+            user_health = starting_health = db_user["health"]
 
             if user_health < 1:
                 await ctx.send_embed(ctx.l.mobs_mech.no_health)
@@ -345,7 +345,9 @@ class MobSpawner(commands.Cog):
                         random.choice(ctx.l.mobs_mech.lost.normal).format(mob.nice.lower(), ems_lost, self.d.emojis.emerald)
                     )
         finally:
-            await self.db.update_user(user.id, health=user_health)
+            if user_health != starting_health:  # writing it would restart regeneration
+                await self.db.update_user(user.id, health=user_health)
+
             await self.ipc.eval(f"econ_paused_users.pop({user.id}, None)")  # unpause user
 
 
@@ -1,14 +1,51 @@
 from concurrent.futures import ProcessPoolExecutor
 from collections import defaultdict
+from typing import Optional
 from classyjson import ClassyDict
 import asyncio
 import asyncpg
+import time
 import psutil
 import arrow
 
-from util.ipc import Server, PacketType, PacketHandlerRegistry, handle_packet
+from util.ipc import (
+    Server,
+    PacketType,
+    PacketHandlerRegistry,
+    handle_packet,
+    EvalResponsePacket,
+    CooldownResponsePacket,
+    AdmitResponsePacket,
+    MineCommandResponsePacket,
+    ConcurrencyCheckResponsePacket,
+    T_PACKET,
+    DEFAULT_COMPRESSION_THRESHOLD,
+    DISPATCH_INLINE,
+    DISPATCH_TASK,
+    MODE_ALL,
+    current_connection,
+)
+from util.broadcasts import BroadcastManager
+from util.pubsub import PubSub
+from util.ring import RingBuffer
 from util.setup import load_secrets, load_data, setup_karen_logging
-from util.cooldowns import CooldownManager, MaxConcurrencyManager
+from util.cooldowns import (
+    CooldownManager,
+    CompactCooldownManager,
+    MaxConcurrencyManager,
+    COMPACT_COOLDOWNS_SUPPORTED,
+    DEFAULT_LEASE_DURATION,
+    DEFAULT_CONCURRENCY_LEASE_DURATION,
+    LEASE_REVOKE_TIMEOUT,
+)
+from util.reminders import ReminderScheduler, Reminder
+from util.snapshots import (
+    KarenSnapshots,
+    DEFAULT_SNAPSHOT_INTERVAL,
+    SECTION_ACTIVE_EFFECTS,
+    SECTION_MINE_COMMANDS,
+    SECTION_PILLAGES,
+)
 from util.code import execute_code, format_exception
 from util.misc import MultiLock
 
@@ -23,38 +60,75 @@ class MechaKaren(PacketHandlerRegistry):
             self.mine_commands = defaultdict(int)  # {user_id: command_count}, also used for fishing btw
             self.trivia_commands = defaultdict(int)  # {user_id: trivia_command_count}
             self.active_effects = defaultdict(set)  # {user_id: [effect, potion, effect,..]}
+            self.effect_ends = {}  # {(user_id, effect): time.time()}
             self.pillages = defaultdict(int)  # {user_id: num_successful_pillages}
 
             self.econ_paused_users = {}  # {user_id: time.time()}
 
-    def __init__(self):
-        self.k = load_secrets()
+    def __init__(self, secrets: Optional[ClassyDict] = None):
+        self.k = load_secrets() if secrets is None else secrets
         self.d = load_data()
         self.v = self.Share()
 
         self.logger = setup_karen_logging()
         self.db = None
-        self.cooldowns = CooldownManager(self.d.cooldown_rates)
-        self.concurrency = MaxConcurrencyManager()
+        self.cooldowns = self.make_cooldown_manager()
+        self.cooldown_revokes = {}  # {user_id: asyncio.Task}, leases which are being revoked
+        self.concurrency = MaxConcurrencyManager(
+            self.k.manager.get("concurrency_lease_duration", DEFAULT_CONCURRENCY_LEASE_DURATION)
+        )
         self.pillage_lock = MultiLock()
-        self.server = Server(self.k.manager.host, self.k.manager.port, self.k.manager.auth, self.get_packet_handlers())
+        self.server = Server(
+            self.k.manager.host,
+            self.k.manager.port,
+            self.k.manager.auth,
+            self.get_packet_handlers(),
+            batch_window=self.k.manager.get("batch_window"),
+            unix_socket=self.k.manager.get("unix_socket"),
+            compression_threshold=self.k.manager.get("compression_threshold", DEFAULT_COMPRESSION_THRESHOLD),
+            logger=self.logger,
+        )
 
         self.shard_ids = tuple(range(self.k.shard_count))
         self.online_shards = set()
 
         self.eval_env = {"karen": self, **self.v.__dict__}
 
-        self.broadcasts = {}  # {broadcast_id: {ready: asyncio.Event, responses: [response, response,..]}}
+        # karen's state is snapshotted to disk so it isn't lost when karen restarts, if a path is configured
+        snapshot_path = self.k.manager.get("snapshot_path")
+        self.snapshots = None if snapshot_path is None else KarenSnapshots(snapshot_path, self.cooldowns, self.v)
+
+        self.broadcasts = BroadcastManager(self.server, shard_count=self.k.shard_count)
+        self.pubsub = PubSub(self.server)
+        self.server.disconnect_handlers.append(self.cooldowns.end_leases)
+        self.server.disconnect_handlers.append(self.concurrency.end_slots)
         self.dm_messages = {}  # {user_id: {event: asyncio.Event, content: "contents of message"}}
-        self.current_id = 0
 
         self.commands = defaultdict(int)
         self.commands_lock = asyncio.Lock()
 
+        self.reminders = ReminderScheduler()
+        self.reminder_deliveries = set()  # asyncio.Tasks delivering batches of reminders
+
         self.commands_task = None
-        self.heal_users_task = None
         self.clear_trivia_commands_task = None
         self.reminders_task = None
+        self.snapshots_task = None
+
+    def make_cooldown_manager(self) -> CooldownManager:
+        lease_duration = self.k.manager.get("cooldown_lease_duration", DEFAULT_LEASE_DURATION)
+
+        if self.k.manager.get("compact_cooldowns"):
+            if COMPACT_COOLDOWNS_SUPPORTED:
+                return CompactCooldownManager(self.d.cooldown_rates, lease_duration)
+
+            self.logger.warning("compact_cooldowns is enabled but util.cooldown_table isn't compiled, using dicts")
+
+        return CooldownManager(self.d.cooldown_rates, lease_duration)
+
+    def track_change(self, section: int, user_id: int, name: str = "") -> None:  # for the next snapshot
+        if self.snapshots is not None:
+            self.snapshots.track(section, user_id, name)
 
     @handle_packet(PacketType.MISSING_PACKET)
     async def handle_missing_packet(self, packet: ClassyDict):
@@ -65,19 +139,19 @@ class MechaKaren(PacketHandlerRegistry):
 
         self.logger.error(f"Missing packet handler for packet type {packet_type}")
 
-    @handle_packet(PacketType.SHARD_READY)
-    async def handle_shard_ready_packet(self, packet: ClassyDict):
+    @handle_packet(PacketType.SHARD_READY, dispatch=DISPATCH_INLINE)
+    def handle_shard_ready_packet(self, packet: T_PACKET):
         self.online_shards.add(packet.shard_id)
 
         if len(self.online_shards) == len(self.shard_ids):
             self.logger.info(f"\u001b[36;1mALL SHARDS\u001b[0m [0-{len(self.online_shards)-1}] \u001b[36;1mREADY\u001b[0m")
 
-    @handle_packet(PacketType.SHARD_DISCONNECT)
-    async def handle_shard_disconnect_packet(self, packet: ClassyDict):
+    @handle_packet(PacketType.SHARD_DISCONNECT, dispatch=DISPATCH_INLINE)
+    def handle_shard_disconnect_packet(self, packet: T_PACKET):
         self.online_shards.discard(packet.shard_id)
 
     @handle_packet(PacketType.EVAL)
-    async def handle_eval_packet(self, packet: ClassyDict):
+    async def handle_eval_packet(self, packet: T_PACKET):
         try:
             result = eval(packet.code, self.eval_env)
             success = True
@@ -87,7 +161,7 @@ class MechaKaren(PacketHandlerRegistry):
 
             self.logger.error(result)
 
-        return {"type": PacketType.EVAL_RESPONSE, "result": result, "success": success}
+        return EvalResponsePacket(result=result, success=success)
 
     @handle_packet(PacketType.EXEC)
     async def handle_exec_packet(self, packet: ClassyDict):
@@ -102,48 +176,145 @@ class MechaKaren(PacketHandlerRegistry):
 
         return {"type": PacketType.EXEC_RESPONSE, "result": result, "success": success}
 
-    @handle_packet(PacketType.BROADCAST_REQUEST)
+    @handle_packet(PacketType.BROADCAST_REQUEST, dispatch=DISPATCH_TASK)
     async def handle_broadcast_request_packet(self, packet: ClassyDict):
-        """broadcasts the packet to every connection including the broadcaster, and waits for responses"""
+        """broadcasts the packet to every connection including the broadcaster (or only to the cluster which runs the
+        guild's shard if a guild_id is given), and waits for responses"""
 
-        broadcast_id = f"b{self.current_id}"
-        self.current_id += 1
+        connections = None
 
-        broadcast_packet = {**packet.packet, "id": broadcast_id}
-        broadcast_coros = [s.write_packet(broadcast_packet) for s in self.server.connections]
-        broadcast = self.broadcasts[broadcast_id] = {
-            "ready": asyncio.Event(),
-            "responses": [],
-            "expects": len(broadcast_coros),
-        }
+        if packet.get("guild_id") is not None:
+            connections = self.broadcasts.routed_connections(self.broadcasts.route_guild(packet.guild_id))
+
+        broadcast = self.broadcasts.start(
+            packet.packet, mode=packet.get("mode", MODE_ALL), quorum=packet.get("quorum"), connections=connections
+        )
+
+        try:
+            wait_task = asyncio.create_task(broadcast.wait(packet.get("timeout", self.broadcasts.default_timeout)))
+
+            if packet.get("stream"):  # send each response to the broadcaster as it comes in
+                requester = current_connection.get()
+
+                async for response in broadcast:
+                    await requester.write_packet({"type": PacketType.BROADCAST_PARTIAL, "id": packet.id, "response": response})
 
-        await asyncio.wait(broadcast_coros)
-        await broadcast["ready"].wait()
+            await wait_task
+        finally:
+            self.broadcasts.finish(broadcast)
 
-        return {"type": PacketType.BROADCAST_RESPONSE, "responses": broadcast["responses"]}
+        if not broadcast.complete:
+            self.logger.warning(
+                f"Broadcast of {packet.packet.get('type')} timed out with {len(broadcast.responses)}/{broadcast.expects} responses"
+            )
 
-    @handle_packet(PacketType.BROADCAST_RESPONSE)
-    async def handle_broadcast_response_packet(self, packet: ClassyDict):
-        broadcast = self.broadcasts[packet.id]
-        broadcast["responses"].append(packet)
+        return {"type": PacketType.BROADCAST_RESPONSE, "responses": broadcast.responses, "complete": broadcast.complete}
 
-        if len(broadcast["responses"]) == broadcast["expects"]:
-            broadcast["ready"].set()
+    @handle_packet(PacketType.BROADCAST_RESPONSE, dispatch=DISPATCH_INLINE)
+    def handle_broadcast_response_packet(self, packet: ClassyDict):
+        self.broadcasts.handle_response(packet)
+
+    @handle_packet(PacketType.SUBSCRIBE, dispatch=DISPATCH_INLINE)
+    def handle_subscribe_packet(self, packet: T_PACKET):
+        self.pubsub.subscribe(current_connection.get(), packet.topics)
+
+    @handle_packet(PacketType.UNSUBSCRIBE, dispatch=DISPATCH_INLINE)
+    def handle_unsubscribe_packet(self, packet: T_PACKET):
+        self.pubsub.unsubscribe(current_connection.get(), packet.topics)
+
+    @handle_packet(PacketType.PUBLISH, dispatch=DISPATCH_INLINE)
+    def handle_publish_packet(self, packet: T_PACKET):
+        self.pubsub.publish(packet)
+
+    # COOLDOWN and ADMIT can wait on another cluster to give up a lease for up to LEASE_REVOKE_TIMEOUT, so they run in
+    # their own tasks instead of occupying the pool's workers (and the connection's lane) every connection shares
+    @handle_packet(PacketType.COOLDOWN, dispatch=DISPATCH_TASK)
+    async def handle_cooldown_packet(self, packet: T_PACKET):
+        connection = current_connection.get()
+        contended = await self.reclaim_cooldown_lease(packet.user_id, connection)
 
-    @handle_packet(PacketType.COOLDOWN)
-    async def handle_cooldown_packet(self, packet: ClassyDict):
         cooldown_info = self.cooldowns.check(packet.command, packet.user_id)
-        return {"type": PacketType.COOLDOWN_RESPONSE, **cooldown_info}
 
-    @handle_packet(PacketType.COOLDOWN_ADD)
-    async def handle_cooldown_add_packet(self, packet: ClassyDict):
+        # a lease which was just revoked isn't granted again by the same check, so it doesn't bounce between clusters
+        if not contended:
+            cooldown_info.update(self.cooldowns.grant_lease(packet.user_id, connection))
+
+        return CooldownResponsePacket(**cooldown_info)
+
+    @handle_packet(PacketType.ADMIT, dispatch=DISPATCH_TASK)
+    async def handle_admit_packet(self, packet: T_PACKET):
+        connection = current_connection.get()
+        contended = packet.cooldown and await self.reclaim_cooldown_lease(packet.user_id, connection)
+
+        # nothing below awaits, so no other packet can change what's checked before it's applied
+        if packet.cooldown:
+            remaining = self.cooldowns.get_remaining(packet.command, packet.user_id)
+
+            if remaining:
+                return AdmitResponsePacket(can_run=False, remaining=remaining)
+
+        if packet.concurrency and not self.concurrency.check(packet.command, packet.user_id):
+            return AdmitResponsePacket(can_run=False, concurrency_limited=True)
+
+        if packet.econ and self.v.econ_paused_users.get(packet.user_id) is not None:
+            return AdmitResponsePacket(can_run=False, econ_paused=True)
+
+        lease_info = {}
+
+        if packet.cooldown:
+            self.cooldowns.add_cooldown(packet.command, packet.user_id)
+
+            if not contended:
+                lease_info = self.cooldowns.grant_lease(packet.user_id, connection)
+
+        self.commands[packet.user_id] += 1  # commands_dump_loop() doesn't await while holding commands_lock
+
+        return AdmitResponsePacket(can_run=True, **lease_info)
+
+    async def reclaim_cooldown_lease(self, user_id: int, connection: object) -> bool:
+        """Waits until no other cluster holds the user's cooldown lease, revoking it if needed. Returns whether a lease
+        had to be revoked."""
+
+        contended = False
+
+        while True:
+            revoke_task = self.cooldown_revokes.get(user_id)
+
+            if revoke_task is None:
+                holder = self.cooldowns.get_lease_holder(user_id)
+
+                if holder is None or holder is connection:
+                    return contended
+
+                revoke_task = self.cooldown_revokes[user_id] = asyncio.create_task(self.revoke_cooldown_lease(user_id, holder))
+
+            contended = True
+            await asyncio.shield(revoke_task)
+
+    async def revoke_cooldown_lease(self, user_id: int, holder: object) -> None:
+        try:
+            broadcast = await self.broadcasts.broadcast(
+                {"type": PacketType.COOLDOWN_LEASE_REVOKE, "user_id": user_id},
+                timeout=LEASE_REVOKE_TIMEOUT,
+                connections=[holder],
+            )
+
+            if not broadcast.complete:
+                self.logger.warning(f"Cluster holding the cooldown lease of user {user_id} didn't respond to its revocation")
+
+            self.cooldowns.end_lease(user_id, broadcast.responses[0].cooldowns if broadcast.responses else None)
+        finally:
+            self.cooldown_revokes.pop(user_id, None)
+
+    @handle_packet(PacketType.COOLDOWN_ADD, dispatch=DISPATCH_INLINE)
+    def handle_cooldown_add_packet(self, packet: T_PACKET):
         self.cooldowns.add_cooldown(packet.command, packet.user_id)
 
-    @handle_packet(PacketType.COOLDOWN_RESET)
-    async def handle_cooldown_reset_packet(self, packet: ClassyDict):
+    @handle_packet(PacketType.COOLDOWN_RESET, dispatch=DISPATCH_INLINE)
+    def handle_cooldown_reset_packet(self, packet: T_PACKET):
         self.cooldowns.clear_cooldown(packet.command, packet.user_id)
 
-    @handle_packet(PacketType.DM_MESSAGE_REQUEST)
+    @handle_packet(PacketType.DM_MESSAGE_REQUEST, dispatch=DISPATCH_TASK)
     async def handle_dm_message_request_packet(self, packet: ClassyDict):
         entry = self.dm_messages[packet.user_id] = {"event": asyncio.Event(), "content": None}
         await entry["event"].wait()
@@ -152,8 +323,8 @@ class MechaKaren(PacketHandlerRegistry):
 
         return {"type": PacketType.DM_MESSAGE, "content": entry["content"]}
 
-    @handle_packet(PacketType.DM_MESSAGE)
-    async def handle_dm_message_packet(self, packet: ClassyDict):
+    @handle_packet(PacketType.DM_MESSAGE, dispatch=DISPATCH_INLINE)
+    def handle_dm_message_packet(self, packet: ClassyDict):
         entry = self.dm_messages.get(packet.user_id)
 
         if entry is None:
@@ -162,47 +333,75 @@ class MechaKaren(PacketHandlerRegistry):
         entry["content"] = packet.content
         entry["event"].set()
 
-    @handle_packet(PacketType.MINE_COMMAND)
-    async def handle_mine_command_packet(self, packet: ClassyDict):  # used for fishing too
+    @handle_packet(PacketType.MINE_COMMAND, dispatch=DISPATCH_INLINE)
+    def handle_mine_command_packet(self, packet: T_PACKET):  # used for fishing too
         self.v.mine_commands[packet.user_id] += packet.addition
-        return {"type": PacketType.MINE_COMMAND_RESPONSE, "current": self.v.mine_commands[packet.user_id]}
+        self.track_change(SECTION_MINE_COMMANDS, packet.user_id)
+
+        return MineCommandResponsePacket(current=self.v.mine_commands[packet.user_id])
 
-    @handle_packet(PacketType.MINE_COMMANDS_RESET)
-    async def handle_mine_commands_reset_packet(self, packet: ClassyDict):
+    @handle_packet(PacketType.MINE_COMMANDS_RESET, dispatch=DISPATCH_INLINE)
+    def handle_mine_commands_reset_packet(self, packet: ClassyDict):
         self.v.mine_commands[packet.user] = 0
+        self.track_change(SECTION_MINE_COMMANDS, packet.user)
 
-    @handle_packet(PacketType.CONCURRENCY_CHECK)
-    async def handle_concurrency_check_packet(self, packet: ClassyDict):
-        return {
-            "type": PacketType.CONCURRENCY_CHECK_RESPONSE,
-            "can_run": self.concurrency.check(packet.command, packet.user_id),
-        }
+    @handle_packet(PacketType.ACTIVE_EFFECT, dispatch=DISPATCH_INLINE)
+    def handle_active_effect_packet(self, packet: T_PACKET):
+        ends_at = time.time() + packet.duration
+
+        self.v.active_effects[packet.user_id].add(packet.effect)
+        self.v.effect_ends[(packet.user_id, packet.effect)] = ends_at
+        self.track_change(SECTION_ACTIVE_EFFECTS, packet.user_id, packet.effect)
+
+        self.schedule_effect_end(packet.user_id, packet.effect, ends_at)
+
+    def schedule_effect_end(self, user_id: int, effect: str, ends_at: float) -> None:
+        # karen ends effects itself instead of relying on the cluster which used the potion, whose task is lost if it
+        # restarts (or karen does), so neither active_effects nor effect_ends keep effects which ended
+        asyncio.get_event_loop().call_later(max(ends_at - time.time(), 0), self.end_effect, user_id, effect, ends_at)
+
+    def end_effect(self, user_id: int, effect: str, ends_at: float) -> None:
+        if self.v.effect_ends.get((user_id, effect)) == ends_at:  # it wasn't used again since
+            del self.v.effect_ends[(user_id, effect)]
+            self.v.active_effects[user_id].discard(effect)
+
+    @handle_packet(PacketType.REMINDER_ADD, dispatch=DISPATCH_INLINE)
+    def handle_reminder_add_packet(self, packet: T_PACKET):
+        self.reminders.add(
+            Reminder(packet.at, packet.message_id, packet.user_id, packet.channel_id, packet.reminder, packet.guild_id)
+        )
+
+    @handle_packet(PacketType.CONCURRENCY_CHECK, dispatch=DISPATCH_INLINE)
+    def handle_concurrency_check_packet(self, packet: T_PACKET):
+        return ConcurrencyCheckResponsePacket(can_run=self.concurrency.check(packet.command, packet.user_id))
 
-    @handle_packet(PacketType.CONCURRENCY_ACQUIRE)
-    async def handle_concurrency_acquire_packet(self, packet: ClassyDict):
-        self.concurrency.acquire(packet.command, packet.user_id)
+    @handle_packet(PacketType.CONCURRENCY_ACQUIRE, dispatch=DISPATCH_INLINE)
+    def handle_concurrency_acquire_packet(self, packet: T_PACKET):
+        self.concurrency.acquire(packet.command, packet.user_id, current_connection.get())
 
-    @handle_packet(PacketType.CONCURRENCY_RELEASE)
-    async def handle_concurrency_release_packet(self, packet: ClassyDict):
-        self.concurrency.release(packet.command, packet.user_id)
+    @handle_packet(PacketType.CONCURRENCY_RELEASE, dispatch=DISPATCH_INLINE)
+    def handle_concurrency_release_packet(self, packet: T_PACKET):
+        self.concurrency.release(packet.command, packet.user_id, current_connection.get())
 
     @handle_packet(PacketType.COMMAND_RAN)
-    async def handle_command_ran_packet(self, packet: ClassyDict):
+    async def handle_command_ran_packet(self, packet: T_PACKET):
         async with self.commands_lock:
             self.commands[packet.user_id] += 1
 
-    @handle_packet(PacketType.ACQUIRE_PILLAGE_LOCK)
+    @handle_packet(PacketType.ACQUIRE_PILLAGE_LOCK, dispatch=DISPATCH_TASK)
     async def handle_acquire_pillage_lock_packet(self, packet: ClassyDict):
         await self.pillage_lock.acquire(packet.user_ids)
         return {}
 
-    @handle_packet(PacketType.RELEASE_PILLAGE_LOCK)
-    async def handle_release_pillage_lock_packet(self, packet: ClassyDict):
+    @handle_packet(PacketType.RELEASE_PILLAGE_LOCK, dispatch=DISPATCH_INLINE)
+    def handle_release_pillage_lock_packet(self, packet: ClassyDict):
         self.pillage_lock.release(packet.user_ids)
 
-    @handle_packet(PacketType.PILLAGE)
-    async def handle_pillage_packet(self, packet: ClassyDict):
+    @handle_packet(PacketType.PILLAGE, dispatch=DISPATCH_INLINE)
+    def handle_pillage_packet(self, packet: ClassyDict):
         self.v.pillages[packet.pillager] += 1
+        self.track_change(SECTION_PILLAGES, packet.pillager)
+
         return {"pillager": self.v.pillages[packet.pillager] - 1, "victim": self.v.pillages[packet.victim] - 1}
 
     @handle_packet(PacketType.FETCH_STATS)
@@ -214,41 +413,63 @@ class MechaKaren(PacketHandlerRegistry):
 
         return {"type": PacketType.STATS_RESPONSE, "stats": [mem_usage, threads, len(asyncio.all_tasks())] + [0] * 7}
 
-    @handle_packet(PacketType.TRIVIA)
-    async def handle_trivia_packet(self, packet: ClassyDict):
+    @handle_packet(PacketType.FETCH_IPC_METRICS)
+    async def handle_fetch_ipc_metrics_packet(self, packet: ClassyDict):
+        return {
+            "metrics": self.server.metrics.to_dict(),
+            "broadcasts": self.broadcasts.get_stats(),
+            "pubsub": self.pubsub.get_stats(),
+            "cooldowns": self.cooldowns.get_stats(),
+            "concurrency": self.concurrency.get_stats(),
+            "reminders": self.reminders.get_stats(),
+            "dispatch": self.server.pool.get_stats(),
+        }
+
+    @handle_packet(PacketType.TRIVIA, dispatch=DISPATCH_INLINE)
+    def handle_trivia_packet(self, packet: ClassyDict):
         self.v.trivia_commands[packet.author] += 1
         return {"do_reward": self.v.trivia_commands[packet.author] < 5}
 
-    async def commands_dump_loop(self):
-        try:
-            while True:
-                await asyncio.sleep(60)
-
-                if self.commands:
-                    async with self.commands_lock:
-                        commands_dump = list(self.commands.items())
-                        user_ids = [(user_id,) for user_id in list(self.commands.keys())]
-
-                        self.commands.clear()
-
-                    await self.db.executemany(
-                        'INSERT INTO users (user_id) VALUES ($1) ON CONFLICT ("user_id") DO NOTHING', user_ids
-                    )  # ensure users are in the database first
-                    await self.db.executemany(
-                        'INSERT INTO leaderboards (user_id, commands) VALUES ($1, $2) ON CONFLICT ("user_id") DO UPDATE SET "commands" = leaderboards.commands + $2 WHERE leaderboards.user_id = $1',
-                        commands_dump,
-                    )
-        except Exception as e:
-            self.logger.error(format_exception(e))
+    async def dump_commands(self, commands_dump: list) -> None:
+        """Adds [(user_id, commands),..] to the leaderboards. The counts are copied into a temporary table and merged
+        with one statement per table, in a transaction so a failed dump can be retried without counting anything twice"""
+
+        async with self.db.acquire() as con:
+            async with con.transaction():
+                await con.execute("CREATE TEMPORARY TABLE commands_dump (user_id BIGINT, commands BIGINT) ON COMMIT DROP")
+                await con.copy_records_to_table("commands_dump", records=commands_dump)
+
+                # ensure users are in the database first
+                await con.execute(
+                    'INSERT INTO users (user_id) SELECT user_id FROM commands_dump ON CONFLICT ("user_id") DO NOTHING'
+                )
+                await con.execute(
+                    'INSERT INTO leaderboards (user_id, commands) SELECT user_id, commands FROM commands_dump ON CONFLICT ("user_id") DO UPDATE SET "commands" = leaderboards.commands + EXCLUDED.commands'
+                )
 
-    async def heal_users_loop(self):
+    async def commands_dump_loop(self):
         while True:
-            await asyncio.sleep(32)
+            await asyncio.sleep(60)
+
+            if not self.commands:
+                continue
+
+            async with self.commands_lock:
+                commands_dump = list(self.commands.items())
+                self.commands.clear()
 
             try:
-                await self.db.execute("UPDATE users SET health = health + 1 WHERE health < 20")
+                await self.dump_commands(commands_dump)
+            except asyncio.CancelledError:
+                self.requeue_commands(commands_dump)  # dumped by start() when karen shuts down
+                raise
             except Exception as e:
                 self.logger.error(format_exception(e))
+                self.requeue_commands(commands_dump)  # retried with the next dump
+
+    def requeue_commands(self, commands_dump: list) -> None:  # doesn't await, like handle_admit_packet()
+        for user_id, commands in commands_dump:
+            self.commands[user_id] += commands
 
     async def clear_trivia_commands_loop(self):
         while True:
@@ -259,31 +480,124 @@ class MechaKaren(PacketHandlerRegistry):
             except Exception as e:
                 self.logger.error(format_exception(e))
 
-    async def remind_reminders_loop(self):
+    async def snapshots_loop(self):
         while True:
-            await asyncio.sleep(5)
+            await asyncio.sleep(self.k.manager.get("snapshot_interval", DEFAULT_SNAPSHOT_INTERVAL))
 
             try:
-                reminders = await self.db.fetch(
-                    "DELETE FROM reminders WHERE at <= NOW() RETURNING channel_id, user_id, message_id, reminder"
-                )
+                await self.snapshots.write()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                self.logger.error(format_exception(e))
+
+    async def restore_snapshot(self):
+        start = time.perf_counter()
+
+        try:
+            restored = await self.snapshots.restore()
+        except Exception as e:
+            self.logger.error(f"Failed to restore snapshot {self.snapshots.file.path}: {format_exception(e)}")
+            return
+
+        if restored is None:
+            return
+
+        counts, torn = restored
+        counts = ", ".join(f"{count} {section}" for section, count in counts.items())
+
+        self.logger.info(f"Restored {counts} from snapshot in {(time.perf_counter() - start) * 1000:.0f}ms")
+
+        if torn:
+            self.logger.warning(f"Snapshot {self.snapshots.file.path} ended with a partially written delta, which was skipped")
+
+        for (user_id, effect), ends_at in self.v.effect_ends.items():
+            self.schedule_effect_end(user_id, effect, ends_at)
+
+    async def load_reminders(self) -> None:
+        previous = self.reminders.loaded_until
+        until = self.reminders.start_load(time.time())
+
+        try:
+            # reminders which are overdue are loaded too, like ones which weren't delivered because a cluster was down
+            records = await self.db.fetch(
+                "SELECT user_id, channel_id, guild_id, message_id, reminder, at FROM reminders WHERE at <= $1",
+                arrow.get(until).datetime,
+            )
+        except BaseException:
+            self.reminders.loaded_until = previous  # so the load is retried
+            raise
+
+        self.reminders.load(
+            Reminder(r["at"].timestamp(), r["message_id"], r["user_id"], r["channel_id"], r["reminder"], r["guild_id"])
+            for r in records
+        )
+
+    def route_reminders(self, reminders: list) -> dict:
+        """Groups reminders by the connection of the cluster which runs their guild's shard, reminders in dms and in
+        guilds whose cluster isn't connected are grouped under None and sent to every cluster"""
+
+        routes = defaultdict(list)
 
-                for reminder in reminders:
-                    broadcast_id = f"b{self.current_id}"
-                    self.current_id += 1
+        for reminder in reminders:
+            routes[None if reminder.guild_id is None else self.broadcasts.route_guild(reminder.guild_id)].append(reminder)
 
-                    broadcast_packet = {"type": PacketType.REMINDER, "id": broadcast_id, **reminder}
-                    broadcast_coros = [s.write_packet(broadcast_packet) for s in self.server.connections]
-                    broadcast = self.broadcasts[broadcast_id] = {
-                        "ready": asyncio.Event(),
-                        "responses": [],
-                        "expects": len(broadcast_coros),
-                    }
+        return routes
 
-                    await asyncio.wait(broadcast_coros)
-                    await broadcast["ready"].wait()
+    async def deliver_reminders(self, reminders: list, connection: Optional[object] = None) -> None:
+        """Sends a batch of due reminders to the cluster they're routed to (or every cluster), each cluster delivers
+        the reminders in channels it can see and responds with their message ids. The reminders' rows are deleted once
+        they're delivered."""
+
+        delivered = set()
+        deleted = []
+
+        try:
+            broadcast = await self.broadcasts.broadcast(
+                {"type": PacketType.REMINDER, "reminders": [reminder.to_packet() for reminder in reminders]},
+                connections=None if connection is None else self.broadcasts.routed_connections(connection),
+            )
+
+            for response in broadcast.responses:
+                delivered.update(response.get("delivered", ()))
+
+            # if every cluster responded, the reminders which weren't delivered can't be (their channel is gone), if not
+            # they're kept and sent again after the next load
+            settled = [reminder.message_id for reminder in reminders] if broadcast.complete else list(delivered)
+
+            if settled:
+                await self.db.execute("DELETE FROM reminders WHERE message_id = ANY($1::BIGINT[])", settled)
+                deleted = settled
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            self.logger.error(format_exception(e))
+        finally:
+            self.reminders.finish(reminders, len(delivered), max(len(deleted) - len(delivered), 0))
+
+    async def remind_reminders_loop(self):
+        reminders = self.reminders
+
+        while True:
+            try:
+                if time.time() >= reminders.loaded_until:
+                    await self.load_reminders()
+
+                due = reminders.pop_due(time.time())
+
+                # sent in the background, so a slow cluster doesn't hold up the next batches
+                for connection, batch in self.route_reminders(due).items():
+                    task = asyncio.create_task(self.deliver_reminders(batch, connection))
+                    self.reminder_deliveries.add(task)
+                    task.add_done_callback(self.reminder_deliveries.discard)
+
+                if not due:
+                    await reminders.sleep(time.time())
+            except asyncio.CancelledError:
+                raise
             except Exception as e:
                 self.logger.error(format_exception(e))
+                await asyncio.sleep(5)
 
     async def start(self, pp):
         self.db = await asyncpg.create_pool(
@@ -295,14 +609,20 @@ class MechaKaren(PacketHandlerRegistry):
             min_size=1,
         )
 
+        if self.snapshots is not None:
+            await self.restore_snapshot()  # before the clusters start, so nothing can be overwritten
+
         await self.server.start()
         self.cooldowns.start()
+        self.concurrency.start()
 
         self.commands_task = asyncio.create_task(self.commands_dump_loop())
-        self.heal_users_task = asyncio.create_task(self.heal_users_loop())
         self.clear_trivia_commands_task = asyncio.create_task(self.clear_trivia_commands_loop())
         self.reminders_task = asyncio.create_task(self.remind_reminders_loop())
 
+        if self.snapshots is not None:
+            self.snapshots_task = asyncio.create_task(self.snapshots_loop())
+
         shard_groups = []
         loop = asyncio.get_event_loop()
         g = self.k.cluster_size
@@ -312,17 +632,51 @@ class MechaKaren(PacketHandlerRegistry):
         # 75 to leave room for other programs using the db server
         db_pool_size_per = 75 // (self.k.shard_count // g + 1)
 
+        # one-way packets from each cluster go through a shared memory ring buffer instead of the socket if enabled
+        ring_size = self.k.manager.get("ring_size")
+
         for shard_id_group in [self.shard_ids[i : i + g] for i in range(0, len(self.shard_ids), g)]:
-            shard_groups.append(loop.run_in_executor(pp, run_cluster, self.k.shard_count, shard_id_group, db_pool_size_per))
+            ring_path = None
+
+            if ring_size:
+                ring = RingBuffer.create(ring_size)
+                self.server.rings.append(ring)
+                ring_path = ring.path
+
+            shard_groups.append(
+                loop.run_in_executor(pp, run_cluster, self.k.shard_count, shard_id_group, db_pool_size_per, ring_path)
+            )
 
         await asyncio.wait(shard_groups)
         self.cooldowns.stop()
+        self.concurrency.stop()
+
+        for ring in self.server.rings:
+            ring.close()
 
         self.commands_task.cancel()
-        self.heal_users_task.cancel()
         self.clear_trivia_commands_task.cancel()
         self.reminders_task.cancel()
 
+        for task in self.reminder_deliveries:  # their reminders are still in the database
+            task.cancel()
+
+        if self.snapshots is not None:
+            self.snapshots_task.cancel()
+
+            try:
+                await self.snapshots.write(full=True)
+            except Exception as e:
+                self.logger.error(format_exception(e))
+
+        await asyncio.gather(self.commands_task, return_exceptions=True)  # it requeues a dump it was cancelled during
+
+        if self.commands:
+            try:
+                await self.dump_commands(list(self.commands.items()))
+            except Exception as e:
+                self.logger.error(format_exception(e))
+
         await self.db.close()
 
     def run(self):
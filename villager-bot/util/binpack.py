@@ -0,0 +1,451 @@
+from typing import Callable, Dict, Tuple, Union
+import classyjson as cj
+import struct
+import json
+
+try:  # the msgpack package is optional, when it's installed its C implementation is used
+    import msgpack
+except ImportError:
+    msgpack = None
+
+# A small, dependency free implementation of (a subset of) the msgpack format, used as the binary
+# codec for the Karen <-> cluster ipc. On top of the regular msgpack types, sets are supported
+# natively as ext type 1 (the ext data is a packed array of the set's members) and ints that don't
+# fit in 64 bits are sent as ext type 2 (the ext data is the int in base 10, encoded as ascii).
+#
+# Dicts are always unpacked into ClassyDicts so packets can be used the same as with the json codec.
+# For the same reason map keys are always unpacked as strings: ints, floats, bools and None are turned
+# into the string json would have made of them, and any other type of key is rejected.
+# If the msgpack package is installed, pack() and unpack() use it instead of the pure python
+# implementation, the wire format is the same so peers don't have to agree on it.
+#
+# Example:
+# >>> pack({"type": 13, "user_id": 536986067140608041})
+# bytearray(b'\x82\xa4type\r\xa7user_id\xcf\x07s\xc1\xfb\xa5@\x00)')
+
+EXT_SET = 1
+EXT_BIGINT = 2
+
+T_BYTES_LIKE = Union[bytes, bytearray, memoryview]
+
+_u8 = struct.Struct(">B")
+_u16 = struct.Struct(">H")
+_u32 = struct.Struct(">I")
+_u64 = struct.Struct(">Q")
+_i8 = struct.Struct(">b")
+_i16 = struct.Struct(">h")
+_i32 = struct.Struct(">i")
+_i64 = struct.Struct(">q")
+_f32 = struct.Struct(">f")
+_f64 = struct.Struct(">d")
+
+_pack_tagged_u8 = struct.Struct(">BB").pack
+_pack_tagged_u16 = struct.Struct(">BH").pack
+_pack_tagged_u32 = struct.Struct(">BI").pack
+_pack_tagged_u64 = struct.Struct(">BQ").pack
+_pack_tagged_i8 = struct.Struct(">Bb").pack
+_pack_tagged_i16 = struct.Struct(">Bh").pack
+_pack_tagged_i32 = struct.Struct(">Bi").pack
+_pack_tagged_i64 = struct.Struct(">Bq").pack
+_pack_tagged_f64 = struct.Struct(">Bd").pack
+
+
+class PackError(TypeError):
+    pass
+
+
+class UnpackError(ValueError):
+    pass
+
+
+def _pack_none(obj: None, buf: bytearray) -> None:
+    buf.append(0xC0)
+
+
+def _pack_bool(obj: bool, buf: bytearray) -> None:
+    buf.append(0xC3 if obj else 0xC2)
+
+
+def _pack_int(obj: int, buf: bytearray) -> None:
+    if obj >= 0:
+        if obj <= 0x7F:
+            buf.append(obj)
+        elif obj <= 0xFF:
+            buf += _pack_tagged_u8(0xCC, obj)
+        elif obj <= 0xFFFF:
+            buf += _pack_tagged_u16(0xCD, obj)
+        elif obj <= 0xFFFFFFFF:
+            buf += _pack_tagged_u32(0xCE, obj)
+        elif obj <= 0xFFFFFFFFFFFFFFFF:
+            buf += _pack_tagged_u64(0xCF, obj)
+        else:
+            _pack_ext(EXT_BIGINT, str(obj).encode("ascii"), buf)
+    else:
+        if obj >= -32:
+            buf.append(obj & 0xFF)
+        elif obj >= -0x80:
+            buf += _pack_tagged_i8(0xD0, obj)
+        elif obj >= -0x8000:
+            buf += _pack_tagged_i16(0xD1, obj)
+        elif obj >= -0x80000000:
+            buf += _pack_tagged_i32(0xD2, obj)
+        elif obj >= -0x8000000000000000:
+            buf += _pack_tagged_i64(0xD3, obj)
+        else:
+            _pack_ext(EXT_BIGINT, str(obj).encode("ascii"), buf)
+
+
+def _pack_float(obj: float, buf: bytearray) -> None:
+    buf += _pack_tagged_f64(0xCB, obj)
+
+
+def _pack_str(obj: str, buf: bytearray) -> None:
+    data = obj.encode("utf8")
+    length = len(data)
+
+    if length <= 31:
+        buf.append(0xA0 | length)
+    elif length <= 0xFF:
+        buf += _pack_tagged_u8(0xD9, length)
+    elif length <= 0xFFFF:
+        buf += _pack_tagged_u16(0xDA, length)
+    else:
+        buf += _pack_tagged_u32(0xDB, length)
+
+    buf += data
+
+
+def _pack_bytes(obj: T_BYTES_LIKE, buf: bytearray) -> None:
+    length = len(obj)
+
+    if length <= 0xFF:
+        buf += _pack_tagged_u8(0xC4, length)
+    elif length <= 0xFFFF:
+        buf += _pack_tagged_u16(0xC5, length)
+    else:
+        buf += _pack_tagged_u32(0xC6, length)
+
+    buf += obj
+
+
+def _pack_array_header(length: int, buf: bytearray) -> None:
+    if length <= 15:
+        buf.append(0x90 | length)
+    elif length <= 0xFFFF:
+        buf += _pack_tagged_u16(0xDC, length)
+    else:
+        buf += _pack_tagged_u32(0xDD, length)
+
+
+def _pack_array(obj: Union[list, tuple], buf: bytearray) -> None:
+    _pack_array_header(len(obj), buf)
+
+    for item in obj:
+        (_PACKERS.get(type(item)) or _find_packer(item))(item, buf)
+
+
+def _pack_map(obj: dict, buf: bytearray) -> None:
+    length = len(obj)
+
+    if length <= 15:
+        buf.append(0x80 | length)
+    elif length <= 0xFFFF:
+        buf += _pack_tagged_u16(0xDE, length)
+    else:
+        buf += _pack_tagged_u32(0xDF, length)
+
+    for k, v in obj.items():
+        (_PACKERS.get(type(k)) or _find_packer(k))(k, buf)
+        (_PACKERS.get(type(v)) or _find_packer(v))(v, buf)
+
+
+def _pack_ext(ext_type: int, data: bytes, buf: bytearray) -> None:
+    length = len(data)
+
+    if length <= 0xFF:
+        buf += _pack_tagged_u8(0xC7, length)
+    elif length <= 0xFFFF:
+        buf += _pack_tagged_u16(0xC8, length)
+    else:
+        buf += _pack_tagged_u32(0xC9, length)
+
+    buf.append(ext_type)
+    buf += data
+
+
+def _pack_set(obj: Union[set, frozenset], buf: bytearray) -> None:
+    data = bytearray()
+    _pack_array(tuple(obj), data)
+    _pack_ext(EXT_SET, data, buf)
+
+
+_PACKERS: Dict[type, Callable[[object, bytearray], None]] = {
+    type(None): _pack_none,
+    bool: _pack_bool,
+    int: _pack_int,
+    float: _pack_float,
+    str: _pack_str,
+    bytes: _pack_bytes,
+    bytearray: _pack_bytes,
+    memoryview: _pack_bytes,
+    list: _pack_array,
+    tuple: _pack_array,
+    dict: _pack_map,
+    set: _pack_set,
+    frozenset: _pack_set,
+}
+
+
+def _find_packer(obj: object) -> Callable[[object, bytearray], None]:
+    # subclasses (IntEnum, ClassyDict, defaultdict, etc...) are looked up once and then cached
+    for base, packer in tuple(_PACKERS.items()):
+        if base is not bool and isinstance(obj, base):
+            _PACKERS[type(obj)] = packer
+            return packer
+
+    raise PackError(f"Object of type {type(obj).__name__} can't be packed")
+
+
+def _pack_into(obj: object, buf: bytearray) -> None:
+    (_PACKERS.get(type(obj)) or _find_packer(obj))(obj, buf)
+
+
+def py_pack(obj: object) -> bytearray:
+    buf = bytearray()
+    _pack_into(obj, buf)
+    return buf
+
+
+def _unpack_str(data: T_BYTES_LIKE, i: int, length: int) -> Tuple[str, int]:
+    end = i + length
+    return str(data[i:end], "utf8"), end
+
+
+def _unpack_array(data: T_BYTES_LIKE, i: int, length: int) -> Tuple[list, int]:
+    if length > len(data) - i:  # every item takes at least a byte, so a bogus length can't make this allocate gigabytes
+        raise UnpackError("Truncated data")
+
+    array = [None] * length
+
+    for j in range(length):
+        array[j], i = _unpack_from(data, i)
+
+    return array, i
+
+
+def _map_key(key: object) -> str:
+    if key is None or isinstance(key, (bool, int, float)):
+        return json.dumps(key)
+
+    raise UnpackError(f"Invalid map key of type {type(key).__name__}")
+
+
+def _unpack_set(array: list) -> set:
+    try:
+        return set(array)
+    except TypeError as e:  # unhashable members
+        raise UnpackError(f"Malformed set ext: {e}") from e
+
+
+def _unpack_map(data: T_BYTES_LIKE, i: int, length: int) -> Tuple[cj.ClassyDict, int]:
+    if length * 2 > len(data) - i:  # every key and value takes at least a byte
+        raise UnpackError("Truncated data")
+
+    items = []
+
+    for _ in range(length):
+        k, i = _unpack_from(data, i)
+        v, i = _unpack_from(data, i)
+        items.append((k if type(k) is str else _map_key(k), v))
+
+    # nested values are already unpacked into ClassyDicts, so skip the ClassyDict constructor's classify pass
+    dct = cj.ClassyDict()
+    dict.update(dct, items)
+    return dct, i
+
+
+def _unpack_ext(data: T_BYTES_LIKE, i: int, length: int) -> Tuple[object, int]:
+    ext_type = data[i]
+    i += 1
+    end = i + length
+
+    if ext_type == EXT_SET:
+        array, i = _unpack_from(data, i)
+
+        if i != end:
+            raise UnpackError("Malformed set ext")
+
+        return _unpack_set(array), end
+
+    if ext_type == EXT_BIGINT:
+        return int(str(data[i:end], "ascii")), end
+
+    raise UnpackError(f"Unknown ext type {ext_type}")
+
+
+def _unpack_from(data: T_BYTES_LIKE, i: int) -> Tuple[object, int]:
+    b = data[i]
+    i += 1
+
+    if b <= 0x7F:  # positive fixint
+        return b, i
+
+    if b >= 0xE0:  # negative fixint
+        return b - 0x100, i
+
+    if b >= 0xA0 and b <= 0xBF:  # fixstr
+        return _unpack_str(data, i, b & 0x1F)
+
+    if b >= 0x80 and b <= 0x8F:  # fixmap
+        return _unpack_map(data, i, b & 0x0F)
+
+    if b >= 0x90 and b <= 0x9F:  # fixarray
+        return _unpack_array(data, i, b & 0x0F)
+
+    if b == 0xC0:
+        return None, i
+
+    if b == 0xC2:
+        return False, i
+
+    if b == 0xC3:
+        return True, i
+
+    if b == 0xCC:
+        return data[i], i + 1
+
+    if b == 0xCD:
+        return _u16.unpack_from(data, i)[0], i + 2
+
+    if b == 0xCE:
+        return _u32.unpack_from(data, i)[0], i + 4
+
+    if b == 0xCF:
+        return _u64.unpack_from(data, i)[0], i + 8
+
+    if b == 0xD0:
+        return _i8.unpack_from(data, i)[0], i + 1
+
+    if b == 0xD1:
+        return _i16.unpack_from(data, i)[0], i + 2
+
+    if b == 0xD2:
+        return _i32.unpack_from(data, i)[0], i + 4
+
+    if b == 0xD3:
+        return _i64.unpack_from(data, i)[0], i + 8
+
+    if b == 0xCA:
+        return _f32.unpack_from(data, i)[0], i + 4
+
+    if b == 0xCB:
+        return _f64.unpack_from(data, i)[0], i + 8
+
+    if b == 0xD9:
+        return _unpack_str(data, i + 1, data[i])
+
+    if b == 0xDA:
+        return _unpack_str(data, i + 2, _u16.unpack_from(data, i)[0])
+
+    if b == 0xDB:
+        return _unpack_str(data, i + 4, _u32.unpack_from(data, i)[0])
+
+    if b >= 0xC4 and b <= 0xC6:  # bin 8/16/32
+        size = 1 << (b - 0xC4)
+        length = data[i] if size == 1 else (_u16 if size == 2 else _u32).unpack_from(data, i)[0]
+        i += size
+        return bytes(data[i : i + length]), i + length
+
+    if b == 0xDC:
+        return _unpack_array(data, i + 2, _u16.unpack_from(data, i)[0])
+
+    if b == 0xDD:
+        return _unpack_array(data, i + 4, _u32.unpack_from(data, i)[0])
+
+    if b == 0xDE:
+        return _unpack_map(data, i + 2, _u16.unpack_from(data, i)[0])
+
+    if b == 0xDF:
+        return _unpack_map(data, i + 4, _u32.unpack_from(data, i)[0])
+
+    if b >= 0xC7 and b <= 0xC9:  # ext 8/16/32
+        size = 1 << (b - 0xC7)
+        length = data[i] if size == 1 else (_u16 if size == 2 else _u32).unpack_from(data, i)[0]
+        return _unpack_ext(data, i + size, length)
+
+    if b >= 0xD4 and b <= 0xD8:  # fixext 1/2/4/8/16
+        return _unpack_ext(data, i, 1 << (b - 0xD4))
+
+    raise UnpackError(f"Invalid type byte 0x{b:02X} at offset {i - 1}")
+
+
+def py_unpack(data: T_BYTES_LIKE) -> object:
+    try:
+        obj, end = _unpack_from(data, 0)
+    except (IndexError, struct.error) as e:
+        raise UnpackError("Truncated data") from e
+
+    if end > len(data):
+        raise UnpackError("Truncated data")
+
+    if end < len(data):
+        raise UnpackError(f"Trailing data after offset {end}")
+
+    return obj
+
+
+def _classy_dict_from_pairs(pairs: list) -> cj.ClassyDict:
+    dct = cj.ClassyDict()
+    dict.update(dct, [(k if type(k) is str else _map_key(k), v) for k, v in pairs])
+    return dct
+
+
+def _msgpack_default(obj: object) -> object:
+    if isinstance(obj, (set, frozenset)):
+        return msgpack.ExtType(EXT_SET, msgpack.packb(tuple(obj), default=_msgpack_default))
+
+    if isinstance(obj, int):
+        return msgpack.ExtType(EXT_BIGINT, str(obj).encode("ascii"))
+
+    raise PackError(f"Object of type {type(obj).__name__} can't be packed")
+
+
+def _msgpack_ext_hook(ext_type: int, data: bytes) -> object:
+    if ext_type == EXT_SET:
+        return _unpack_set(_msgpack_unpack(data))
+
+    if ext_type == EXT_BIGINT:
+        return int(data.decode("ascii"))
+
+    raise UnpackError(f"Unknown ext type {ext_type}")
+
+
+def _msgpack_pack(obj: object) -> bytes:
+    try:
+        return msgpack.packb(obj, default=_msgpack_default)
+    except OverflowError:  # older versions of msgpack raise instead of calling default() for ints which don't fit in 64 bits
+        return py_pack(obj)
+
+
+def _msgpack_unpack(data: T_BYTES_LIKE) -> object:
+    try:
+        return msgpack.unpackb(
+            data,
+            object_pairs_hook=_classy_dict_from_pairs,
+            ext_hook=_msgpack_ext_hook,
+            strict_map_key=False,
+            raw=False,
+        )
+    except ValueError as e:
+        if isinstance(e, UnpackError):
+            raise
+
+        raise UnpackError(str(e)) from e
+
+
+if msgpack is None:
+    pack = py_pack
+    unpack = py_unpack
+else:
+    pack = _msgpack_pack
+    unpack = _msgpack_unpack
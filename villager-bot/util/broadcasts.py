@@ -0,0 +1,276 @@
+from typing import AsyncIterator, Callable, Dict, Optional
+from collections import deque
+import asyncio
+import time
+
+from util.ipc import Server, T_PACKET, BROADCAST_MODES, MODE_ALL, MODE_FIRST, current_connection, guild_shard_id
+
+DEFAULT_BROADCAST_TIMEOUT = 20  # seconds a broadcast waits for responses by default, None means forever
+
+T_ANSWER_CHECK = Callable[[T_PACKET], bool]
+
+
+def is_answer(response: T_PACKET) -> bool:  # default answer check for MODE_FIRST, meant for eval responses
+    return response.get("success", True) and response.get("result") is not None
+
+
+class Broadcast:
+    def __init__(self, broadcast_id: str, connections: list, mode: str, quorum: Optional[int], answer_check: T_ANSWER_CHECK):
+        if mode not in BROADCAST_MODES:
+            raise ValueError(f"Invalid broadcast mode {mode!r}")
+
+        expects = len(connections)
+
+        self.id = broadcast_id
+        self.expects = expects
+        self.pending = set(connections)  # connections which haven't responded yet
+        self.mode = mode
+        self.quorum = expects if quorum is None else min(quorum, expects)
+        self.answer_check = answer_check
+
+        self.responses = []
+        self.answer = None  # the first response which passed answer_check, for MODE_FIRST
+
+        self.created_at = time.monotonic()
+        self.finished_at = None
+
+        self._done = asyncio.Event()
+        self._queue = asyncio.Queue()  # responses which haven't been consumed by __aiter__ yet
+
+        self.send_tasks = set()  # the tasks sending the packet, cancelled once the broadcast is done
+
+        if expects == 0:
+            self._finish()
+
+    @property
+    def done(self) -> bool:
+        return self._done.is_set()
+
+    @property
+    def complete(self) -> bool:  # whether the broadcast got what it was waiting for before its deadline
+        if self.mode == MODE_FIRST:
+            return self.answer is not None or len(self.responses) >= self.expects
+
+        return len(self.responses) >= self.quorum
+
+    @property
+    def latency(self) -> float:
+        return (self.finished_at or time.monotonic()) - self.created_at
+
+    def _finish(self) -> None:
+        if not self.done:
+            self.finished_at = time.monotonic()
+            self._done.set()
+            self._queue.put_nowait(None)
+
+            for task in self.send_tasks:
+                task.cancel()
+
+    def add_response(self, response: T_PACKET, connection: object = None) -> None:
+        if self.done:
+            return
+
+        self.pending.discard(connection)
+        self.responses.append(response)
+        self._queue.put_nowait(response)
+
+        if self.mode == MODE_FIRST and self.answer is None and self.answer_check(response):
+            self.answer = response
+
+        if self.complete:
+            self._finish()
+
+    def connection_lost(self, connection: object) -> None:
+        """Stops waiting on a connection which was lost before it responded"""
+
+        if self.done or connection not in self.pending:
+            return
+
+        self.pending.discard(connection)
+        self.expects -= 1
+        self.quorum = min(self.quorum, self.expects)
+
+        if self.complete:
+            self._finish()
+
+    async def wait(self, timeout: Optional[float]) -> bool:
+        """Waits until the broadcast is complete or the timeout passes, returns whether it's complete"""
+
+        try:
+            await asyncio.wait_for(self._done.wait(), timeout)
+        except asyncio.TimeoutError:
+            pass
+
+        self._finish()
+
+        return self.complete
+
+    async def __aiter__(self) -> AsyncIterator[T_PACKET]:
+        """Yields responses as they arrive until the broadcast is done, doesn't apply a timeout by itself"""
+
+        while True:
+            response = await self._queue.get()
+
+            if response is None:
+                return
+
+            yield response
+
+
+class BroadcastManager:
+    """Sends packets to every connection of a Server and collects the responses"""
+
+    def __init__(
+        self, server: Server, default_timeout: Optional[float] = DEFAULT_BROADCAST_TIMEOUT, shard_count: Optional[int] = None
+    ):
+        self.server = server
+        self.default_timeout = default_timeout
+        self.shard_count = shard_count  # needed to route packets to a guild's cluster
+
+        self.broadcasts: Dict[str, Broadcast] = {}
+        self.current_id = 0
+
+        server.disconnect_handlers.append(self.connection_lost)
+
+        # counters
+        self.started = 0
+        self.completed = 0
+        self.timed_out = 0
+        self.late_responses = 0  # responses to broadcasts which were already finished
+        self.routed = 0  # packets sent only to the cluster which runs their shard
+        self.unrouted = 0  # packets which were meant for one shard, but were broadcast because no cluster runs it
+        self.latencies = deque(maxlen=1000)  # latencies of the most recent finished broadcasts, in seconds
+
+    def start(
+        self,
+        packet: T_PACKET,
+        *,
+        mode: str = MODE_ALL,
+        quorum: Optional[int] = None,
+        answer_check: T_ANSWER_CHECK = is_answer,
+        connections: Optional[list] = None,
+    ) -> Broadcast:
+        """Creates a broadcast and sends its packet to every connection (or only to the given ones), the caller has to
+        finish() it"""
+
+        broadcast_id = f"b{self.current_id}"
+        self.current_id += 1
+
+        connections = list(self.server.connections if connections is None else connections)
+
+        broadcast = self.broadcasts[broadcast_id] = Broadcast(broadcast_id, connections, mode, quorum, answer_check)
+        self.started += 1
+
+        broadcast_packet = {**packet, "id": broadcast_id}
+
+        for connection in connections:
+            task = asyncio.create_task(self._send(connection, broadcast_packet))
+            broadcast.send_tasks.add(task)
+            task.add_done_callback(broadcast.send_tasks.discard)
+
+        return broadcast
+
+    async def _send(self, connection, packet: dict) -> None:
+        try:
+            # only waiting on the write is cancelled with the broadcast, the packets in the same batch / bulk queue
+            # wait on the same future, cancelling the write itself would cancel theirs too
+            await asyncio.shield(connection.write_packet(packet))
+        except asyncio.CancelledError:
+            raise
+        except (ConnectionError, RuntimeError):  # the connection died, so the broadcast will time out
+            pass
+        except Exception as e:
+            self.server.pool.logger.error(f"Failed to send broadcast {packet['id']}: {e!r}")
+
+    def finish(self, broadcast: Broadcast) -> None:
+        """Removes the broadcast and records its stats, safe to call multiple times"""
+
+        if self.broadcasts.pop(broadcast.id, None) is None:
+            return
+
+        broadcast._finish()
+
+        if broadcast.complete:
+            self.completed += 1
+        else:
+            self.timed_out += 1
+
+        self.latencies.append(broadcast.latency)
+
+    async def broadcast(
+        self,
+        packet: T_PACKET,
+        *,
+        timeout: object = ...,
+        mode: str = MODE_ALL,
+        quorum: Optional[int] = None,
+        answer_check: T_ANSWER_CHECK = is_answer,
+        connections: Optional[list] = None,
+    ) -> Broadcast:
+        """Broadcasts a packet and waits until enough responses arrived or the timeout passes, check
+        Broadcast.complete to see which happened. If no timeout is passed, default_timeout is used."""
+
+        broadcast = self.start(packet, mode=mode, quorum=quorum, answer_check=answer_check, connections=connections)
+
+        try:
+            await broadcast.wait(self.default_timeout if timeout is ... else timeout)
+        finally:
+            self.finish(broadcast)
+
+        return broadcast
+
+    def route(self, shard_id: int) -> Optional[object]:
+        """Returns the connection of the cluster which runs the shard, or None if no connected cluster announced it"""
+
+        return self.server.shard_connections.get(shard_id)
+
+    def route_guild(self, guild_id: int) -> Optional[object]:
+        return self.route(guild_shard_id(guild_id, self.shard_count))
+
+    def routed_connections(self, connection: Optional[object]) -> Optional[list]:
+        """The connections a packet for a shard is sent to, every connection if the shard's cluster isn't known"""
+
+        if connection is None:
+            self.unrouted += 1
+            return None
+
+        self.routed += 1
+        return [connection]
+
+    async def route_to_shard(self, shard_id: int, packet: T_PACKET, **kwargs) -> Broadcast:
+        """Sends a packet only to the cluster which runs the shard and waits for its response, see broadcast()"""
+
+        return await self.broadcast(packet, connections=self.routed_connections(self.route(shard_id)), **kwargs)
+
+    async def route_to_guild(self, guild_id: int, packet: T_PACKET, **kwargs) -> Broadcast:
+        """Sends a packet only to the cluster which runs the guild's shard and waits for its response, see broadcast()"""
+
+        return await self.broadcast(packet, connections=self.routed_connections(self.route_guild(guild_id)), **kwargs)
+
+    def handle_response(self, response: T_PACKET) -> None:
+        broadcast = self.broadcasts.get(response.get("id"))
+
+        if broadcast is None or broadcast.done:
+            self.late_responses += 1
+            return
+
+        broadcast.add_response(response, current_connection.get())
+
+    def connection_lost(self, connection: object) -> None:
+        for broadcast in list(self.broadcasts.values()):
+            broadcast.connection_lost(connection)
+
+    def get_stats(self) -> dict:
+        latencies = sorted(self.latencies)
+
+        return {
+            "in_flight": len(self.broadcasts),
+            "started": self.started,
+            "completed": self.completed,
+            "timed_out": self.timed_out,
+            "late_responses": self.late_responses,
+            "routed": self.routed,
+            "unrouted": self.unrouted,
+            "latency_p50": latencies[len(latencies) // 2] if latencies else 0,
+            "latency_max": latencies[-1] if latencies else 0,
+        }
@@ -0,0 +1,209 @@
+# cython: boundscheck=False, wraparound=False
+
+import numpy as np
+import time
+
+cimport numpy as np
+
+ctypedef np.uint64_t NPUINT64_t
+ctypedef np.uint32_t NPUINT32_t
+ctypedef np.uint8_t NPUINT8_t
+
+cdef double MAX_LOAD = 0.5  # the table is grown once more than this fraction of its slots are used
+
+cdef NPUINT32_t MAX_CENTISECONDS = 0xFFFFFFFF  # ends are stored as uint32s, which wrap after ~497 days
+cdef double REBASE_AFTER = 0x7FFFFFFF / 100.0  # seconds after which the epoch is moved forward (~248 days)
+
+
+cdef inline NPUINT64_t slot_hash(NPUINT64_t user_id, NPUINT8_t command):
+    cdef NPUINT64_t h = (user_id ^ (command * <NPUINT64_t>0x9E3779B97F4A7C15)) * <NPUINT64_t>0xBF58476D1CE4E5B9
+    return h ^ (h >> 31)
+
+
+cdef class CooldownTable:
+    """An open addressing (linear probing) hash table of (user_id, command index) -> when the cooldown ends. End times
+    are stored as uint32 centiseconds since the epoch, 0 marks an empty slot, so a slot takes 13 bytes. The table is
+    kept at most half full and its capacity is a power of two, so there are 2-4 slots per cooldown, for 3 million
+    cooldowns (8M slots) that's 36.4 bytes a cooldown. So the ends don't wrap, sweep() moves the epoch forward (rebases
+    it) once it's REBASE_AFTER seconds old, ends too far ahead to be stored are clamped."""
+
+    cdef readonly double epoch  # time.time() the ends are counted from, the table's creation or last rebase
+    cdef readonly Py_ssize_t size  # used slots, including cooldowns which ended but weren't swept yet
+    cdef readonly Py_ssize_t capacity
+    cdef Py_ssize_t mask
+    cdef readonly Py_ssize_t sweep_cursor  # the slot the next sweep starts at, 0 once a sweep reached the last slot
+
+    cdef NPUINT64_t[::1] keys
+    cdef NPUINT8_t[::1] commands
+    cdef NPUINT32_t[::1] ends
+
+    def __init__(self, Py_ssize_t capacity = 1024):
+        self.epoch = time.time()
+        self.size = 0
+        self.sweep_cursor = 0
+
+        cdef Py_ssize_t power_of_two = 1024
+
+        while power_of_two < capacity:
+            power_of_two *= 2
+
+        self._allocate(power_of_two)
+
+    cdef void _allocate(self, Py_ssize_t capacity):
+        self.capacity = capacity
+        self.mask = capacity - 1
+
+        self.keys = np.zeros(capacity, np.uint64)
+        self.commands = np.zeros(capacity, np.uint8)
+        self.ends = np.zeros(capacity, np.uint32)
+
+    @property
+    def nbytes(self) -> int:
+        return self.capacity * (sizeof(NPUINT64_t) + sizeof(NPUINT8_t) + sizeof(NPUINT32_t))
+
+    def __len__(self) -> int:
+        return self.size
+
+    cdef inline NPUINT32_t _centiseconds(self, double timestamp):
+        cdef double centiseconds = (timestamp - self.epoch) * 100
+
+        if centiseconds < 1:
+            return 1
+
+        if centiseconds > MAX_CENTISECONDS:
+            return MAX_CENTISECONDS
+
+        return <NPUINT32_t>centiseconds
+
+    cpdef void rebase(self, double now):
+        """Moves the epoch forward to now, cooldowns which ended before it are kept as ended until they're swept"""
+
+        cdef NPUINT32_t delta = self._centiseconds(now)
+        cdef Py_ssize_t i
+
+        for i in range(self.capacity):
+            if self.ends[i] != 0:
+                self.ends[i] = self.ends[i] - delta if self.ends[i] > delta else 1
+
+        self.epoch += delta / 100.0
+
+    cdef Py_ssize_t _find(self, NPUINT64_t user_id, NPUINT8_t command):
+        """Returns the slot the key is in, or the empty slot it would be put in"""
+
+        cdef Py_ssize_t i = slot_hash(user_id, command) & self.mask
+
+        while self.ends[i] != 0 and (self.keys[i] != user_id or self.commands[i] != command):
+            i = (i + 1) & self.mask
+
+        return i
+
+    cdef void _grow(self):
+        cdef NPUINT64_t[::1] keys = self.keys
+        cdef NPUINT8_t[::1] commands = self.commands
+        cdef NPUINT32_t[::1] ends = self.ends
+        cdef Py_ssize_t old_capacity = self.capacity
+        cdef Py_ssize_t i, j
+
+        self._allocate(old_capacity * 2)
+
+        for i in range(old_capacity):
+            if ends[i] != 0:
+                j = self._find(keys[i], commands[i])
+
+                self.keys[j] = keys[i]
+                self.commands[j] = commands[i]
+                self.ends[j] = ends[i]
+
+    cdef void _delete(self, Py_ssize_t i):
+        """Empties a slot, moving back the entries after it which would no longer be found (backward shift deletion)"""
+
+        cdef Py_ssize_t j = i
+        cdef Py_ssize_t home
+
+        while True:
+            j = (j + 1) & self.mask
+
+            if self.ends[j] == 0:
+                break
+
+            home = slot_hash(self.keys[j], self.commands[j]) & self.mask
+
+            # the entry can stay if its home slot is cyclically in (i, j]
+            if (i <= j and i < home <= j) or (i > j and (home > i or home <= j)):
+                continue
+
+            self.keys[i] = self.keys[j]
+            self.commands[i] = self.commands[j]
+            self.ends[i] = self.ends[j]
+            i = j
+
+        self.ends[i] = 0
+        self.size -= 1
+
+    cpdef double get(self, NPUINT64_t user_id, NPUINT8_t command):
+        """Returns the time.time() the cooldown ends at, 0 if there is none"""
+
+        cdef Py_ssize_t i = self._find(user_id, command)
+
+        if self.ends[i] == 0:
+            return 0
+
+        return self.epoch + self.ends[i] / 100.0
+
+    cpdef void set(self, NPUINT64_t user_id, NPUINT8_t command, double ends_at):
+        cdef Py_ssize_t i = self._find(user_id, command)
+
+        if self.ends[i] == 0:
+            if self.size + 1 > self.capacity * MAX_LOAD:
+                self._grow()
+                i = self._find(user_id, command)
+
+            self.keys[i] = user_id
+            self.commands[i] = command
+            self.size += 1
+
+        self.ends[i] = self._centiseconds(ends_at)
+
+    cpdef bint remove(self, NPUINT64_t user_id, NPUINT8_t command):
+        """Removes the cooldown, returns whether there was one"""
+
+        cdef Py_ssize_t i = self._find(user_id, command)
+
+        if self.ends[i] == 0:
+            return False
+
+        self._delete(i)
+
+        return True
+
+    def dump(self) -> tuple:
+        """Copies the used slots into (user ids, command indexes, time.time() they end at) arrays"""
+
+        ends = np.asarray(self.ends)
+        used = np.flatnonzero(ends)
+
+        return np.asarray(self.keys)[used], np.asarray(self.commands)[used], self.epoch + ends[used] / 100.0
+
+    cpdef Py_ssize_t sweep(self, Py_ssize_t limit, double now):
+        """Removes cooldowns which ended at now, looking at up to limit slots from where the last sweep stopped and
+        stopping after the last slot. Returns how many slots it looked at."""
+
+        cdef NPUINT32_t now_centiseconds
+        cdef Py_ssize_t start = self.sweep_cursor
+        cdef Py_ssize_t end = min(start + limit, self.capacity)
+        cdef Py_ssize_t i = start
+
+        if now - self.epoch > REBASE_AFTER:
+            self.rebase(now)
+
+        now_centiseconds = self._centiseconds(now)
+
+        while i < end:
+            if self.ends[i] != 0 and self.ends[i] <= now_centiseconds:
+                self._delete(i)  # something else may have been moved into the slot, so it's checked again
+            else:
+                i += 1
+
+        self.sweep_cursor = i & self.mask
+
+        return i - start
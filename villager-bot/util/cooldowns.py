@@ -1,7 +1,80 @@
+from typing import Callable, Dict, List, Optional, Tuple
 from collections import defaultdict
+import numpy as np
 import asyncio
 import time
 
+try:  # compiled by pyximport, see __main__.py
+    from util.cooldown_table import CooldownTable
+except ImportError:
+    CooldownTable = None
+
+COMPACT_COOLDOWNS_SUPPORTED = CooldownTable is not None
+
+DEFAULT_LEASE_DURATION = 30  # seconds a cluster can check a user's cooldowns by itself after karen granted it a lease
+LEASE_REVOKE_TIMEOUT = 2  # seconds karen waits on a lease holder to give a lease back before ending it anyway
+
+# seconds a concurrency slot is held for at most, so a release which never arrives can't lock a user out forever
+DEFAULT_CONCURRENCY_LEASE_DURATION = 10 * 60
+
+T_DUMP = Tuple[List[str], np.ndarray, np.ndarray, np.ndarray]
+
+CLEAR_BATCH_SIZE = 10000  # ended cooldowns (or table slots) CooldownManager looks at before letting other tasks run
+
+
+class ExpiryWheel:
+    """A timing wheel with a slot per second, keys are added to the slot of the second they expire in so the expired
+    ones can be found without looking at the others"""
+
+    def __init__(self, clock: Callable[[], float]):
+        self.clock = clock  # time.time or time.monotonic, whichever the expiry times come from
+
+        self.slots = defaultdict(list)  # {second: [key, key,..]}
+        self.current = int(clock())  # the first slot which hasn't been popped yet
+
+    def add(self, expires_at: float, key: object) -> None:
+        second = int(expires_at)
+
+        if second < self.current:
+            second = self.current
+
+        self.slots[second].append(key)
+
+    def add_sorted(self, expires_at: np.ndarray, keys: list) -> None:  # expires_at has to be sorted
+        seconds = np.maximum(expires_at.astype(np.int64), self.current).tolist()
+        start = 0
+
+        for end in (np.flatnonzero(np.diff(seconds)) + 1).tolist() + [len(keys)]:
+            self.slots[seconds[start]].extend(keys[start:end])
+            start = end
+
+    def pop_expired(self, limit: Optional[int] = None) -> list:
+        """Removes and returns the keys of past seconds, at most limit of them"""
+
+        now = int(self.clock())
+        expired = []
+
+        while self.current < now:
+            slot = self.slots.get(self.current)
+
+            if slot:
+                if limit is not None and len(expired) + len(slot) > limit:
+                    split = len(slot) - (limit - len(expired))
+                    expired.extend(slot[split:])
+                    del slot[split:]
+
+                    return expired
+
+                expired.extend(slot)
+
+            self.slots.pop(self.current, None)
+            self.current += 1
+
+        return expired
+
+    def __len__(self) -> int:
+        return sum(map(len, self.slots.values()))
+
 
 class CommandOnKarenCooldown(Exception):
     def __init__(self, remaining: float):
@@ -13,41 +86,122 @@ class MaxKarenConcurrencyReached(Exception):
 
 
 class MaxConcurrencyManager:
-    def __init__(self):
-        self.limits = set()
+    """Concurrency slots are leased to the connection of the cluster running the command. A slot is freed when its
+    holder releases it, when the holder's connection is lost, or when the lease expires."""
 
-    def acquire(self, command: str, user_id: int) -> None:
-        self.limits.add((command, user_id))
+    def __init__(self, lease_duration: float = DEFAULT_CONCURRENCY_LEASE_DURATION):
+        self.lease_duration = lease_duration
 
-    def release(self, command: str, user_id: int) -> None:
-        try:
-            self.limits.remove((command, user_id))
-        except KeyError:
-            pass
+        # {(command_name, user_id): (holder, time.monotonic() the lease expires at)}, holder is None for slots
+        # acquired without a connection (through a ring buffer), those can be released by anyone
+        self.slots: Dict[Tuple[str, int], Tuple[object, float]] = {}
+
+        self._slot_ends = ExpiryWheel(time.monotonic)  # keys are (command_name, user_id), like CooldownManager's
+
+        # counters
+        self.expired = 0  # slots which were never released and reclaimed once their lease expired
+        self.disconnected = 0  # slots which were reclaimed because their holder's connection was lost
+
+        self._clear_task = None
+
+    def acquire(self, command: str, user_id: int, holder: object = None) -> None:
+        expires_at = time.monotonic() + self.lease_duration
+
+        self.slots[(command, user_id)] = (holder, expires_at)
+        self._slot_ends.add(expires_at, (command, user_id))
+
+    def release(self, command: str, user_id: int, holder: object = None) -> None:
+        slot = self.slots.get((command, user_id))
+
+        # a late release from a cluster which lost the slot mustn't free the slot of whoever holds it now
+        if slot is not None and (slot[0] is None or slot[0] is holder):
+            del self.slots[(command, user_id)]
 
     def check(self, command: str, user_id: int) -> bool:
-        if (command, user_id) in self.limits:
-            return False
+        slot = self.slots.get((command, user_id))
+
+        if slot is None:
+            return True
+
+        if slot[1] <= time.monotonic():
+            del self.slots[(command, user_id)]
+            self.expired += 1
+
+            return True
 
-        return True
+        return False
+
+    def end_slots(self, holder: object) -> None:  # the holder's connection was lost
+        for key, (slot_holder, _) in list(self.slots.items()):
+            if slot_holder is holder:
+                del self.slots[key]
+                self.disconnected += 1
+
+    def clear_expired(self) -> None:
+        for key in self._slot_ends.pop_expired():
+            self.check(*key)  # removes the slot if its lease expired, it may have been re-acquired since
+
+    def get_stats(self) -> dict:
+        return {"slots": len(self.slots), "expired": self.expired, "disconnected": self.disconnected}
+
+    async def _clear_dead(self):
+        try:
+            while True:
+                self.clear_expired()
+                await asyncio.sleep(20)
+        except asyncio.CancelledError:
+            return
+
+    def start(self):
+        self._clear_task = asyncio.create_task(self._clear_dead())
+
+    def stop(self):
+        self._clear_task.cancel()
 
 
 class CooldownManager:
-    def __init__(self, cooldown_rates: dict):
+    def __init__(self, cooldown_rates: dict, lease_duration: Optional[float] = DEFAULT_LEASE_DURATION):
         self.rates = cooldown_rates  # {command_name: seconds_per_command}
         self.cooldowns = defaultdict(dict)  # {command_name: {user_id: time.time()}}
 
+        # a user's cooldowns are leased to the cluster which checks them, so it doesn't have to ask karen again until
+        # the lease expires or another cluster checks the same user, None disables leases
+        self.lease_duration = lease_duration
+        self.leases: Dict[int, Tuple[object, float]] = {}  # {user_id: (holder, time.monotonic() it expires at)}
+
+        # when cooldowns and leases end, so removing them only has to look at the ones which ended. keys aren't removed
+        # when a cooldown is re-added or cleared early, so they're checked against the dicts above first
+        self._cooldown_ends = ExpiryWheel(time.time)  # keys are (command_name, user_id)
+        self._lease_ends = ExpiryWheel(time.monotonic)  # keys are user_ids
+
+        # (command_name, user_id) of cooldowns added or cleared since the last snapshot, None if nothing snapshots them
+        self.changes: Optional[set] = None
+
+        # counters
+        self.leases_granted = 0
+        self.leases_revoked = 0
+
         self._clear_task = None
 
-    def add_cooldown(self, command: str, user_id: int) -> None:
-        self.cooldowns[command][user_id] = time.time()
+    def add_cooldown(self, command: str, user_id: int, started: Optional[float] = None) -> None:
+        if started is None:
+            started = time.time()
+
+        self.cooldowns[command][user_id] = started
+        self._cooldown_ends.add(started + self.rates[command], (command, user_id))
+
+        if self.changes is not None:
+            self.changes.add((command, user_id))
 
     def clear_cooldown(self, command: str, user_id: int) -> None:
-        self.cooldowns[command].pop(user_id, None)
+        if self.cooldowns[command].pop(user_id, None) is not None and self.changes is not None:
+            self.changes.add((command, user_id))
+
+    def get_started(self, command: str, user_id: int) -> float:  # returns the time.time() the cooldown started at or 0
+        return self.cooldowns[command].get(user_id, 0)
 
     def get_remaining(self, command: str, user_id: int) -> float:  # returns remaning cooldown or 0
-        started = self.cooldowns[command].get(user_id, 0)
-        remaining = self.rates[command] - (time.time() - started)
+        remaining = self.rates[command] - (time.time() - self.get_started(command, user_id))
 
         if remaining < 0.01:
             self.clear_cooldown(command, user_id)
@@ -65,13 +219,134 @@ class CooldownManager:
 
         return {"can_run": True}
 
+    def get_user_cooldowns(self, user_id: int) -> Dict[str, float]:  # {command: remaining} of the user's cooldowns
+        user_cooldowns = {}
+
+        for command in self.rates:
+            remaining = self.get_remaining(command, user_id)
+
+            if remaining:
+                user_cooldowns[command] = remaining
+
+        return user_cooldowns
+
+    def merge_user_cooldowns(self, user_id: int, user_cooldowns: Dict[str, float]) -> None:
+        """Adds the cooldowns a lease holder added by itself, user_cooldowns is {command: remaining}"""
+
+        now = time.time()
+
+        for command, remaining in user_cooldowns.items():
+            started = now - (self.rates[command] - remaining)
+
+            if started > self.get_started(command, user_id):
+                self.add_cooldown(command, user_id, started)
+
+    def get_lease_holder(self, user_id: int) -> Optional[object]:
+        lease = self.leases.get(user_id)
+
+        if lease is None:
+            return None
+
+        holder, expires_at = lease
+
+        if expires_at <= time.monotonic():
+            del self.leases[user_id]
+            return None
+
+        return holder
+
+    def grant_lease(self, user_id: int, holder: object) -> dict:
+        """Leases the user's cooldowns to the holder, returns the lease fields of a COOLDOWN_RESPONSE"""
+
+        if self.lease_duration is None:
+            return {}
+
+        expires_at = time.monotonic() + self.lease_duration
+
+        self.leases[user_id] = (holder, expires_at)
+        self._lease_ends.add(expires_at, user_id)
+        self.leases_granted += 1
+
+        return {"lease": self.lease_duration, "cooldowns": self.get_user_cooldowns(user_id)}
+
+    def end_lease(self, user_id: int, user_cooldowns: Optional[Dict[str, float]] = None) -> None:
+        if self.leases.pop(user_id, None) is not None:
+            self.leases_revoked += 1
+
+        if user_cooldowns:
+            self.merge_user_cooldowns(user_id, user_cooldowns)
+
+    def dump(self) -> Callable[[], T_DUMP]:
+        """Copies every cooldown, returns a function which turns the copies into (command names, user ids, command name
+        indexes, time.time() started) arrays and can be called off the event loop"""
+
+        cooldowns = {command: users.copy() for command, users in self.cooldowns.items()}
+
+        def to_arrays() -> T_DUMP:
+            commands = list(cooldowns)
+            user_ids = [np.fromiter(users.keys(), np.uint64, len(users)) for users in cooldowns.values()]
+            started = [np.fromiter(users.values(), np.float64, len(users)) for users in cooldowns.values()]
+            command_indexes = np.repeat(np.arange(len(commands)), [len(users) for users in cooldowns.values()])
+
+            if not commands:
+                return commands, np.empty(0, np.uint64), command_indexes, np.empty(0, np.float64)
+
+            return commands, np.concatenate(user_ids), command_indexes, np.concatenate(started)
+
+        return to_arrays
+
+    def load(self, commands: List[str], user_ids: np.ndarray, command_indexes: np.ndarray, started: np.ndarray) -> None:
+        """Adds cooldowns from arrays like the ones dump() returns, without counting them as changes"""
+
+        for i in np.unique(command_indexes).tolist():
+            command = commands[i]
+            selected = command_indexes == i
+
+            order = np.argsort(started[selected])
+            command_user_ids = user_ids[selected][order].tolist()
+            command_started = started[selected][order]
+
+            self.cooldowns[command].update(zip(command_user_ids, command_started.tolist()))
+            self._cooldown_ends.add_sorted(command_started + self.rates[command], [(command, u) for u in command_user_ids])
+
+    def end_leases(self, holder: object) -> None:  # the holder's connection was lost
+        for user_id, (lease_holder, _) in list(self.leases.items()):
+            if lease_holder is holder:
+                del self.leases[user_id]
+
+    def get_stats(self) -> dict:
+        return {
+            "leases": len(self.leases),
+            "leases_granted": self.leases_granted,
+            "leases_revoked": self.leases_revoked,
+        }
+
+    def clear_ended(self, limit: Optional[int] = None) -> bool:
+        """Removes cooldowns and leases which ended, looking at most at limit cooldowns. Returns whether it's done, so
+        False if it stopped because of the limit."""
+
+        ended = self._cooldown_ends.pop_expired(limit)
+        now = time.time()
+
+        for command, user_id in ended:
+            started = self.cooldowns[command].get(user_id)
+
+            if started is not None and started + self.rates[command] <= now:  # wasn't re-added since
+                del self.cooldowns[command][user_id]
+
+        self._clear_ended_leases()
+
+        return limit is None or len(ended) < limit
+
+    def _clear_ended_leases(self) -> None:
+        for user_id in self._lease_ends.pop_expired():
+            self.get_lease_holder(user_id)  # removes the lease if it expired
+
     async def _clear_dead(self):
         try:
             while True:
-                for command, users in list(self.cooldowns.items()):
-                    for user_id, started in list(users.items()):
-                        if self.rates[command] - (time.time() - self.cooldowns[command].get(user_id, 0)) <= 0:
-                            del self.cooldowns[command][user_id]
+                while not self.clear_ended(CLEAR_BATCH_SIZE):
+                    await asyncio.sleep(0)
 
                 await asyncio.sleep(20)
         except asyncio.CancelledError:
@@ -82,3 +357,202 @@ class CooldownManager:
 
     def stop(self):
         self._clear_task.cancel()
+
+
+class CompactCooldownManager(CooldownManager):
+    """A CooldownManager which keeps cooldowns in a CooldownTable (~36 bytes a cooldown) instead of dicts of floats, for
+    when there are millions of them. Cooldowns are removed by sweeping the table, so there's no timing wheel."""
+
+    def __init__(self, cooldown_rates: dict, lease_duration: Optional[float] = DEFAULT_LEASE_DURATION):
+        if not COMPACT_COOLDOWNS_SUPPORTED:
+            raise RuntimeError("CompactCooldownManager needs the util.cooldown_table cython module")
+
+        super().__init__(cooldown_rates, lease_duration)
+
+        self.command_indexes = {command: i for i, command in enumerate(cooldown_rates)}  # {command_name: 0-255}
+        self.cooldowns = CooldownTable()
+
+    def add_cooldown(self, command: str, user_id: int, started: Optional[float] = None) -> None:
+        if started is None:
+            started = time.time()
+
+        self.cooldowns.set(user_id, self.command_indexes[command], started + self.rates[command])
+
+        if self.changes is not None:
+            self.changes.add((command, user_id))
+
+    def clear_cooldown(self, command: str, user_id: int) -> None:
+        if self.cooldowns.remove(user_id, self.command_indexes[command]) and self.changes is not None:
+            self.changes.add((command, user_id))
+
+    def get_started(self, command: str, user_id: int) -> float:
+        ends_at = self.cooldowns.get(user_id, self.command_indexes[command])
+
+        if ends_at == 0:
+            return 0
+
+        return ends_at - self.rates[command]
+
+    def clear_ended(self, limit: Optional[int] = None) -> bool:
+        """Sweeps limit slots of the table, returns whether the sweep reached the end of it"""
+
+        self.cooldowns.sweep(self.cooldowns.capacity if limit is None else limit, time.time())
+        self._clear_ended_leases()
+
+        return self.cooldowns.sweep_cursor == 0
+
+    def dump(self) -> Callable[[], T_DUMP]:
+        user_ids, command_indexes, ends = self.cooldowns.dump()  # already copies
+        rates = np.array(list(self.rates.values()), np.float64)  # in the same order as command_indexes
+
+        return lambda: (list(self.rates), user_ids, command_indexes, ends - rates[command_indexes])
+
+    def load(self, commands: List[str], user_ids: np.ndarray, command_indexes: np.ndarray, started: np.ndarray) -> None:
+        table_indexes = np.array([self.command_indexes.get(command, 0) for command in commands] or [0], np.uint8)
+        rates = np.array([self.rates.get(command, 0) for command in commands] or [0], np.float64)
+
+        for user_id, command_index, ends_at in zip(
+            user_ids.tolist(), table_indexes[command_indexes].tolist(), (started + rates[command_indexes]).tolist()
+        ):
+            self.cooldowns.set(user_id, command_index, ends_at)
+
+
+class CooldownLeases:
+    """The cluster side of CooldownManager's leases. While a cluster holds a user's lease it checks and adds their
+    cooldowns by itself (cooldowns it adds are still sent to karen with a one-way COOLDOWN_ADD), otherwise it asks
+    karen. Cooldowns a cluster knows about are always enforced, since karen can only have more of them."""
+
+    def __init__(self, cooldown_rates: dict):
+        self.rates = cooldown_rates  # {command_name: seconds_per_command}
+
+        self.leases: Dict[int, float] = {}  # {user_id: time.monotonic() the lease expires at}
+        self.cooldowns: Dict[int, Dict[str, float]] = {}  # {user_id: {command_name: time.monotonic() it ends at}}
+
+        # when leases and users' cooldowns end, like CooldownManager's wheels keys are checked against the dicts above
+        self._lease_ends = ExpiryWheel(time.monotonic)  # keys are user_ids
+        self._cooldown_ends = ExpiryWheel(time.monotonic)  # keys are user_ids, added for every cooldown
+
+        # counters
+        self.local_checks = 0
+        self.remote_checks = 0
+        self.revoked = 0
+
+        self._clear_task = None
+
+    def get_remaining(self, command: str, user_id: int) -> float:
+        remaining = self.cooldowns.get(user_id, {}).get(command, 0) - time.monotonic()
+
+        if remaining < 0.01:
+            return 0
+
+        return remaining
+
+    def add_cooldown(self, command: str, user_id: int) -> None:
+        ends_at = time.monotonic() + self.rates[command]
+
+        self.cooldowns.setdefault(user_id, {})[command] = ends_at
+        self._cooldown_ends.add(ends_at, user_id)
+
+    def check(self, command: str, user_id: int) -> Optional[dict]:
+        """Checks the cooldown without karen if possible and adds it if the command is runnable, returns None if karen
+        has to be asked instead"""
+
+        remaining = self.get_remaining(command, user_id)
+
+        if remaining:
+            self.local_checks += 1
+            return {"can_run": False, "remaining": remaining}
+
+        if self.leases.get(user_id, 0) > time.monotonic():
+            self.local_checks += 1
+            self.add_cooldown(command, user_id)
+            return {"can_run": True}
+
+        self.remote_checks += 1
+
+        return None
+
+    def update(self, user_id: int, response: object, requested_at: float) -> None:
+        """Updates the user's cooldowns and lease from karen's COOLDOWN_RESPONSE. requested_at is the time.monotonic()
+        the request was sent at, the lease is counted from then so it always expires before karen's does"""
+
+        if not response.lease:
+            return
+
+        now = time.monotonic()
+
+        self.leases[user_id] = requested_at + response.lease
+        self._lease_ends.add(self.leases[user_id], user_id)
+
+        user_cooldowns = {command: now + remaining for command, remaining in (response.cooldowns or {}).items()}
+
+        if user_cooldowns:
+            self.cooldowns[user_id] = user_cooldowns
+            self._cooldown_ends.add(max(user_cooldowns.values()), user_id)
+        else:
+            self.cooldowns.pop(user_id, None)
+
+    def revoke(self, user_id: int) -> Dict[str, float]:
+        """Ends the user's lease, returns their cooldowns as {command: remaining} so karen can merge them"""
+
+        if self.leases.pop(user_id, None) is not None:
+            self.revoked += 1
+
+        user_cooldowns = {}
+
+        for command in list(self.cooldowns.get(user_id, ())):
+            remaining = self.get_remaining(command, user_id)
+
+            if remaining:
+                user_cooldowns[command] = remaining
+
+        return user_cooldowns
+
+    def clear_leases(self) -> None:  # karen forgets about leases when the connection to it is lost
+        self.leases.clear()
+
+    def clear_ended(self, limit: Optional[int] = None) -> bool:
+        """Removes leases and users' cooldowns which ended, looking at most at limit users with ended cooldowns. Returns
+        whether it's done, so False if it stopped because of the limit."""
+
+        now = time.monotonic()
+
+        for user_id in self._lease_ends.pop_expired():
+            expires_at = self.leases.get(user_id)
+
+            if expires_at is not None and expires_at <= now:  # wasn't renewed since
+                del self.leases[user_id]
+
+        ended = self._cooldown_ends.pop_expired(limit)
+
+        for user_id in ended:
+            user_cooldowns = self.cooldowns.get(user_id)
+
+            if user_cooldowns is not None and max(user_cooldowns.values(), default=0) <= now:
+                del self.cooldowns[user_id]
+
+        return limit is None or len(ended) < limit
+
+    async def _clear_dead(self):
+        try:
+            while True:
+                while not self.clear_ended(CLEAR_BATCH_SIZE):
+                    await asyncio.sleep(0)
+
+                await asyncio.sleep(20)
+        except asyncio.CancelledError:
+            return
+
+    def start(self):
+        self._clear_task = asyncio.create_task(self._clear_dead())
+
+    def stop(self):
+        self._clear_task.cancel()
+
+    def get_stats(self) -> dict:
+        return {
+            "leases": len(self.leases),
+            "local_checks": self.local_checks,
+            "remote_checks": self.remote_checks,
+            "revoked": self.revoked,
+        }
@@ -0,0 +1,157 @@
+from typing import Awaitable, Callable, List, Optional
+import logging
+import asyncio
+import time
+
+# How packet handlers are run, set per handler with @handle_packet(packet_type, dispatch=...)
+DISPATCH_INLINE = "inline"  # plain (non async) function called by the connection's reader, must be cheap and never block
+DISPATCH_POOL = "pool"  # the default, run by one of the HandlerPool's workers
+DISPATCH_TASK = "task"  # run in its own task, for handlers which wait on other packets or on users (locks, dms, broadcasts)
+
+DISPATCH_MODES = (DISPATCH_INLINE, DISPATCH_POOL, DISPATCH_TASK)
+
+DEFAULT_HANDLER_WORKERS = 64  # handlers a HandlerPool runs at the same time
+DEFAULT_MAX_PENDING_HANDLERS = 256  # queued + running handlers per connection before its reader stops reading
+
+T_HANDLER_CALL = Callable[..., Awaitable[None]]
+
+
+class Lane:
+    """The handlers submitted by one connection. Once max_pending of them are queued or running, submit() waits for
+    one to finish, so the connection stops being read from and the peer's writes back up instead of the queue growing"""
+
+    __slots__ = ("pool", "name", "max_pending", "pending", "_slots")
+
+    def __init__(self, pool: "HandlerPool", name: str, max_pending: int):
+        self.pool = pool
+        self.name = name
+        self.max_pending = max_pending
+
+        self.pending = 0
+        self._slots = asyncio.Semaphore(max_pending)
+
+    async def submit(self, call: T_HANDLER_CALL, *args) -> None:
+        if self._slots.locked():
+            pool = self.pool
+            pool.backpressure_waits += 1
+
+            started_at = time.monotonic()
+            await self._slots.acquire()
+            pool.backpressure_time += time.monotonic() - started_at
+        else:
+            await self._slots.acquire()
+
+        self.pending += 1
+        self.pool._submit(self, call, args)
+
+    def _done(self) -> None:
+        self.pending -= 1
+        self._slots.release()
+
+
+class HandlerPool:
+    """A fixed number of worker tasks which run packet handlers, shared by every connection (Lane) of a Client or Server"""
+
+    def __init__(
+        self,
+        workers: int = DEFAULT_HANDLER_WORKERS,
+        max_pending: int = DEFAULT_MAX_PENDING_HANDLERS,
+        logger: Optional[logging.Logger] = None,
+    ):
+        self.workers = workers
+        self.max_pending = max_pending  # per lane
+        self.logger = logging.getLogger(__name__) if logger is None else logger
+
+        self.lanes: List[Lane] = []
+
+        self._queue = None  # asyncio.Queue, created in start() so it belongs to the running event loop
+        self._tasks = []
+
+        self.running = 0
+        self.detached = 0  # DISPATCH_TASK handlers which are currently running
+
+        # counters
+        self.handled = 0
+        self.errors = 0
+        self.queued_max = 0
+        self.backpressure_waits = 0  # times a lane was full, so its connection wasn't read from until a handler finished
+        self.backpressure_time = 0  # total seconds spent waiting on full lanes
+
+    def start(self) -> None:
+        self._queue = asyncio.Queue()
+        self._tasks = [asyncio.create_task(self._worker()) for _ in range(self.workers)]
+
+    def stop(self) -> None:
+        for task in self._tasks:
+            task.cancel()
+
+        self._tasks.clear()
+
+    def lane(self, name: str) -> Lane:
+        lane = Lane(self, name, self.max_pending)
+        self.lanes.append(lane)
+
+        return lane
+
+    def close_lane(self, lane: Lane) -> None:
+        self.lanes.remove(lane)  # handlers already queued by the lane still run
+
+    @property
+    def queued(self) -> int:
+        return 0 if self._queue is None else self._queue.qsize()
+
+    def _submit(self, lane: Lane, call: T_HANDLER_CALL, args: tuple) -> None:
+        self._queue.put_nowait((lane, call, args))
+
+        queued = self._queue.qsize()
+        if queued > self.queued_max:
+            self.queued_max = queued
+
+    def report_error(self, handler: str, e: Exception) -> None:
+        self.errors += 1
+        self.logger.error(f"Unhandled error in packet handler {handler}", exc_info=e)
+
+    async def _run(self, call: T_HANDLER_CALL, args: tuple) -> None:
+        try:
+            await call(*args)
+        except asyncio.CancelledError:  # an Exception before python 3.8
+            raise
+        except Exception as e:
+            self.report_error(getattr(call, "__qualname__", repr(call)), e)
+
+        self.handled += 1
+
+    async def _worker(self) -> None:
+        while True:
+            lane, call, args = await self._queue.get()
+            self.running += 1
+
+            try:
+                await self._run(call, args)
+            finally:
+                self.running -= 1
+                lane._done()
+
+    def spawn(self, call: T_HANDLER_CALL, *args) -> None:
+        """Runs a handler in its own task, outside of the workers and lanes (DISPATCH_TASK)"""
+
+        self.detached += 1
+        asyncio.create_task(self._run(call, args)).add_done_callback(self._detached_done)
+
+    def _detached_done(self, task: asyncio.Task) -> None:
+        self.detached -= 1
+
+    def get_stats(self) -> dict:
+        return {
+            "workers": self.workers,
+            "running": self.running,
+            "detached": self.detached,
+            "queued": self.queued,
+            "queued_max": self.queued_max,
+            "lanes": len(self.lanes),
+            "lane_pending_max": max((lane.pending for lane in self.lanes), default=0),
+            "handled": self.handled,
+            "errors": self.errors,
+            "backpressure_waits": self.backpressure_waits,
+            "backpressure_time": self.backpressure_time,
+        }
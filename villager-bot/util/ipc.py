@@ -1,12 +1,67 @@
-from typing import Awaitable, Dict, Optional, Union, Callable
+from typing import AsyncIterator, Awaitable, Dict, List, Optional, Tuple, Union, Callable
 from asyncio import StreamReader, StreamWriter
+from collections import defaultdict, deque
+from contextvars import ContextVar
 from enum import IntEnum, auto
 import classyjson as cj
+import ipaddress
+import logging
 import asyncio
+import random
+import socket
 import struct
+import time
+import zlib
+import os
+
+from util.dispatch import (
+    HandlerPool,
+    Lane,
+    DISPATCH_INLINE,
+    DISPATCH_POOL,
+    DISPATCH_TASK,
+    DISPATCH_MODES,
+    DEFAULT_HANDLER_WORKERS,
+    DEFAULT_MAX_PENDING_HANDLERS,
+)
+from util.metrics import IpcMetrics
+from util.ring import RingBuffer
+from util import binpack
 
 LENGTH_LENGTH = struct.calcsize(">i")
 
+FLAG_BATCH = 1 << 31  # set in the length header of frames which contain multiple packets
+FLAG_CHUNK = 1 << 30  # set in the length header of frames which contain a piece of a bulk packet
+FLAG_COMPRESSED = 1 << 29  # set in the length header of packets whose data is zlib compressed
+LENGTH_MASK = FLAG_COMPRESSED - 1
+
+MAX_BATCH_SIZE = 65536  # pending packets are flushed early once a batch gets this big (in bytes)
+DEFAULT_CHUNK_SIZE = 32768  # bulk packets are split into chunks of this size (in bytes)
+# compressing costs more time than it saves on fast links (on loopback it made a data.json round trip ~6x slower),
+# so it's off unless a threshold is configured, and even then only used for peers which aren't on the same machine.
+# Deployments with clusters on other machines than karen can set manager.compression_threshold in secrets.json (to
+# REMOTE_COMPRESSION_THRESHOLD for example) if the network between them is slower than compressing.
+DEFAULT_COMPRESSION_THRESHOLD = None
+REMOTE_COMPRESSION_THRESHOLD = 4096  # suggested threshold for clusters connecting over a network (in bytes)
+COMPRESSION_LEVEL = 1  # zlib level, higher levels barely compress json / binpack data better but are a lot slower
+MAX_FRAME_SIZE = 16 * 1024 * 1024  # frames bigger than this are treated as a broken stream (in bytes)
+
+DEFAULT_REQUEST_TIMEOUT = 10  # seconds Client.request() waits for a response by default
+
+# optional protocol features, negotiated during auth
+FEATURES = ("batch", "typed", "chunk", "compress")
+
+RING_POLL_INTERVAL = 0.005  # seconds the server waits between checking empty ring buffers
+
+RECONNECT_DELAY = 0.5  # seconds a client waits before its first reconnect attempt, doubled after every failed attempt
+MAX_RECONNECT_DELAY = 30
+REPLAY_QUEUE_SIZE = 10000  # one-way packets a client keeps while it's disconnected, the oldest ones are dropped first
+
+# unix domain sockets aren't available everywhere (namely windows), in which case only tcp is used
+UNIX_SOCKETS_SUPPORTED = hasattr(asyncio, "start_unix_server")
+
+_frame_header = struct.Struct(">I")
+
 # Basically this protocol revolves around sending json data. A packet consists of the length
 # of the upcoming data to read as a big endian int32 (i) as well as the data itself, dumped to
 # a string and then encoded into UTF8.
@@ -20,6 +75,37 @@ LENGTH_LENGTH = struct.calcsize(">i")
 # The JSON payload is expected to have a "type" field as well as an "id", which helps
 # the receiver to know what to do with the packet. The first packet from the client
 # must be an authorization packet containing the pre-shared secret.
+#
+# The authorization packet and its response are always sent as json. The client can list the
+# codecs it supports in the authorization packet's "codecs" field (in order of preference), and
+# if the server supports one of them it responds with a "codec" field, after which both sides
+# switch to that codec for the rest of the connection. Peers which don't know about codecs just
+# ignore the field, so the connection falls back to json.
+#
+# Optional features are negotiated the same way, via the "features" field of both packets. If
+# the peer supports the "batch" feature and batching is enabled, packets written within the batch
+# window are coalesced into one frame. A batched frame has FLAG_BATCH set in its length header,
+# and its data is the packets (each with their own length header) one after the other.
+#
+# Packets have one of two priority classes. Interactive packets (most of them) are written right
+# away, while bulk packets (BULK_PACKET_TYPES and anything bigger than the chunk size) are queued
+# and written one after the other by a background task. If the peer supports the "chunk" feature,
+# bulk packets are split into frames of at most the chunk size which have FLAG_CHUNK set in their
+# length header, and the transport is drained between chunks, so interactive packets written in
+# the meantime go out between the chunks instead of waiting behind the whole packet. The data of
+# the first chunk starts with the length of the whole packet, the receiver reassembles the chunks
+# and handles the packet once it has all of them.
+#
+# If a compression threshold is set, the peer is remote (not connected over a unix socket or
+# loopback) and it supports the "compress" feature, packets whose encoded data is at least the
+# compression threshold are zlib compressed (unless that doesn't make them smaller), which is
+# marked by FLAG_COMPRESSED in the packet's length header. That is the frame header for packets
+# sent on their own, the packet's own header inside of batched frames, and the length at the start
+# of the first chunk for chunked packets. Smaller packets are sent exactly like before.
+#
+# Received packets are dispatched to their handlers according to the handler's dispatch mode (see
+# util.dispatch). Cheap handlers are called inline by the reader, everything else is queued on the
+# connection's lane of a bounded HandlerPool, and the reader stops reading once the lane is full.
 
 
 class PacketType(IntEnum):
@@ -58,9 +144,450 @@ class PacketType(IntEnum):
     STATS_RESPONSE = auto()
     TRIVIA = auto()
     UPDATE_SUPPORT_SERVER_ROLES = auto()
+    BROADCAST_PARTIAL = auto()
+    FETCH_IPC_METRICS = auto()
+    SUBSCRIBE = auto()
+    UNSUBSCRIBE = auto()
+    PUBLISH = auto()
+    COOLDOWN_LEASE_REVOKE = auto()
+    ADMIT = auto()
+    ADMIT_RESPONSE = auto()
+    ACTIVE_EFFECT = auto()
+    REMINDER_ADD = auto()
+    DATA_RELOAD = auto()
+
+
+class PacketStreamError(Exception):
+    pass
+
+
+class ConnectionLostError(ConnectionError):
+    """Raised for requests which were in flight when the connection was lost, and for packets sent while the client
+    is reconnecting (except REPLAY_PACKET_TYPES, which are queued)"""
+
+
+class RequestTimeoutError(asyncio.TimeoutError):
+    def __init__(self, packet_type: object, timeout: float):
+        super().__init__(f"No response to {packet_type!r} request within {timeout} seconds")
+
+        self.packet_type = packet_type
+        self.timeout = timeout
+
+    def __reduce__(self):  # so it can be pickled, for example by a ProcessPoolExecutor
+        return (type(self), (self.packet_type, self.timeout))
+
+
+# per packet type overrides for DEFAULT_REQUEST_TIMEOUT, None means the request never times out
+DEFAULT_REQUEST_TIMEOUTS = {
+    PacketType.BROADCAST_REQUEST: 30,  # karen has to wait on every cluster
+    PacketType.DM_MESSAGE_REQUEST: None,  # waits on a user, callers apply their own timeout
+    PacketType.ACQUIRE_PILLAGE_LOCK: None,  # waits until the lock is free
+}
+
+# how many responses a broadcast waits for before karen responds to the BROADCAST_REQUEST
+MODE_ALL = "all"  # every connection
+MODE_QUORUM = "quorum"  # the number of connections given in the request's "quorum" field
+MODE_FIRST = "first"  # the first successful response with a non-null result, or every connection if there is none
+
+BROADCAST_MODES = (MODE_ALL, MODE_QUORUM, MODE_FIRST)
+
+BROADCAST_TIMEOUT_MARGIN = 5  # extra seconds a client waits on top of the broadcast's timeout for karen's response
+
+
+def guild_shard_id(guild_id: int, shard_count: int) -> int:  # the shard discord puts the guild on
+    return (guild_id >> 22) % shard_count
+
+
+# pub/sub topics, messages published to a topic are sent to every client subscribed to it without any responses
+TOPIC_BAN_LIST = "ban-list"  # {"user_id": int, "banned": bool}
+TOPIC_DATA_RELOAD = "data-reload"  # None, data.json and the translations should be reloaded from disk (DATA_RELOAD
+# broadcasts do the same, but report whether each cluster succeeded)
+
+# one-way packets which a Client sends through its ring buffer (if it has one) instead of the socket. Ring packets have
+# no connection and aren't ordered with the socket's, so CONCURRENCY_ACQUIRE and CONCURRENCY_RELEASE aren't ones, karen
+# keeps track of which connection holds a slot so it's freed when the connection is lost
+RING_PACKET_TYPES = frozenset(
+    {
+        PacketType.SHARD_READY,
+        PacketType.COOLDOWN_ADD,
+        PacketType.COMMAND_RAN,
+    }
+)
+
+
+PRIORITY_INTERACTIVE = 0
+PRIORITY_BULK = 1
+
+# packets which are always sent with PRIORITY_BULK, other packets only are when they're bigger than the chunk size
+BULK_PACKET_TYPES = frozenset({PacketType.EXEC, PacketType.EXEC_RESPONSE})
+
+
+# one-way packets which are safe to send late, a Client which is reconnecting queues these and sends them once it's
+# connected again, instead of raising ConnectionLostError. CONCURRENCY_RELEASE isn't one, karen frees a connection's
+# slots when it's lost and a late release could free a slot the user acquired again after the reconnect
+REPLAY_PACKET_TYPES = frozenset(
+    {
+        PacketType.SHARD_READY,
+        PacketType.SHARD_DISCONNECT,
+        PacketType.COOLDOWN_ADD,
+        PacketType.COOLDOWN_RESET,
+        PacketType.COMMAND_RAN,
+        PacketType.MINE_COMMANDS_RESET,
+        PacketType.RELEASE_PILLAGE_LOCK,
+        PacketType.PUBLISH,
+        PacketType.ACTIVE_EFFECT,
+        PacketType.REMINDER_ADD,
+    }
+)
+
+
+class MalformedPacketError(ValueError):
+    pass
+
+
+class Packet:
+    """Base class for typed packets, subclasses declare their fields via __slots__ and annotations
+    and are registered for a PacketType with the @packet() decorator"""
+
+    __slots__ = ("id",)
+
+    type: PacketType = None
+
+    _fields = ()  # names of the packet's fields, excluding type and id
+    _types = ()  # expected type(s) for each field, or None to accept anything
+    _defaults = {}  # {field_name: default_value} for fields which are optional
+
+    def __init__(self, *, id: Optional[str] = None, **kwargs):
+        self.id = id
+
+        for name in self._fields:
+            try:
+                value = kwargs.pop(name)
+            except KeyError:
+                if name not in self._defaults:
+                    raise TypeError(f"{type(self).__name__} is missing required field {name!r}")
+
+                value = self._defaults[name]
+
+            setattr(self, name, value)
+
+        if kwargs:
+            raise TypeError(f"{type(self).__name__} got unexpected fields {', '.join(map(repr, kwargs))}")
+
+    @classmethod
+    def _validate(cls, name: str, value: object, expected: Optional[tuple]) -> None:
+        if expected is not None and not isinstance(value, expected):
+            raise MalformedPacketError(f"Field {name!r} of {cls.__name__} has invalid type {type(value).__name__}")
+
+    @classmethod
+    def from_values(cls, values: list) -> "Packet":
+        """Creates a packet from the [type, id, *fields] array typed packets are sent as"""
+
+        if len(values) != len(cls._fields) + 2:
+            raise MalformedPacketError(f"{cls.__name__} expects {len(cls._fields)} fields, got {len(values) - 2}")
+
+        self = cls.__new__(cls)
+        self.id = values[1]
+
+        for name, expected, value in zip(cls._fields, cls._types, values[2:]):
+            cls._validate(name, value, expected)
+            setattr(self, name, value)
+
+        return self
+
+    @classmethod
+    def from_dict(cls, data: dict) -> "Packet":
+        self = cls.__new__(cls)
+        self.id = data.get("id")
+
+        for name, expected in zip(cls._fields, cls._types):
+            try:
+                value = data[name]
+            except KeyError:
+                if name not in cls._defaults:
+                    raise MalformedPacketError(f"{cls.__name__} is missing required field {name!r}")
+
+                value = cls._defaults[name]
+
+            cls._validate(name, value, expected)
+            setattr(self, name, value)
+
+        return self
+
+    def to_values(self) -> tuple:
+        return (self.type, self.id, *[getattr(self, name) for name in self._fields])
+
+    def to_dict(self) -> dict:
+        data = {"type": self.type, **{name: getattr(self, name) for name in self._fields}}
+
+        if self.id is not None:
+            data["id"] = self.id
+
+        return data
+
+    def get(self, name: str, default: object = None) -> object:  # for compatibility with handlers written for ClassyDicts
+        return getattr(self, name, default)
+
+    def __eq__(self, other: object) -> bool:
+        if not isinstance(other, Packet):
+            return NotImplemented
+
+        return self.to_values() == other.to_values()
+
+    def __repr__(self) -> str:
+        fields = "".join(f", {name}={getattr(self, name, None)!r}" for name in self._fields)
+        return f"{type(self).__name__}(id={self.id!r}{fields})"
+
+    __str__ = __repr__
+
+
+# {packet_type: packet_class}
+PACKET_CLASSES: Dict[PacketType, type] = {}
+
+_FIELD_TYPES = {float: (int, float), object: None}  # ints are valid floats, object accepts anything
+
+
+def packet(packet_type: PacketType) -> Callable[[type], type]:
+    """Decorator for registering a Packet subclass as the typed packet for a packet type"""
+
+    def _packet(cls: type) -> type:
+        if packet_type in PACKET_CLASSES:
+            raise ValueError(f"Can't register {cls.__qualname__} for packet type {packet_type} because there already is one.")
+
+        annotations = {}
+        for base in reversed(cls.__mro__):
+            annotations.update(base.__dict__.get("__annotations__", {}))
+
+        cls.type = packet_type
+        cls._fields = tuple(
+            name for base in reversed(cls.__mro__) if base is not Packet for name in base.__dict__.get("__slots__", ())
+        )
+        cls._types = tuple(_FIELD_TYPES.get(annotations[name], annotations[name]) for name in cls._fields)
+
+        PACKET_CLASSES[packet_type] = cls
+        return cls
+
+    return _packet
+
+
+class CommandUserPacket(Packet):
+    __slots__ = ("command", "user_id")
+
+    command: str
+    user_id: int
+
+
+@packet(PacketType.DISCONNECT)
+class DisconnectPacket(Packet):
+    __slots__ = ()
+
+
+@packet(PacketType.SHARD_READY)
+class ShardReadyPacket(Packet):
+    __slots__ = ("shard_id",)
+
+    shard_id: int
+
+
+@packet(PacketType.SHARD_DISCONNECT)
+class ShardDisconnectPacket(Packet):
+    __slots__ = ("shard_id",)
+
+    shard_id: int
+
+
+@packet(PacketType.EVAL)
+class EvalPacket(Packet):
+    __slots__ = ("code",)
+
+    code: str
+
+
+@packet(PacketType.EVAL_RESPONSE)
+class EvalResponsePacket(Packet):
+    __slots__ = ("result", "success")
+
+    result: object
+    success: bool
+
+
+@packet(PacketType.COOLDOWN)
+class CooldownPacket(CommandUserPacket):
+    __slots__ = ()
+
+
+@packet(PacketType.COOLDOWN_RESPONSE)
+class CooldownResponsePacket(Packet):
+    __slots__ = ("can_run", "remaining", "lease", "cooldowns")
+
+    can_run: bool
+    remaining: float
+    lease: float  # seconds the cluster can check the user's cooldowns by itself for, 0 if it can't
+    cooldowns: object  # {command: remaining} of the user's cooldowns when a lease is granted
+
+    _defaults = {"remaining": 0, "lease": 0, "cooldowns": None}
+
+
+@packet(PacketType.COOLDOWN_ADD)
+class CooldownAddPacket(CommandUserPacket):
+    __slots__ = ()
+
 
+@packet(PacketType.COOLDOWN_RESET)
+class CooldownResetPacket(CommandUserPacket):
+    __slots__ = ()
 
-T_PACKET_HANDLER_CALLABLE = Callable[[cj.ClassyDict], Awaitable[Optional[dict]]]
+
+@packet(PacketType.COOLDOWN_LEASE_REVOKE)
+class CooldownLeaseRevokePacket(Packet):
+    __slots__ = ("user_id",)
+
+    user_id: int
+
+
+@packet(PacketType.MINE_COMMAND)
+class MineCommandPacket(Packet):
+    __slots__ = ("user_id", "addition")
+
+    user_id: int
+    addition: int
+
+
+@packet(PacketType.MINE_COMMAND_RESPONSE)
+class MineCommandResponsePacket(Packet):
+    __slots__ = ("current",)
+
+    current: int
+
+
+@packet(PacketType.ACTIVE_EFFECT)
+class ActiveEffectPacket(Packet):
+    """A user used a potion (or seaweed), karen keeps track of when its effect ends so it survives restarts"""
+
+    __slots__ = ("user_id", "effect", "duration")
+
+    user_id: int
+    effect: str
+    duration: float  # seconds
+
+
+@packet(PacketType.REMINDER_ADD)
+class ReminderAddPacket(Packet):
+    """A reminder was added to the database, so karen can schedule it if it's due before karen's next load"""
+
+    __slots__ = ("user_id", "channel_id", "guild_id", "message_id", "reminder", "at")
+
+    user_id: int
+    channel_id: int
+    guild_id: object  # None for reminders in dms
+    message_id: int
+    reminder: str
+    at: float  # time.time() the user should be reminded at
+
+
+@packet(PacketType.CONCURRENCY_CHECK)
+class ConcurrencyCheckPacket(CommandUserPacket):
+    __slots__ = ()
+
+
+@packet(PacketType.CONCURRENCY_CHECK_RESPONSE)
+class ConcurrencyCheckResponsePacket(Packet):
+    __slots__ = ("can_run",)
+
+    can_run: bool
+
+
+@packet(PacketType.CONCURRENCY_ACQUIRE)
+class ConcurrencyAcquirePacket(CommandUserPacket):
+    __slots__ = ()
+
+
+@packet(PacketType.CONCURRENCY_RELEASE)
+class ConcurrencyReleasePacket(CommandUserPacket):
+    __slots__ = ()
+
+
+@packet(PacketType.COMMAND_RAN)
+class CommandRanPacket(Packet):
+    __slots__ = ("user_id",)
+
+    user_id: int
+
+
+@packet(PacketType.ADMIT)
+class AdmitPacket(CommandUserPacket):
+    """Checks everything karen has to check before a command runs at once, and if it can run adds its cooldown and
+    counts it like COMMAND_RAN. The concurrency slot is only acquired (with CONCURRENCY_ACQUIRE) once the command is
+    invoked, since checks also run for commands which aren't (help checking which commands can be ran for example)"""
+
+    __slots__ = ("cooldown", "concurrency", "econ")
+
+    cooldown: bool  # whether karen has to check the cooldown, false if there's none or the cluster checked it itself
+    concurrency: bool  # whether the command is concurrency limited, only checks whether a slot is free
+    econ: bool  # whether the command can't be ran by users with paused econ
+
+    _defaults = {"cooldown": False, "concurrency": False, "econ": False}
+
+
+@packet(PacketType.ADMIT_RESPONSE)
+class AdmitResponsePacket(CooldownResponsePacket):
+    __slots__ = ("concurrency_limited", "econ_paused")
+
+    concurrency_limited: bool
+    econ_paused: bool
+
+    _defaults = {**CooldownResponsePacket._defaults, "concurrency_limited": False, "econ_paused": False}
+
+
+@packet(PacketType.SUBSCRIBE)
+class SubscribePacket(Packet):
+    __slots__ = ("topics",)
+
+    topics: list
+
+
+@packet(PacketType.UNSUBSCRIBE)
+class UnsubscribePacket(Packet):
+    __slots__ = ("topics",)
+
+    topics: list
+
+
+@packet(PacketType.PUBLISH)
+class PublishPacket(Packet):
+    __slots__ = ("topic", "message")
+
+    topic: str
+    message: object
+
+
+T_PACKET = Union[Packet, cj.ClassyDict]
+
+
+def to_packet(data: object) -> T_PACKET:
+    """Turns decoded data into a typed packet if its packet type has one, raises MalformedPacketError if it doesn't fit"""
+
+    if type(data) is list:  # typed packets are sent as [type, id, *fields]
+        try:
+            cls = PACKET_CLASSES[data[0]]
+        except (IndexError, KeyError, TypeError):
+            raise MalformedPacketError(f"Invalid typed packet {data!r}")
+
+        return cls.from_values(data)
+
+    if not isinstance(data, dict):
+        raise MalformedPacketError(f"Invalid packet {data!r}")
+
+    cls = PACKET_CLASSES.get(data.get("type"))
+
+    if cls is None:
+        return data
+
+    return cls.from_dict(data)
+
+
+T_PACKET_HANDLER_CALLABLE = Callable[[T_PACKET], Awaitable[Optional[Union[dict, Packet]]]]
+T_SUBSCRIBER = Callable[[object], Optional[Awaitable[None]]]
 T_HANDLER_CALLABLE_REGISTRY = Dict[PacketType, T_PACKET_HANDLER_CALLABLE]
 
 
@@ -79,55 +606,536 @@ def special_obj_hook(dct):
     return dct
 
 
+def json_dumps(data: Union[dict, cj.ClassyDict]) -> bytes:
+    return cj.dumps(data, cls=CustomJSONEncoder).encode()
+
+
+def json_loads(data: binpack.T_BYTES_LIKE) -> cj.ClassyDict:
+    if isinstance(data, memoryview):  # the json module only accepts str, bytes and bytearray
+        data = bytes(data)
+
+    return cj.loads(data, object_hook=special_obj_hook)
+
+
+# {codec_name: (dumps, loads)}, in order of preference
+CODECS = {
+    "binpack": (binpack.pack, binpack.unpack),
+    "json": (json_dumps, json_loads),
+}
+
+
+def is_local_peer(writer: StreamWriter) -> bool:
+    """Whether the other end of the connection is on the same machine (a unix socket or a loopback address)"""
+
+    sock = writer.get_extra_info("socket")
+
+    if sock is not None and getattr(socket, "AF_UNIX", None) is not None and sock.family == socket.AF_UNIX:
+        return True
+
+    peername = writer.get_extra_info("peername")
+
+    if not isinstance(peername, tuple):
+        return False
+
+    try:
+        return ipaddress.ip_address(peername[0]).is_loopback
+    except ValueError:
+        return False
+
+
 class JsonPacketStream:
-    def __init__(self, reader: StreamReader, writer: StreamWriter):
+    def __init__(
+        self,
+        reader: StreamReader,
+        writer: StreamWriter,
+        batch_window: Optional[float] = None,
+        max_frame_size: int = MAX_FRAME_SIZE,
+        metrics: Optional[IpcMetrics] = None,
+        chunk_size: Optional[int] = DEFAULT_CHUNK_SIZE,
+        compression_threshold: Optional[int] = DEFAULT_COMPRESSION_THRESHOLD,
+    ):
         self.reader = reader
         self.writer = writer
 
+        self.metrics = metrics  # per packet type counts and byte totals are recorded here if set
+
+        self.max_frame_size = max_frame_size
+
         self.drain_lock = asyncio.Lock()
 
-    async def read_packet(self) -> cj.ClassyDict:
-        (length,) = struct.unpack(">i", await self.reader.read(LENGTH_LENGTH))  # read the length of the upcoming packet
+        self.codec = None
+        self._dumps = None
+        self._loads = None
+        self.set_codec("json")
+
+        self.peer_features = set()
+        self.shard_ids = ()  # the shards the peer runs, sent by clients with their auth packet
+
+        # None disables batching, 0 coalesces packets written in the same event loop iteration,
+        # anything above that is how many seconds to wait for more packets before flushing
+        self.batch_window = batch_window
+
+        self._batch = []  # [encoded packet with header, encoded packet with header,..]
+        self._batch_size = 0
+        self._batch_flushed = None  # asyncio.Future, done once the current batch was written and drained
+        self._batch_handle = None  # asyncio.Handle / asyncio.TimerHandle for the scheduled flush
+        self._drain_tasks = set()  # the tasks draining flushed batches, referenced here so they aren't garbage collected
+
+        self._read_backlog = deque()  # packets from a batched frame which haven't been returned by read_packet() yet
+
+        self.chunk_size = chunk_size  # None disables splitting up bulk packets
+
+        self._bulk_queue = deque()  # [(encoded packet, asyncio.Future which is done once it's written),..]
+        self._bulk_task = None
+
+        self._chunks = None  # bytearray with the chunks of the bulk packet which is being received
+        self._chunks_header = 0  # the length header of the bulk packet which is being received
+
+        self.compression_threshold = compression_threshold  # None disables compressing packets
+        self.peer_local = is_local_peer(writer)  # packets to local peers aren't compressed
+
+        # counters
+        self.frames_read = 0
+        self.packets_read = 0
+        self.frames_written = 0
+        self.packets_written = 0
+        self.frame_sizes = defaultdict(int)  # {packets_in_frame: frames_written}
+        self.malformed_packets = 0
+        self.bulk_packets_written = 0
+        self.chunks_written = 0
+        self.chunks_read = 0
+        self.compressed_packets = 0
+        self.compression_saved = 0  # bytes
+
+    def set_codec(self, codec: str) -> None:
+        self._dumps, self._loads = CODECS[codec]
+        self.codec = codec
+
+    @property
+    def batching(self) -> bool:
+        return self.batch_window is not None and "batch" in self.peer_features
+
+    @property
+    def chunking(self) -> bool:
+        return self.chunk_size is not None and "chunk" in self.peer_features
+
+    @property
+    def compressing(self) -> bool:
+        return self.compression_threshold is not None and not self.peer_local and "compress" in self.peer_features
+
+    @property
+    def bulk_queued(self) -> int:
+        return len(self._bulk_queue)
+
+    @property
+    def packets_per_frame(self) -> float:
+        return self.packets_written / (self.frames_written or 1)
+
+    @property
+    def typed(self) -> bool:
+        return "typed" in self.peer_features
+
+    def _decompress(self, data: binpack.T_BYTES_LIKE) -> bytes:
+        decompressor = zlib.decompressobj()
+
+        try:
+            decompressed = decompressor.decompress(data, self.max_frame_size)
+        except zlib.error as e:
+            raise PacketStreamError(f"Failed to decompress packet: {e}") from e
+
+        if decompressor.unconsumed_tail:
+            raise PacketStreamError(f"Decompressed packet exceeds the maximum frame size of {self.max_frame_size}")
+
+        return decompressed
+
+    def _decode(self, data: binpack.T_BYTES_LIKE, header: int = 0) -> Optional[T_PACKET]:
+        if header & FLAG_COMPRESSED:
+            data = self._decompress(data)
+
+        try:
+            decoded = self._loads(data)
+        except (ValueError, TypeError) as e:  # TypeError for unhashable set members in json
+            raise PacketStreamError(f"Failed to decode packet with codec {self.codec}: {e}") from e
+
+        # a malformed packet doesn't break the framing, so only the packet itself is dropped
+        try:
+            packet = to_packet(decoded)
+        except MalformedPacketError:
+            self.malformed_packets += 1
+            return None
+
+        if self.metrics is not None:
+            metrics = self.metrics.get(packet.get("type"))
+            metrics.received += 1
+            metrics.received_bytes += len(data)
+
+        return packet
+
+    def _encode(self, packet: T_PACKET) -> bytes:
+        """Encodes (and maybe compresses) a packet, returns it with its length header"""
+
+        if isinstance(packet, Packet):
+            data = self._dumps(packet.to_values() if self.typed else packet.to_dict())
+        else:
+            data = self._dumps(packet)
+
+        header = len(data)
+
+        if self.compressing and header >= self.compression_threshold:
+            compressed = zlib.compress(data, COMPRESSION_LEVEL)
+
+            if len(compressed) < header:
+                self.compressed_packets += 1
+                self.compression_saved += header - len(compressed)
+
+                data = compressed
+                header = FLAG_COMPRESSED | len(data)
+
+        if self.metrics is not None:
+            metrics = self.metrics.get(packet.get("type"))
+            metrics.sent += 1
+            metrics.sent_bytes += len(data)
+
+        return _frame_header.pack(header) + data
+
+    async def read_frame(self) -> List[T_PACKET]:
+        # readexactly() reads the whole frame into a single bytes object, which is then decoded
+        # without being copied again (batched frames are split up via memoryview slices)
+        try:
+            (header,) = _frame_header.unpack(await self.reader.readexactly(LENGTH_LENGTH))
+            length = header & LENGTH_MASK
+
+            if length > self.max_frame_size:
+                raise PacketStreamError(f"Frame length {length} exceeds the maximum frame size of {self.max_frame_size}")
+
+            data = await self.reader.readexactly(length)
+        except asyncio.IncompleteReadError as e:
+            if not e.partial and e.expected == LENGTH_LENGTH:
+                raise PacketStreamError("Stream closed by peer") from e
 
-        data = bytearray(await self.reader.read(length))
+            raise PacketStreamError(f"Stream truncated, got {len(e.partial)} of {e.expected} expected bytes") from e
 
-        while len(data) < length:
-            data += await self.reader.read(length - len(data))
+        self.frames_read += 1
 
-        return cj.loads(data, object_hook=special_obj_hook)
+        if header & FLAG_CHUNK:
+            return self._read_chunk(data)
 
-    async def write_packet(self, data: Union[dict, cj.ClassyDict]) -> None:
-        data = cj.dumps(data, cls=CustomJSONEncoder).encode()
-        packet = struct.pack(">i", len(data)) + data
+        if not header & FLAG_BATCH:
+            self.packets_read += 1
+            packet = self._decode(data, header)
+            return [] if packet is None else [packet]
 
-        for i in range(0, len(packet), 65535):
-            self.writer.write(packet[i - 65535 : i])
+        packets = []
+        view = memoryview(data)
+        i = 0
 
-        self.writer.write(packet)
+        while i < length:
+            if i + LENGTH_LENGTH > length:
+                raise PacketStreamError(f"Malformed batched frame, truncated packet header at offset {i}")
+
+            (packet_header,) = _frame_header.unpack_from(view, i)
+            packet_length = packet_header & LENGTH_MASK
+            i += LENGTH_LENGTH
+
+            if i + packet_length > length:
+                raise PacketStreamError(f"Malformed batched frame, packet at offset {i} overruns the frame")
+
+            packet = self._decode(view[i : i + packet_length], packet_header)
+            i += packet_length
+
+            if packet is not None:
+                packets.append(packet)
+
+        self.packets_read += len(packets)
+        return packets
+
+    def _read_chunk(self, data: bytes) -> List[T_PACKET]:
+        self.chunks_read += 1
+
+        if self._chunks is None:  # the first chunk starts with the length of the whole packet
+            if len(data) < LENGTH_LENGTH:
+                raise PacketStreamError("Malformed chunk, truncated packet length")
+
+            (self._chunks_header,) = _frame_header.unpack_from(data)
+
+            if self._chunks_header & LENGTH_MASK > self.max_frame_size:
+                raise PacketStreamError(
+                    f"Chunked packet length {self._chunks_header & LENGTH_MASK} exceeds the maximum frame size of {self.max_frame_size}"
+                )
+
+            self._chunks = bytearray(memoryview(data)[LENGTH_LENGTH:])
+        else:
+            self._chunks += data
+
+        expected = self._chunks_header & LENGTH_MASK
+
+        if len(self._chunks) < expected:
+            return []
+
+        if len(self._chunks) > expected:
+            raise PacketStreamError(f"Malformed chunks, got {len(self._chunks)} of {expected} expected bytes")
+
+        data = self._chunks
+        self._chunks = None
+
+        self.packets_read += 1
+        packet = self._decode(data, self._chunks_header)
+        return [] if packet is None else [packet]
+
+    async def read_packet(self) -> T_PACKET:
+        while not self._read_backlog:
+            self._read_backlog.extend(await self.read_frame())
+
+        return self._read_backlog.popleft()
+
+    def _is_bulk(self, packet: T_PACKET, data: bytes, priority: Optional[int]) -> bool:
+        if priority is None:
+            return len(data) > (self.chunk_size or MAX_BATCH_SIZE) or packet.get("type") in BULK_PACKET_TYPES
+
+        return priority == PRIORITY_BULK
+
+    async def write_packet(self, packet: T_PACKET, priority: Optional[int] = None) -> None:
+        """Writes a packet, priority is PRIORITY_INTERACTIVE or PRIORITY_BULK, None picks it based on type and size"""
+
+        data = self._encode(packet)
+
+        if self._is_bulk(packet, data, priority):
+            await self._queue_bulk(data)
+            return
+
+        if self.batching:
+            await self._add_to_batch(data)
+            return
+
+        self.writer.write(data)
+        self.frames_written += 1
+        self.packets_written += 1
+        self.frame_sizes[1] += 1
+
+        async with self.drain_lock:
+            await self.writer.drain()
+
+    def write_packet_nowait(self, packet: T_PACKET, priority: Optional[int] = None) -> None:
+        """Writes a packet (or adds it to the current batch / bulk queue) without draining, the caller has to await
+        drain() later"""
+
+        data = self._encode(packet)
+
+        if self._is_bulk(packet, data, priority):
+            self._queue_bulk(data)
+            return
+
+        if self.batching:
+            self._add_to_batch(data)
+            return
+
+        self.writer.write(data)
+        self.frames_written += 1
+        self.packets_written += 1
+        self.frame_sizes[1] += 1
+
+    async def drain(self) -> None:
         async with self.drain_lock:
             await self.writer.drain()
 
+    async def write_packets(self, packets: List[T_PACKET]) -> None:
+        """Writes multiple packets with a single write (or into the current batch) and drains once"""
+
+        encoded = []
+        bulk = []
+
+        for packet in packets:
+            data = self._encode(packet)
+            (bulk if self._is_bulk(packet, data, None) else encoded).append(data)
+
+        if bulk:
+            await asyncio.gather(self._write_encoded(encoded), *[self._queue_bulk(data) for data in bulk])
+            return
+
+        await self._write_encoded(encoded)
+
+    async def _write_encoded(self, encoded: List[bytes]) -> None:
+        if self.batching:
+            await asyncio.gather(*{self._add_to_batch(data) for data in encoded})
+            return
+
+        self.writer.write(b"".join(encoded))
+        self.frames_written += len(encoded)
+        self.packets_written += len(encoded)
+        self.frame_sizes[1] += len(encoded)
+
+        async with self.drain_lock:
+            await self.writer.drain()
+
+    def _queue_bulk(self, data: bytes) -> asyncio.Future:
+        written = asyncio.get_event_loop().create_future()
+        self._bulk_queue.append((data, written))
+
+        if self._bulk_task is None:
+            self._bulk_task = asyncio.create_task(self._write_bulk())
+
+        return written
+
+    async def _write_bulk(self) -> None:
+        try:
+            while self._bulk_queue:
+                data, written = self._bulk_queue[0]
+
+                try:
+                    await self._write_chunks(data)
+                except asyncio.CancelledError:  # an Exception before python 3.8
+                    raise
+                except Exception as e:
+                    written.set_exception(e)
+                    written.exception()  # marks it as retrieved, packets written with write_packet_nowait() don't await it
+                else:
+                    written.set_result(None)
+
+                self._bulk_queue.popleft()
+        finally:
+            self._bulk_task = None
+
+    async def _write_chunks(self, data: bytes) -> None:
+        self.bulk_packets_written += 1
+        self.packets_written += 1
+
+        if not self.chunking:
+            self.writer.write(data)
+            self.frames_written += 1
+            self.frame_sizes[1] += 1
+
+            async with self.drain_lock:
+                await self.writer.drain()
+
+            return
+
+        # data starts with the packet's length header, so the first chunk does too
+        view = memoryview(data)
+
+        for i in range(0, len(data), self.chunk_size):
+            chunk = view[i : i + self.chunk_size]
+
+            self.writer.write(_frame_header.pack(FLAG_CHUNK | len(chunk)) + chunk)
+            self.frames_written += 1
+            self.chunks_written += 1
+
+            async with self.drain_lock:
+                await self.writer.drain()
+
+            await asyncio.sleep(0)  # let interactive packets be written between the chunks
+
+    def _add_to_batch(self, packet: bytes) -> asyncio.Future:
+        self._batch.append(packet)
+        self._batch_size += len(packet)
+
+        flushed = self._batch_flushed
+
+        if flushed is None:
+            loop = asyncio.get_event_loop()
+            flushed = self._batch_flushed = loop.create_future()
+
+            if self.batch_window:
+                self._batch_handle = loop.call_later(self.batch_window, self._flush_batch)
+            else:
+                self._batch_handle = loop.call_soon(self._flush_batch)
+
+        if self._batch_size >= MAX_BATCH_SIZE:
+            self._batch_handle.cancel()
+            self._flush_batch()
+
+        return flushed
+
+    def _flush_batch(self) -> None:
+        batch = self._batch
+        flushed = self._batch_flushed
+
+        self._batch = []
+        self._batch_size = 0
+        self._batch_flushed = None
+        self._batch_handle = None
+
+        if len(batch) == 1:
+            self.writer.write(batch[0])
+        else:
+            data = b"".join(batch)
+            self.writer.write(_frame_header.pack(FLAG_BATCH | len(data)) + data)
+
+        self.frames_written += 1
+        self.packets_written += len(batch)
+        self.frame_sizes[len(batch)] += 1
+
+        # drain once per frame instead of once per packet, every writer in the batch waits on this
+        task = asyncio.create_task(self._drain_batch(flushed))
+        self._drain_tasks.add(task)
+        task.add_done_callback(self._drain_tasks.discard)
+
+    async def _drain_batch(self, flushed: asyncio.Future) -> None:
+        try:
+            async with self.drain_lock:
+                await self.writer.drain()
+        except asyncio.CancelledError:
+            flushed.cancel()
+            raise
+        except Exception as e:
+            flushed.set_exception(e)
+            flushed.exception()  # marks it as retrieved, packets written with write_packet_nowait() don't await it
+        else:
+            flushed.set_result(None)
+
     async def close(self) -> None:
+        if self._batch_handle is not None:
+            self._batch_handle.cancel()
+            self._flush_batch()
+
+        self.fail_bulk(ConnectionResetError("Stream was closed before the packet was written"))
+
         self.writer.close()
         await self.writer.wait_closed()
 
+    def fail_bulk(self, error: Exception) -> None:
+        """Stops writing bulk packets and fails the ones which weren't written yet with the error"""
+
+        if self._bulk_task is not None:
+            self._bulk_task.cancel()
+
+        for _, written in self._bulk_queue:
+            if not written.done():
+                written.set_exception(error)
+                written.exception()
+
+        self._bulk_queue.clear()
+
 
 class PacketHandler:
-    __slots__ = ("packet_type", "function")
+    __slots__ = ("packet_type", "function", "dispatch")
 
-    def __init__(self, packet_type: PacketType, function: T_PACKET_HANDLER_CALLABLE):
+    def __init__(self, packet_type: PacketType, function: T_PACKET_HANDLER_CALLABLE, dispatch: str = DISPATCH_POOL):
         self.packet_type = packet_type
         self.function = function
+        self.dispatch = dispatch
 
     def __call__(self, *args, **kwargs):
         return self.function(*args, **kwargs)
 
+    def bind(self, instance: object) -> "PacketHandler":
+        return PacketHandler(self.packet_type, self.function.__get__(instance), self.dispatch)
 
-def handle_packet(packet_type: PacketType) -> Callable[[T_PACKET_HANDLER_CALLABLE], PacketHandler]:
-    """Decorator for creating a PacketHandler object in a class"""
+
+def handle_packet(
+    packet_type: PacketType, *, dispatch: str = DISPATCH_POOL
+) -> Callable[[T_PACKET_HANDLER_CALLABLE], PacketHandler]:
+    """Decorator for creating a PacketHandler object in a class, see util.dispatch for the dispatch modes"""
+
+    if dispatch not in DISPATCH_MODES:
+        raise ValueError(f"Invalid dispatch mode {dispatch!r}")
 
     def _handle(function: T_PACKET_HANDLER_CALLABLE) -> PacketHandler:
-        return PacketHandler(packet_type, function)
+        if (dispatch == DISPATCH_INLINE) == asyncio.iscoroutinefunction(function):
+            raise TypeError(
+                f"{function.__qualname__} has to be {'a plain' if dispatch == DISPATCH_INLINE else 'an async'} function"
+            )
+
+        return PacketHandler(packet_type, function, dispatch)
 
     return _handle
 
@@ -152,7 +1160,7 @@ class PacketHandlerRegistryMeta(type):
                             f"Can't register {function.__module__}.{function.__qualname__} as a handler for packet type {packet_type} because there already is one."
                         )
 
-                    new.__packet_handlers__[packet_type] = function
+                    new.__packet_handlers__[packet_type] = obj
 
         return new
 
@@ -164,8 +1172,9 @@ class PacketHandlerRegistry(metaclass=PacketHandlerRegistryMeta):
         self = super().__new__(cls)
 
         # bind handlers to their class instance manually
-        for packet_type, handler in list(cls.__packet_handlers__.items()):
-            self.__packet_handlers__[packet_type] = handler.__get__(self)
+        self.__packet_handlers__ = {
+            packet_type: handler.bind(self) for packet_type, handler in cls.__packet_handlers__.items()
+        }
 
         return self
 
@@ -174,19 +1183,28 @@ class PacketHandlerRegistry(metaclass=PacketHandlerRegistryMeta):
 
 
 class PacketPlaceholder:
-    __slots__ = ("packet", "_event")
+    __slots__ = ("packet", "created_at", "_future")
 
     def __init__(self):
-        self.packet: cj.ClassyDict = None
-        self._event = asyncio.Event()
+        self.packet: T_PACKET = None
+        self.created_at = time.monotonic()
+        self._future = asyncio.get_event_loop().create_future()
 
-    def set(self, packet: cj.ClassyDict) -> None:
+    def set(self, packet: T_PACKET) -> None:
         self.packet = packet
-        self._event.set()
 
-    async def wait(self) -> cj.ClassyDict:
-        await self._event.wait()
-        return self.packet
+        if not self._future.done():
+            self._future.set_result(packet)
+
+    def fail(self, exception: Exception) -> None:
+        if not self._future.done():
+            self._future.set_exception(exception)
+
+    async def wait(self, timeout: Optional[float] = None) -> T_PACKET:
+        if timeout is None:
+            return await self._future
+
+        return await asyncio.wait_for(self._future, timeout)
 
     def __repr__(self) -> str:
         return f"PacketPlaceholder(packet={self.packet!r})"
@@ -195,79 +1213,515 @@ class PacketPlaceholder:
 
 
 class Client:
-    def __init__(self, host: str, port: int, packet_handlers: Dict[PacketType, PacketHandler]):
+    def __init__(
+        self,
+        host: str,
+        port: int,
+        packet_handlers: Dict[PacketType, PacketHandler],
+        *,
+        batch_window: Optional[float] = None,
+        request_timeout: Optional[float] = DEFAULT_REQUEST_TIMEOUT,
+        request_timeouts: Optional[Dict[PacketType, Optional[float]]] = None,
+        unix_socket: Optional[str] = None,
+        ring: Optional[RingBuffer] = None,
+        chunk_size: Optional[int] = DEFAULT_CHUNK_SIZE,
+        compression_threshold: Optional[int] = DEFAULT_COMPRESSION_THRESHOLD,
+        handler_workers: int = DEFAULT_HANDLER_WORKERS,
+        max_pending_handlers: int = DEFAULT_MAX_PENDING_HANDLERS,
+        logger: Optional[logging.Logger] = None,
+        reconnect_delay: Optional[float] = RECONNECT_DELAY,
+        shard_ids: Optional[List[int]] = None,
+    ):
         self.host = host
         self.port = port
+        self.unix_socket = unix_socket  # used instead of host & port when set and the socket exists
+
+        self.shard_ids = list(shard_ids or ())  # sent with the auth packet, so the server can route packets for them
+
+        self.ring = ring  # shared memory lane to the server for RING_PACKET_TYPES
+
+        self.chunk_size = chunk_size
+        self.compression_threshold = compression_threshold
 
         self.packet_handlers = packet_handlers
 
+        self.batch_window = batch_window
+
+        self.request_timeout = request_timeout
+        self.request_timeouts = {**DEFAULT_REQUEST_TIMEOUTS, **(request_timeouts or {})}
+
         self._stream = None
 
-        self._expected_packets: Dict[str, PacketPlaceholder] = {}
+        self._expected_packets: Dict[str, PacketPlaceholder] = {}  # insertion ordered, so the first entry is the oldest
+        self._broadcast_streams: Dict[str, asyncio.Queue] = {}  # {request_id: queue of BROADCAST_PARTIAL packets}
+
+        self.metrics = IpcMetrics(PacketType)
         self._current_id = 0
         self._read_task = None
 
+        self.pool = HandlerPool(handler_workers, max_pending_handlers, logger)
+        self._lane = None
+
+        self.auth = None
+        self.connected = False
+        self.closing = False
+
+        self.reconnect_delay = reconnect_delay  # None disables reconnecting
+        self.disconnect_handlers: List[Callable[[], None]] = []  # called when the connection is lost
+        self.reconnect_handlers: List[Callable[[], Awaitable[None]]] = []  # awaited after every successful reconnect
+        self._reconnect_task = None
+        self._replay_queue = deque(maxlen=REPLAY_QUEUE_SIZE)  # REPLAY_PACKET_TYPES sent while disconnected
+
+        self._subscriptions: Dict[str, List[T_SUBSCRIBER]] = {}  # {topic: [callback, callback,..]}
+
+        # counters
+        self.timed_out_requests = 0
+        self.late_responses = 0
+        self.reconnects = 0
+        self.replayed_packets = 0
+        self.dropped_packets = 0  # packets which didn't fit in the replay queue
+
+    @property
+    def uses_unix_socket(self) -> bool:
+        return UNIX_SOCKETS_SUPPORTED and self.unix_socket is not None and os.path.exists(self.unix_socket)
+
+    async def _open_connection(self) -> Tuple[StreamReader, StreamWriter]:
+        if self.uses_unix_socket:
+            return await asyncio.open_unix_connection(self.unix_socket)
+
+        return await asyncio.open_connection(self.host, self.port)
+
     async def connect(self, auth: str) -> None:
-        self._stream = JsonPacketStream(*await asyncio.open_connection(self.host, self.port))
-        self._read_task = asyncio.create_task(self._read_packets())
+        self.auth = auth
 
-        res = await self.request({"type": PacketType.AUTH, "auth": auth})
+        await self._connect()
+
+        self.pool.start()
+        self._lane = self.pool.lane("karen")
+
+    async def _connect(self) -> None:
+        self._stream = JsonPacketStream(
+            *await self._open_connection(),
+            self.batch_window,
+            metrics=self.metrics,
+            chunk_size=self.chunk_size,
+            compression_threshold=self.compression_threshold,
+        )
+
+        # the auth packet is handled before the read task is started so the codec can be switched before anything else is read
+        await self._stream.write_packet(
+            {
+                "type": PacketType.AUTH,
+                "id": "c-auth",
+                "auth": self.auth,
+                "codecs": list(CODECS),
+                "features": list(FEATURES),
+                "shard_ids": self.shard_ids,
+            }
+        )
+        res = await self._stream.read_packet()
 
         if not res.success:
-            self._read_task.cancel()
             await self._stream.close()
 
             raise ValueError("Invalid authorization")
 
+        if res.get("codec") in CODECS:
+            self._stream.set_codec(res.codec)
+
+        self._stream.peer_features.update(res.get("features", ()))
+
+        self.connected = True
+        self._read_task = asyncio.create_task(self._read_packets())
+
+        if self._subscriptions:  # subscriptions made before connecting, or before reconnecting to a restarted server
+            await self._stream.write_packet(SubscribePacket(topics=list(self._subscriptions)))
+
     async def close(self) -> None:
+        self.closing = True
+
+        if self._reconnect_task is not None:
+            self._reconnect_task.cancel()
+
         self._read_task.cancel()
+        self.pool.stop()
+
+        if self.connected:
+            await self.send(DisconnectPacket())
 
-        await self.send({"type": PacketType.DISCONNECT})
         await self._stream.close()
 
+        if self.ring is not None:
+            self.ring.close()
+
+    @property
+    def in_flight_requests(self) -> int:
+        return len(self._expected_packets)
+
+    @property
+    def oldest_request_age(self) -> float:
+        for placeholder in self._expected_packets.values():
+            return time.monotonic() - placeholder.created_at
+
+        return 0
+
     async def _read_packets(self):
+        try:
+            await self._read_frames()
+        except (PacketStreamError, ConnectionError) as e:
+            self._connection_lost(e)
+
+    async def _read_frames(self):
         while True:
-            packet = await self._stream.read_packet()
+            packets = await self._stream.read_frame()
+            received_at = time.monotonic()
+
+            for packet in packets:
+                packet_id = packet.get("id")
+
+                if packet_id in self._expected_packets:
+                    self._expected_packets[packet_id].set(packet)
+                elif packet_id in self._broadcast_streams:
+                    self._broadcast_streams[packet_id].put_nowait(packet)
+                elif isinstance(packet_id, str) and packet_id.startswith("c"):
+                    # response to a request which already timed out or was cancelled
+                    self.late_responses += 1
+                else:
+                    await self._dispatch(packet, received_at)
 
-            if packet.id in self._expected_packets:
-                self._expected_packets[packet.id].set(packet)
-            else:
-                asyncio.create_task(self._call_handler(packet))
+            await self._stream.drain()  # for responses written by inline handlers
+
+    def _connection_lost(self, e: Exception) -> None:
+        self.connected = False
+        self._stream.writer.close()
+
+        # nothing is going to respond to these, so they fail right away instead of waiting for their timeouts
+        error = ConnectionLostError(f"Lost connection to the server: {e}")
+
+        for placeholder in self._expected_packets.values():
+            placeholder.fail(error)
+
+        self._stream.fail_bulk(error)
+
+        for queue in self._broadcast_streams.values():
+            queue.put_nowait(error)
+
+        for disconnect_handler in self.disconnect_handlers:
+            try:
+                disconnect_handler()
+            except Exception as e:
+                self.pool.logger.error(f"Error in ipc disconnect handler {disconnect_handler!r}", exc_info=e)
+
+        if self.reconnect_delay is not None and not self.closing:
+            self.pool.logger.warning(f"Lost ipc connection ({e}), reconnecting")
+            self._reconnect_task = asyncio.create_task(self._reconnect())
+
+    async def _reconnect(self) -> None:
+        delay = self.reconnect_delay
+
+        while True:
+            # jitter, so clusters which lost their connections at the same time don't all reconnect at the same time
+            await asyncio.sleep(delay * random.uniform(0.5, 1.5))
+
+            try:
+                await self._connect()
+                break
+            except (OSError, PacketStreamError, ValueError):
+                delay = min(delay * 2, MAX_RECONNECT_DELAY)
+
+        self.reconnects += 1
+        self.pool.logger.info(f"Reconnected to ipc server, replaying {len(self._replay_queue)} packets")
+
+        while self._replay_queue and self.connected:
+            packet = self._replay_queue.popleft()
+
+            try:
+                await self.send(packet)
+            except ConnectionError:  # lost again, _read_packets() takes care of it
+                break
+
+            self.replayed_packets += 1
+
+        for reconnect_handler in self.reconnect_handlers:
+            try:
+                await reconnect_handler()
+            except Exception as e:
+                self.pool.logger.error(f"Error in ipc reconnect handler {reconnect_handler!r}", exc_info=e)
+
+    async def send(self, packet: T_PACKET, *, priority: Optional[int] = None) -> None:
+        """Sends a packet without waiting for a response, see JsonPacketStream.write_packet() for priority"""
 
-    async def send(self, packet: Union[dict, cj.ClassyDict]) -> None:
-        await self._stream.write_packet(packet)
+        if self.ring is not None and isinstance(packet, Packet) and packet.type in RING_PACKET_TYPES:
+            if self.ring.push(binpack.pack(packet.to_values())):
+                return
+
+            # the ring is full, so fall back to the socket
+
+        if not self.connected:
+            if isinstance(packet, Packet) and packet.type in REPLAY_PACKET_TYPES:
+                if len(self._replay_queue) == self._replay_queue.maxlen:
+                    self.dropped_packets += 1
+
+                self._replay_queue.append(packet)
+                return
+
+            raise ConnectionLostError("Not connected to the server")
+
+        await self._stream.write_packet(packet, priority)
 
-    async def request(self, packet: Union[dict, cj.ClassyDict]) -> cj.ClassyDict:
-        packet["id"] = packet_id = f"c{self._current_id}"
+    def _get_timeout(self, packet: T_PACKET) -> Optional[float]:
+        return self.request_timeouts.get(packet.get("type"), self.request_timeout)
+
+    def _expect_response(self, packet: T_PACKET) -> PacketPlaceholder:
+        packet_id = f"c{self._current_id}"
         self._current_id += 1
 
-        # create entry before sending packet
+        if isinstance(packet, Packet):
+            packet.id = packet_id
+        else:
+            packet["id"] = packet_id
+
         placeholder = self._expected_packets[packet_id] = PacketPlaceholder()
+        return placeholder
+
+    async def _wait_response(self, packet: T_PACKET, placeholder: PacketPlaceholder, timeout: Optional[float]) -> T_PACKET:
+        metrics = self.metrics.get(packet.get("type"))
+
+        try:
+            response = await placeholder.wait(timeout)
+        except asyncio.TimeoutError:
+            self.timed_out_requests += 1
+            metrics.timeouts += 1
+            raise RequestTimeoutError(packet.get("type"), timeout) from None
+        finally:  # also cleans up after cancellation
+            self._expected_packets.pop(packet.get("id"), None)
+
+        metrics.request_latency.add(time.monotonic() - placeholder.created_at)
+
+        return response
+
+    async def request(self, packet: T_PACKET, *, timeout: object = ...) -> T_PACKET:
+        """Sends a packet and waits for its response, raises RequestTimeoutError if there is none within
+        the timeout. If no timeout is passed, the configured timeout for the packet's type is used."""
+
+        if timeout is ...:
+            timeout = self._get_timeout(packet)
+
+        # create entry before sending packet
+        placeholder = self._expect_response(packet)
+
+        try:
+            await self.send(packet)  # send packet off to karen
+        except BaseException:
+            self._expected_packets.pop(packet.get("id"), None)
+            raise
+
+        return await self._wait_response(packet, placeholder, timeout)
+
+    async def request_many(self, packets: List[T_PACKET], *, timeout: object = ..., return_exceptions: bool = False) -> list:
+        """Sends multiple requests in one write and waits for all of their responses concurrently,
+        return_exceptions works the same as with asyncio.gather()"""
+
+        if not self.connected:
+            raise ConnectionLostError("Not connected to the server")
+
+        placeholders = [self._expect_response(packet) for packet in packets]
+
+        try:
+            await self._stream.write_packets(packets)
+        except BaseException:
+            for packet in packets:
+                self._expected_packets.pop(packet.get("id"), None)
+
+            raise
+
+        return await asyncio.gather(
+            *[
+                self._wait_response(packet, placeholder, self._get_timeout(packet) if timeout is ... else timeout)
+                for packet, placeholder in zip(packets, placeholders)
+            ],
+            return_exceptions=return_exceptions,
+        )
+
+    def _broadcast_request(
+        self, packet: T_PACKET, timeout: object, mode: str, quorum: Optional[int], guild_id: Optional[int]
+    ) -> Tuple[dict, float]:
+        if mode not in BROADCAST_MODES:
+            raise ValueError(f"Invalid broadcast mode {mode!r}")
+
+        if isinstance(packet, Packet):  # broadcasted packets are nested in the request, so they're sent as dicts
+            packet = packet.to_dict()
+
+        request = {"type": PacketType.BROADCAST_REQUEST, "packet": packet, "mode": mode, "quorum": quorum}
+
+        if guild_id is not None:
+            request["guild_id"] = guild_id
+
+        if timeout is ...:
+            return request, self._get_timeout(request)
+
+        request["timeout"] = timeout
+
+        return request, (None if timeout is None else timeout + BROADCAST_TIMEOUT_MARGIN)
+
+    async def broadcast(
+        self,
+        packet: T_PACKET,
+        *,
+        timeout: object = ...,
+        mode: str = MODE_ALL,
+        quorum: Optional[int] = None,
+        guild_id: Optional[int] = None,
+    ) -> cj.ClassyDict:
+        """Sends a packet to every cluster via karen, and returns their responses once the broadcast is done
+        (see the MODE_* constants) or the timeout passed. If no timeout is passed, karen's default is used.
+        If a guild_id is passed, it's only sent to the cluster which runs the guild's shard."""
+
+        request, request_timeout = self._broadcast_request(packet, timeout, mode, quorum, guild_id)
+
+        return await self.request(request, timeout=request_timeout)
+
+    async def broadcast_iter(
+        self,
+        packet: T_PACKET,
+        *,
+        timeout: object = ...,
+        mode: str = MODE_ALL,
+        quorum: Optional[int] = None,
+        guild_id: Optional[int] = None,
+    ) -> AsyncIterator[T_PACKET]:
+        """Like broadcast(), but yields each cluster's response as soon as karen receives it"""
+
+        request, request_timeout = self._broadcast_request(packet, timeout, mode, quorum, guild_id)
+        request["stream"] = True
+        request["id"] = request_id = f"c{self._current_id}"
+        self._current_id += 1
+
+        queue = self._broadcast_streams[request_id] = asyncio.Queue()
+        deadline = None if request_timeout is None else time.monotonic() + request_timeout
+
+        try:
+            await self.send(request)
+
+            while True:
+                try:
+                    packet = await asyncio.wait_for(queue.get(), None if deadline is None else deadline - time.monotonic())
+                except asyncio.TimeoutError:
+                    self.timed_out_requests += 1
+                    raise RequestTimeoutError(PacketType.BROADCAST_REQUEST, request_timeout) from None
+
+                if isinstance(packet, ConnectionLostError):
+                    raise packet
+
+                if packet.type != PacketType.BROADCAST_PARTIAL:  # the final BROADCAST_RESPONSE
+                    return
+
+                yield packet.response
+        finally:
+            self._broadcast_streams.pop(request_id, None)
 
-        await self.send(packet)  # send packet off to karen
+    def subscribe(self, topic: str, callback: T_SUBSCRIBER) -> None:
+        """Calls the callback with every message published to the topic, plain functions are called inline by the
+        reader so they have to be cheap, coroutine functions are ran in their own task"""
 
-        res = await placeholder.wait()
+        callbacks = self._subscriptions.setdefault(topic, [])
 
-        del self._expected_packets[packet_id]
+        if not callbacks and self.connected:
+            self._stream.write_packet_nowait(SubscribePacket(topics=[topic]))
 
-        return res
+        callbacks.append(callback)
 
-    async def broadcast(self, packet: Union[dict, cj.ClassyDict]) -> cj.ClassyDict:
-        return await self.request({"type": PacketType.BROADCAST_REQUEST, "packet": packet})
+    def unsubscribe(self, topic: str, callback: T_SUBSCRIBER) -> None:
+        callbacks = self._subscriptions.get(topic, [])
 
-    async def eval(self, code: str) -> cj.ClassyDict:
-        return await self.request({"type": PacketType.EVAL, "code": code})
+        if callback in callbacks:
+            callbacks.remove(callback)
+
+        if not callbacks and self._subscriptions.pop(topic, None) is not None and self.connected:
+            self._stream.write_packet_nowait(UnsubscribePacket(topics=[topic]))
+
+    async def publish(self, topic: str, message: object = None) -> None:
+        """Sends a message to every client subscribed to the topic (including this one), without waiting for anything"""
+
+        await self.send(PublishPacket(topic=topic, message=message))
+
+    def _deliver(self, packet: T_PACKET) -> None:
+        for callback in self._subscriptions.get(packet.topic, ()):
+            if asyncio.iscoroutinefunction(callback):
+                self.pool.spawn(callback, packet.message)
+                continue
+
+            try:
+                callback(packet.message)
+            except Exception as e:
+                self.pool.report_error(f"subscriber {getattr(callback, '__qualname__', callback)}", e)
+
+    async def eval(self, code: str) -> T_PACKET:
+        return await self.request(EvalPacket(code=code))
 
     async def exec(self, code: str) -> cj.ClassyDict:
         return await self.request({"type": PacketType.EXEC, "code": code})
 
-    async def _call_handler(self, packet: cj.ClassyDict):
+    def _get_handler(self, packet: T_PACKET) -> PacketHandler:
         handler = self.packet_handlers.get(packet.type)
 
         if handler is None:
             handler = self.packet_handlers[PacketType.MISSING_PACKET]
 
-        data = await handler(packet)
+        return handler
+
+    async def _dispatch(self, packet: T_PACKET, received_at: float) -> None:
+        if packet.type == PacketType.PUBLISH:
+            self._deliver(packet)
+            return
+
+        handler = self._get_handler(packet)
+
+        if handler.dispatch == DISPATCH_INLINE:
+            self._call_handler_inline(handler, packet, received_at)
+        elif handler.dispatch == DISPATCH_TASK:
+            self.pool.spawn(self._call_handler, handler, packet, received_at)
+        else:
+            await self._lane.submit(self._call_handler, handler, packet, received_at)
+
+    def _call_handler_inline(self, handler: PacketHandler, packet: T_PACKET, received_at: float) -> None:
+        started_at = time.monotonic()
+        metrics = self.metrics.get(packet.type)
+        metrics.queue_latency.add(started_at - received_at)
+
+        try:
+            response = self._get_response(handler, packet, handler(packet))
+
+            if response is not None:
+                self._stream.write_packet_nowait(response)
+        except Exception as e:
+            self.pool.report_error(_describe_handler(handler), e)
+        finally:
+            self.pool.handled += 1
+            metrics.handler_latency.add(time.monotonic() - started_at)
+
+    async def _call_handler(self, handler: PacketHandler, packet: T_PACKET, received_at: float) -> None:
+        started_at = time.monotonic()
+        metrics = self.metrics.get(packet.type)
+        metrics.queue_latency.add(started_at - received_at)
+
+        try:
+            response = self._get_response(handler, packet, await handler(packet))
+
+            if response is not None:
+                await self.send(response)
+        except ConnectionError:  # karen is gone, so there's nobody to respond to
+            pass
+        except asyncio.CancelledError:  # an Exception before python 3.8
+            raise
+        except Exception as e:
+            self.pool.report_error(_describe_handler(handler), e)
+        finally:
+            metrics.handler_latency.add(time.monotonic() - started_at)
+
+    def _get_response(self, handler: PacketHandler, packet: T_PACKET, data: object) -> Optional[dict]:
+        if isinstance(data, Packet):  # responses to karen are always sent as broadcast responses
+            data = data.to_dict()
 
         if isinstance(data, dict):
             if packet.get("id") is not None:
@@ -275,31 +1729,86 @@ class Client:
 
             data["type"] = PacketType.BROADCAST_RESPONSE
 
-            await self.send(data)
-        elif data is not None:
-            raise ValueError(
-                f"Invalid return from handler {handler.function.__module__}.{handler.function.__qualname__}: {data!r}"
-            )
+            return data
+
+        if data is not None:
+            raise ValueError(f"Invalid return from handler {_describe_handler(handler)}: {data!r}")
+
+        return None
+
+
+def _describe_handler(handler: PacketHandler) -> str:
+    return f"{handler.function.__module__}.{handler.function.__qualname__}"
+
+
+# the connection the packet currently being handled by a Server came from, so handlers can send extra packets to it
+current_connection: ContextVar[Optional[JsonPacketStream]] = ContextVar("current_connection", default=None)
 
 
 class Server:
-    def __init__(self, host: str, port: int, auth: str, packet_handlers: Dict[PacketType, PacketHandler]):
+    def __init__(
+        self,
+        host: str,
+        port: int,
+        auth: str,
+        packet_handlers: Dict[PacketType, PacketHandler],
+        *,
+        batch_window: Optional[float] = None,
+        unix_socket: Optional[str] = None,
+        chunk_size: Optional[int] = DEFAULT_CHUNK_SIZE,
+        compression_threshold: Optional[int] = DEFAULT_COMPRESSION_THRESHOLD,
+        handler_workers: int = DEFAULT_HANDLER_WORKERS,
+        max_pending_handlers: int = DEFAULT_MAX_PENDING_HANDLERS,
+        logger: Optional[logging.Logger] = None,
+    ):
         self.host = host
         self.port = port
+        self.unix_socket = unix_socket  # when set, also listen on this unix socket path for co-located clients
 
         self.auth = auth
 
         self.packet_handlers = packet_handlers
 
+        self.batch_window = batch_window
+        self.chunk_size = chunk_size
+        self.compression_threshold = compression_threshold
+
         self.server = None
+        self.unix_server = None
         self.serve_task = None
 
         self.connections = []
+        self.disconnect_handlers: List[Callable[[JsonPacketStream], None]] = []  # called with each connection that's lost
+        self.shard_connections: Dict[int, JsonPacketStream] = {}  # {shard_id: connection of the client which runs it}
+
+        self.rings: List[RingBuffer] = []  # one per client which has a shared memory lane, read by _drain_rings()
+        self.ring_task = None
 
         self.closing = False
 
+        self.metrics = IpcMetrics(PacketType)  # shared by all connections
+
+        self.pool = HandlerPool(handler_workers, max_pending_handlers, logger)  # shared by all connections and rings
+        self._ring_lane = None
+
+        # counters
+        self.ring_packets = 0
+        self.malformed_ring_packets = 0
+
     async def start(self) -> None:
+        self.pool.start()
+        self._ring_lane = self.pool.lane("rings")
+
         self.server = await asyncio.start_server(self.handle_connection, self.host, self.port)
+        self.ring_task = asyncio.create_task(self._drain_rings())
+
+        if self.unix_socket is not None and UNIX_SOCKETS_SUPPORTED:
+            # a socket file left behind by a previous run would make binding fail
+            if os.path.exists(self.unix_socket):
+                os.remove(self.unix_socket)
+
+            self.unix_server = await asyncio.start_unix_server(self.handle_connection, self.unix_socket)
+
         self.serve_task = asyncio.create_task(self.server.serve_forever())
 
     async def serve(self) -> None:
@@ -309,51 +1818,199 @@ class Server:
     async def close(self) -> None:
         self.closing = True
         self.serve_task.cancel()
+        self.ring_task.cancel()
+        self.pool.stop()
 
         self.server.close()
+
+        # the clients notice right away and start reconnecting, instead of waiting on requests which won't be answered
+        for stream in list(self.connections):
+            stream.writer.close()
+
         await self.server.wait_closed()
 
-    async def call_handler(self, stream: JsonPacketStream, packet: cj.ClassyDict) -> None:
+        if self.unix_server is not None:
+            self.unix_server.close()
+            await self.unix_server.wait_closed()
+
+            if os.path.exists(self.unix_socket):
+                os.remove(self.unix_socket)
+
+    def _get_handler(self, packet: T_PACKET) -> PacketHandler:
         handler = self.packet_handlers.get(packet.type)
 
         if handler is None:
             handler = self.packet_handlers[PacketType.MISSING_PACKET]
 
-        data = await handler(packet)
+        return handler
+
+    async def dispatch(self, stream: Optional[JsonPacketStream], lane: Lane, packet: T_PACKET, received_at: float) -> None:
+        """Calls the packet's handler inline or hands it to the pool, waits if the lane is full"""
+
+        handler = self._get_handler(packet)
+
+        if handler.dispatch == DISPATCH_INLINE:
+            self.call_handler_inline(stream, handler, packet, received_at)
+        elif handler.dispatch == DISPATCH_TASK:
+            self.pool.spawn(self.call_handler, stream, handler, packet, received_at)
+        else:
+            await lane.submit(self.call_handler, stream, handler, packet, received_at)
+
+    def call_handler_inline(
+        self, stream: Optional[JsonPacketStream], handler: PacketHandler, packet: T_PACKET, received_at: float
+    ) -> None:
+        started_at = time.monotonic()
+        metrics = self.metrics.get(packet.type)
+        metrics.queue_latency.add(started_at - received_at)
+
+        current_connection.set(stream)  # set in the reader's task, which only ever reads from this stream
+
+        try:
+            response = self._get_response(handler, packet, handler(packet))
+
+            if response is not None and stream is not None:
+                stream.write_packet_nowait(response)
+        except Exception as e:
+            self.pool.report_error(_describe_handler(handler), e)
+        finally:
+            self.pool.handled += 1
+            metrics.handler_latency.add(time.monotonic() - started_at)
+
+    async def call_handler(
+        self, stream: Optional[JsonPacketStream], handler: PacketHandler, packet: T_PACKET, received_at: float
+    ) -> None:
+        started_at = time.monotonic()
+        metrics = self.metrics.get(packet.type)
+        metrics.queue_latency.add(started_at - received_at)
+
+        current_connection.set(stream)  # set again by every handler a worker runs, so it doesn't leak between them
+
+        try:
+            response = self._get_response(handler, packet, await handler(packet))
+
+            if response is not None and stream is not None:
+                await stream.write_packet(response)
+        except ConnectionError:  # the client is gone, so there's nobody to respond to
+            pass
+        except asyncio.CancelledError:  # an Exception before python 3.8
+            raise
+        except Exception as e:
+            self.pool.report_error(_describe_handler(handler), e)
+        finally:
+            metrics.handler_latency.add(time.monotonic() - started_at)
+
+    def _get_response(self, handler: PacketHandler, packet: T_PACKET, data: object) -> Optional[T_PACKET]:
+        if isinstance(data, Packet):
+            data.id = packet.get("id")
+
+            return data
 
         if isinstance(data, dict):
             if packet.get("id") is not None:
                 data["id"] = packet.id
 
-            await stream.write_packet(data)
-        elif data is not None:
-            raise ValueError(
-                f"Invalid return from handler {handler.function.__module__}.{handler.function.__qualname__}: {data!r}"
-            )
+            return data
 
-    async def handle_connection(self, reader: StreamReader, writer: StreamWriter) -> None:
-        stream = JsonPacketStream(reader, writer)
-        self.connections.append(stream)
-        authed = False
+        if data is not None:
+            raise ValueError(f"Invalid return from handler {_describe_handler(handler)}: {data!r}")
+
+        return None
+
+    async def _drain_rings(self) -> None:
+        while True:
+            drained = 0
 
-        while not self.closing:
+            for ring in self.rings:
+                records = ring.pop_all()
+                received_at = time.monotonic()
+
+                for data in records:
+                    try:
+                        packet = to_packet(binpack.unpack(data))
+                    except (ValueError, TypeError) as e:  # a bad record is skipped, it mustn't stop the ring task
+                        self.malformed_ring_packets += 1
+                        self.pool.logger.warning(f"Skipped malformed ring packet: {e!r}")
+                        continue
+
+                    metrics = self.metrics.get(packet.type)
+                    metrics.received += 1
+                    metrics.received_bytes += len(data)
+
+                    # ring packets are one-way, so there is no stream to respond on. Once the lane is full this
+                    # waits, so the ring fills up and the clients fall back to their (also bounded) sockets
+                    await self.dispatch(None, self._ring_lane, packet, received_at)
+                    drained += 1
+
+            self.ring_packets += drained
+
+            # only wait when the rings were empty, so bursts are drained as fast as they come in
+            await asyncio.sleep(0 if drained else RING_POLL_INTERVAL)
+
+    async def handle_connection(self, reader: StreamReader, writer: StreamWriter) -> None:
+        stream = JsonPacketStream(
+            reader,
+            writer,
+            self.batch_window,
+            metrics=self.metrics,
+            chunk_size=self.chunk_size,
+            compression_threshold=self.compression_threshold,
+        )
+
+        try:
             packet = await stream.read_packet()
+        except PacketStreamError:
+            writer.close()
+            return
 
-            if not authed:
-                auth = packet.get("auth", None)
+        if packet.get("auth", None) != self.auth:
+            await stream.write_packet({"type": PacketType.AUTH_RESPONSE, "success": False, "id": packet.id})
+            return
 
-                if auth == self.auth:
-                    authed = True
-                    await stream.write_packet({"type": PacketType.AUTH_RESPONSE, "success": True, "id": packet.id})
-                else:
-                    await stream.write_packet({"type": PacketType.AUTH_RESPONSE, "success": False, "id": packet.id})
-                    self.connections.remove(stream)
-                    return
+        # pick the first codec the client supports, peers without codec support stay on json
+        codec = next((c for c in packet.get("codecs", ()) if c in CODECS), None)
+        features = [f for f in packet.get("features", ()) if f in FEATURES]
 
-                continue
+        await stream.write_packet(
+            {"type": PacketType.AUTH_RESPONSE, "success": True, "id": packet.id, "codec": codec, "features": features}
+        )
 
-            if packet.type == PacketType.DISCONNECT:
-                self.connections.remove(stream)
-                return
+        if codec is not None:
+            stream.set_codec(codec)
+
+        stream.peer_features.update(features)
+        stream.shard_ids = tuple(packet.get("shard_ids") or ())
 
-            asyncio.create_task(self.call_handler(stream, packet))
+        self.connections.append(stream)
+        lane = self.pool.lane(f"connection {len(self.connections)}")
+
+        for shard_id in stream.shard_ids:  # a reconnecting client replaces its old connection, which may not be closed yet
+            self.shard_connections[shard_id] = stream
+
+        try:
+            while not self.closing:
+                packets = await stream.read_frame()
+                received_at = time.monotonic()
+
+                for packet in packets:
+                    if packet.type == PacketType.DISCONNECT:
+                        return
+
+                    await self.dispatch(stream, lane, packet, received_at)
+
+                await stream.drain()  # for responses written by inline handlers
+        except PacketStreamError:
+            # the stream can't be resynchronized after a broken frame, so the connection is dropped
+            # and the client has to reconnect
+            writer.close()
+        except ConnectionError:  # lost while draining
+            pass
+        finally:
+            self.connections.remove(stream)
+            self.pool.close_lane(lane)
+
+            for shard_id in stream.shard_ids:
+                if self.shard_connections.get(shard_id) is stream:
+                    del self.shard_connections[shard_id]
+
+            for disconnect_handler in self.disconnect_handlers:
+                disconnect_handler(stream)
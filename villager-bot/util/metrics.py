@@ -0,0 +1,192 @@
+from typing import Dict, List, Optional
+from bisect import bisect_left
+
+# upper bounds of the latency histogram buckets in seconds, 50us doubling up to ~6.5s, plus an overflow bucket
+LATENCY_BUCKETS = tuple(0.00005 * 2**i for i in range(18))
+
+
+class Histogram:
+    __slots__ = ("bounds", "counts", "count", "total", "max")
+
+    def __init__(self, bounds: tuple = LATENCY_BUCKETS):
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)
+
+        self.count = 0
+        self.total = 0
+        self.max = 0
+
+    def add(self, value: float) -> None:
+        self.counts[bisect_left(self.bounds, value)] += 1
+
+        self.count += 1
+        self.total += value
+
+        if value > self.max:
+            self.max = value
+
+    @property
+    def mean(self) -> float:
+        return self.total / (self.count or 1)
+
+    def percentile(self, p: float) -> float:
+        """Estimates the p-th percentile (0-1) as the upper bound of the bucket it falls into"""
+
+        target = p * self.count
+        seen = 0
+
+        for i, count in enumerate(self.counts):
+            seen += count
+
+            if seen >= target and count:
+                return self.bounds[i] if i < len(self.bounds) else self.max
+
+        return 0
+
+    def to_dict(self) -> dict:
+        return {"counts": self.counts, "count": self.count, "total": self.total, "max": self.max}
+
+    @classmethod
+    def from_dict(cls, data: dict, bounds: tuple = LATENCY_BUCKETS) -> "Histogram":
+        histogram = cls(bounds)
+
+        histogram.counts = list(data["counts"])
+        histogram.count = data["count"]
+        histogram.total = data["total"]
+        histogram.max = data["max"]
+
+        return histogram
+
+    def merge(self, other: "Histogram") -> None:
+        for i, count in enumerate(other.counts):
+            self.counts[i] += count
+
+        self.count += other.count
+        self.total += other.total
+        self.max = max(self.max, other.max)
+
+
+class PacketMetrics:
+    """Metrics for a single packet type"""
+
+    __slots__ = (
+        "received",
+        "received_bytes",
+        "sent",
+        "sent_bytes",
+        "timeouts",
+        "queue_latency",
+        "handler_latency",
+        "request_latency",
+    )
+
+    def __init__(self):
+        self.received = 0
+        self.received_bytes = 0
+        self.sent = 0
+        self.sent_bytes = 0
+        self.timeouts = 0  # requests which got no response in time
+
+        self.queue_latency = Histogram()  # from the packet being read to its handler being called
+        self.handler_latency = Histogram()  # time spent in the handler, including sending its response
+        self.request_latency = Histogram()  # from a request being sent to its response arriving
+
+    def to_dict(self) -> dict:
+        return {
+            **{name: getattr(self, name) for name in self.__slots__[:5]},
+            **{name: getattr(self, name).to_dict() for name in self.__slots__[5:]},
+        }
+
+
+class IpcMetrics:
+    """Per packet type metrics for one side of the ipc connection(s)"""
+
+    def __init__(self, packet_types: Optional[type] = None):
+        self.packet_types = packet_types  # IntEnum used to name packet types which were recorded as plain ints
+        self.packets: Dict[object, PacketMetrics] = {}  # {packet_type: PacketMetrics}
+
+    def get(self, packet_type: object) -> PacketMetrics:
+        metrics = self.packets.get(packet_type)
+
+        if metrics is None:
+            metrics = self.packets[packet_type] = PacketMetrics()
+
+        return metrics
+
+    def _get_name(self, packet_type: object) -> str:
+        if self.packet_types is not None and not hasattr(packet_type, "name"):
+            try:
+                packet_type = self.packet_types(packet_type)
+            except ValueError:
+                pass
+
+        return getattr(packet_type, "name", str(packet_type))
+
+    def to_dict(self) -> dict:  # keyed by packet type name so it can be sent as a packet
+        merged = {}
+
+        for packet_type, metrics in self.packets.items():
+            name = self._get_name(packet_type)
+
+            if name in merged:  # the same packet type recorded as a plain int and as an enum member
+                merged[name] = merge_metrics({name: merged[name]}, {name: metrics.to_dict()})[name]
+            else:
+                merged[name] = metrics.to_dict()
+
+        return merged
+
+
+def summarize(metrics: dict, sort_by: str = "handler_latency", limit: Optional[int] = None) -> List[tuple]:
+    """Turns IpcMetrics.to_dict() output into (packet_type, received, sent, bytes, queue p50, handler p50,
+    handler p99, request p99) rows, sorted by the total time spent in the given histogram"""
+
+    rows = []
+
+    for packet_type, data in metrics.items():
+        queue, handler, request = (
+            Histogram.from_dict(data[h]) for h in ("queue_latency", "handler_latency", "request_latency")
+        )
+
+        rows.append(
+            (
+                data[sort_by]["total"],
+                (
+                    packet_type,
+                    data["received"],
+                    data["sent"],
+                    data["received_bytes"] + data["sent_bytes"],
+                    queue.percentile(0.5),
+                    handler.percentile(0.5),
+                    handler.percentile(0.99),
+                    request.percentile(0.99),
+                ),
+            )
+        )
+
+    rows.sort(key=(lambda r: r[0]), reverse=True)
+
+    return [r[1] for r in rows[:limit]]
+
+
+def merge_metrics(*metrics: dict) -> dict:
+    """Merges multiple IpcMetrics.to_dict() outputs, like the ones from every cluster"""
+
+    merged = {}
+
+    for m in metrics:
+        for packet_type, data in m.items():
+            if packet_type not in merged:
+                merged[packet_type] = {k: (dict(v) if isinstance(v, dict) else v) for k, v in data.items()}
+                continue
+
+            entry = merged[packet_type]
+
+            for k, v in data.items():
+                if isinstance(v, dict):
+                    histogram = Histogram.from_dict(entry[k])
+                    histogram.merge(Histogram.from_dict(v))
+                    entry[k] = histogram.to_dict()
+                else:
+                    entry[k] += v
+
+    return merged
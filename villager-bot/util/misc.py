@@ -7,7 +7,7 @@ import math
 import time
 
 from util.code import format_exception
-from util.ipc import PacketType
+from util.ipc import PacketType, MODE_FIRST
 
 
 def strip_command(ctx):  # returns message.clean_content excluding the command used
@@ -66,7 +66,7 @@ async def lb_logic(bot, lb_list: list, u_entry: object, rank_fstr: str):
 
         if user is None:
             res = await bot.ipc.broadcast(
-                {"type": PacketType.EVAL, "code": f"getattr(bot.get_user({entry[0]}), 'name', None)"}
+                {"type": PacketType.EVAL, "code": f"getattr(bot.get_user({entry[0]}), 'name', None)"}, mode=MODE_FIRST
             )
 
             for r in res.responses:
@@ -0,0 +1,65 @@
+from typing import Dict, Iterable, Set
+from collections import defaultdict
+
+from util.ipc import Server, JsonPacketStream, T_PACKET
+
+
+class PubSub:
+    """Keeps track of which connections of a Server are subscribed to which topics, and sends published messages to
+    them. Unlike broadcasts nothing responds to published messages, so there is nothing to wait on or keep track of."""
+
+    def __init__(self, server: Server):
+        self.server = server
+
+        self.subscribers: Dict[str, Set[JsonPacketStream]] = defaultdict(set)  # {topic: {connection, connection,..}}
+
+        server.disconnect_handlers.append(self.connection_lost)
+
+        # counters
+        self.published = 0
+        self.delivered = 0
+        self.undelivered = 0  # messages published to topics without subscribers
+
+    def subscribe(self, connection: JsonPacketStream, topics: Iterable[str]) -> None:
+        for topic in topics:
+            self.subscribers[topic].add(connection)
+
+    def unsubscribe(self, connection: JsonPacketStream, topics: Iterable[str]) -> None:
+        for topic in topics:
+            subscribers = self.subscribers.get(topic)
+
+            if subscribers is not None:
+                subscribers.discard(connection)
+
+                if not subscribers:
+                    del self.subscribers[topic]
+
+    def publish(self, packet: T_PACKET) -> int:
+        """Sends a PUBLISH packet to every subscriber of its topic, returns how many there were"""
+
+        self.published += 1
+
+        subscribers = self.subscribers.get(packet.topic)
+
+        if not subscribers:
+            self.undelivered += 1
+            return 0
+
+        # each connection's reader drains it, so the writes don't have to be awaited here
+        for connection in subscribers:
+            connection.write_packet_nowait(packet)
+
+        self.delivered += len(subscribers)
+
+        return len(subscribers)
+
+    def connection_lost(self, connection: JsonPacketStream) -> None:
+        self.unsubscribe(connection, list(self.subscribers))
+
+    def get_stats(self) -> dict:
+        return {
+            "topics": {topic: len(subscribers) for topic, subscribers in self.subscribers.items()},
+            "published": self.published,
+            "delivered": self.delivered,
+            "undelivered": self.undelivered,
+        }
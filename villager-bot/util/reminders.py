@@ -0,0 +1,122 @@
+from typing import Iterable, List, NamedTuple, Optional
+import asyncio
+import heapq
+import time
+
+REMINDER_HORIZON = 5 * 60  # seconds ahead reminders are loaded from the database
+REMINDER_BATCH_SIZE = 100  # the most reminders which are sent to the clusters in one packet
+
+
+class Reminder(NamedTuple):
+    at: float  # the time.time() the user should be reminded at
+    message_id: int  # the message the reminder command was summoned in, identifies the reminder
+    user_id: int
+    channel_id: int
+    reminder: str
+    guild_id: Optional[int]  # None for reminders in dms, which are sent to every cluster
+
+    def to_packet(self) -> dict:
+        return {
+            "user_id": self.user_id,
+            "channel_id": self.channel_id,
+            "message_id": self.message_id,
+            "reminder": self.reminder,
+        }
+
+
+class ReminderScheduler:
+    """Keeps the reminders which are due within the horizon in a min-heap, so they're sent when they're due without
+    polling the database. The database stays the durable record, reminders further ahead than the horizon are only
+    loaded once the horizon reaches them and a reminder's row is only deleted once it was delivered."""
+
+    def __init__(self, horizon: float = REMINDER_HORIZON):
+        self.horizon = horizon
+        self.loaded_until = 0.0  # reminders due before this were loaded (or added), later ones are only in the database
+
+        self.heap: List[Reminder] = []
+        self.scheduled = set()  # message ids of reminders which are in the heap or being delivered
+
+        self._wakeup = None  # created by sleep(), so it belongs to the running event loop
+
+        # counters
+        self.delivered = 0
+        self.dropped = 0  # reminders which no cluster could deliver, for example because their channel was deleted
+
+    def __len__(self) -> int:
+        return len(self.heap)
+
+    def start_load(self, now: float) -> float:
+        """Moves the horizon forward and returns the time reminders have to be loaded until. It's moved before the
+        database is queried so reminders added during the query aren't missed, add() ignores duplicates."""
+
+        self.loaded_until = now + self.horizon
+        return self.loaded_until
+
+    def add(self, reminder: Reminder) -> bool:
+        """Schedules a reminder if it's due within the horizon, returns whether it was"""
+
+        if reminder.at > self.loaded_until or reminder.message_id in self.scheduled:
+            return False
+
+        self.scheduled.add(reminder.message_id)
+        heapq.heappush(self.heap, reminder)
+
+        if self.heap[0] is reminder and self._wakeup is not None:  # the sleeping loop has to wake up earlier
+            self._wakeup.set()
+
+        return True
+
+    def load(self, reminders: Iterable[Reminder]) -> int:
+        return sum(self.add(reminder) for reminder in reminders)
+
+    def pop_due(self, now: float, limit: int = REMINDER_BATCH_SIZE) -> List[Reminder]:
+        due = []
+        heap = self.heap
+
+        while heap and heap[0].at <= now and len(due) < limit:
+            due.append(heapq.heappop(heap))
+
+        return due
+
+    def next_due(self) -> Optional[float]:
+        return self.heap[0].at if self.heap else None
+
+    def finish(self, reminders: Iterable[Reminder], delivered: int, dropped: int) -> None:
+        """Forgets reminders which were popped, the ones which weren't deleted from the database (because not every
+        cluster responded) are loaded again with the next load"""
+
+        for reminder in reminders:
+            self.scheduled.discard(reminder.message_id)
+
+        self.delivered += delivered
+        self.dropped += dropped
+
+    async def sleep(self, now: float) -> None:
+        """Sleeps until the next reminder is due, the horizon has to be moved or an earlier reminder is added"""
+
+        until = self.loaded_until
+        next_due = self.next_due()
+
+        if next_due is not None:
+            until = min(until, next_due)
+
+        if self._wakeup is None:
+            self._wakeup = asyncio.Event()
+
+        self._wakeup.clear()
+
+        try:
+            await asyncio.wait_for(self._wakeup.wait(), max(until - now, 0))
+        except asyncio.TimeoutError:
+            pass
+
+    def get_stats(self) -> dict:
+        next_due = self.next_due()
+
+        return {
+            "scheduled": len(self.heap),
+            "in_flight": len(self.scheduled) - len(self.heap),
+            "delivered": self.delivered,
+            "dropped": self.dropped,
+            "next_due_in": 0 if next_due is None else max(next_due - time.time(), 0),
+        }
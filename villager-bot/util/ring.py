@@ -0,0 +1,135 @@
+from typing import List, Optional
+import tempfile
+import struct
+import mmap
+import os
+
+# A single producer single consumer ring buffer in memory shared between two processes, used by
+# clusters to send one-way packets to karen without going through the ipc socket.
+#
+# The shared memory is a file mapped into both processes (in /dev/shm where available so it never
+# touches the disk). It starts with a header containing the write position (head) and the read
+# position (tail), each on their own cache line since they're written by different processes.
+# Both positions only ever increase, the offset into the data region is position % capacity.
+# Records in the data region are a little endian uint32 length followed by the data, and may wrap
+# around the end of the data region.
+#
+# The producer only writes the head and the consumer only writes the tail, and each position is
+# only advanced after the data it covers has been written / read, so no locking is needed.
+
+HEADER_SIZE = 128
+HEAD_OFFSET = 0
+TAIL_OFFSET = 64
+
+DEFAULT_CAPACITY = 1024 * 1024  # in bytes
+
+_position = struct.Struct("<Q")
+_record_header = struct.Struct("<I")
+
+SHM_DIR = "/dev/shm" if os.path.isdir("/dev/shm") else None
+
+
+class RingBuffer:
+    def __init__(self, path: str, owner: bool = False):
+        self.path = path
+        self.owner = owner  # whether this process created the file, and so is responsible for removing it
+
+        with open(path, "r+b") as f:
+            self._mmap = mmap.mmap(f.fileno(), 0)
+
+        self.capacity = len(self._mmap) - HEADER_SIZE
+
+        # counters
+        self.pushed = 0
+        self.dropped = 0  # pushes which didn't fit, the caller is expected to fall back to the socket
+        self.popped = 0
+
+    @classmethod
+    def create(cls, capacity: int = DEFAULT_CAPACITY) -> "RingBuffer":
+        """Creates a new zeroed ring buffer file, the returned RingBuffer is the owner of the file"""
+
+        fd, path = tempfile.mkstemp(prefix="villager-bot-ring-", dir=SHM_DIR)
+
+        with os.fdopen(fd, "wb") as f:
+            f.truncate(HEADER_SIZE + capacity)
+
+        return cls(path, owner=True)
+
+    @classmethod
+    def attach(cls, path: str) -> "RingBuffer":
+        """Maps an existing ring buffer created by another process"""
+
+        return cls(path)
+
+    def _get_position(self, offset: int) -> int:
+        return _position.unpack_from(self._mmap, offset)[0]
+
+    def _set_position(self, offset: int, position: int) -> None:
+        _position.pack_into(self._mmap, offset, position)
+
+    def _write(self, position: int, data: bytes) -> None:
+        start = position % self.capacity
+        first = min(len(data), self.capacity - start)
+
+        self._mmap[HEADER_SIZE + start : HEADER_SIZE + start + first] = data[:first]
+
+        if first < len(data):  # wrap around to the start of the data region
+            self._mmap[HEADER_SIZE : HEADER_SIZE + len(data) - first] = data[first:]
+
+    def _read(self, position: int, size: int) -> bytes:
+        start = position % self.capacity
+        first = min(size, self.capacity - start)
+
+        data = self._mmap[HEADER_SIZE + start : HEADER_SIZE + start + first]
+
+        if first < size:
+            data += self._mmap[HEADER_SIZE : HEADER_SIZE + size - first]
+
+        return data
+
+    @property
+    def used(self) -> int:
+        return self._get_position(HEAD_OFFSET) - self._get_position(TAIL_OFFSET)
+
+    def push(self, data: bytes) -> bool:
+        """Writes a record to the ring buffer, returns False if there wasn't enough free space (producer only)"""
+
+        head = self._get_position(HEAD_OFFSET)
+        size = _record_header.size + len(data)
+
+        if size > self.capacity - (head - self._get_position(TAIL_OFFSET)):
+            self.dropped += 1
+            return False
+
+        self._write(head, _record_header.pack(len(data)) + data)
+        self._set_position(HEAD_OFFSET, head + size)  # publish the record
+
+        self.pushed += 1
+        return True
+
+    def pop_all(self, max_records: Optional[int] = None) -> List[bytes]:
+        """Reads all records currently in the ring buffer, or up to max_records of them (consumer only)"""
+
+        head = self._get_position(HEAD_OFFSET)
+        tail = self._get_position(TAIL_OFFSET)
+
+        records = []
+
+        while tail < head and (max_records is None or len(records) < max_records):
+            (size,) = _record_header.unpack(self._read(tail, _record_header.size))
+            records.append(self._read(tail + _record_header.size, size))
+            tail += _record_header.size + size
+
+        self._set_position(TAIL_OFFSET, tail)  # free the space of the read records
+
+        self.popped += len(records)
+        return records
+
+    def close(self) -> None:
+        self._mmap.close()
+
+        if self.owner:
+            try:
+                os.remove(self.path)
+            except OSError:  # already removed, or still mapped by another process on windows
+                pass
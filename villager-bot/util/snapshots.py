@@ -0,0 +1,361 @@
+from typing import Callable, DefaultDict, Dict, List, Optional, Tuple
+from collections import defaultdict
+import numpy as np
+import functools
+import threading
+import asyncio
+import struct
+import time
+import zlib
+import os
+
+from util.cooldowns import CooldownManager
+
+# Snapshots of karen's state which would otherwise be lost when karen restarts (cooldowns, potion
+# effects, mine command and pillage counters), so it can be restored when karen starts again.
+#
+# A snapshot file is a full frame followed by any number of delta frames. A frame is a header
+# followed by its names (the commands / effects its records refer to, each terminated by a null
+# byte) and its records. Every record is (section, user_id, name index, value), 19 bytes packed,
+# where a value of 0 means the entry was removed. Delta frames only contain the entries which
+# changed since the previous frame, later records overwrite earlier ones with the same key.
+#
+# Full frames are written to a temporary file which then replaces the snapshot file, so a crash
+# while writing one leaves the previous snapshot. Delta frames are appended, a crash while
+# appending one leaves a torn frame at the end of the file which loading stops at (the header
+# has the frame's length and a crc32 of it). Once the deltas are bigger than the full frame, the
+# next snapshot is a full frame again.
+
+DEFAULT_SNAPSHOT_INTERVAL = 15  # seconds between snapshots
+
+FRAME_FULL = 0
+FRAME_DELTA = 1
+
+SECTION_COOLDOWNS = 0  # name is the command, value is the time.time() the cooldown started at
+SECTION_ACTIVE_EFFECTS = 1  # name is the effect, value is the time.time() the effect ends at
+SECTION_MINE_COMMANDS = 2  # value is the count
+SECTION_PILLAGES = 3  # value is the count
+
+MAGIC = b"VBSN"
+
+_frame_header = struct.Struct("<4sBdIII")  # magic, kind, time.time() written at, crc32, names length, record count
+
+RECORD_DTYPE = np.dtype([("section", "u1"), ("user_id", "<u8"), ("name", "<u2"), ("value", "<f8")])
+
+
+class SnapshotError(Exception):
+    pass
+
+
+class SnapshotFrame:
+    def __init__(self, kind: int, sequence: int = 0):
+        self.kind = kind
+        self.sequence = sequence  # frames collected later have higher sequences
+
+        self.names: List[str] = []
+        self._name_indexes: Dict[str, int] = {}  # {name: index into self.names}
+
+        self._records: List[tuple] = []  # added one at a time
+        self._arrays: List[np.ndarray] = []  # added with add_arrays()
+        self._deferred: List[Callable[[], None]] = []  # add records when the frame is encoded, off the event loop
+
+    def __len__(self) -> int:  # excluding records which will be added by deferred functions
+        return len(self._records) + sum(map(len, self._arrays))
+
+    def _name_index(self, name: str) -> int:
+        index = self._name_indexes.get(name)
+
+        if index is None:
+            index = self._name_indexes[name] = len(self.names)
+            self.names.append(name)
+
+        return index
+
+    def add(self, section: int, user_id: int, name: str, value: float) -> None:
+        self._records.append((section, user_id, self._name_index(name), value))
+
+    def add_arrays(self, section: int, names: List[str], user_ids: np.ndarray, name_indexes: object, values: np.ndarray):
+        """Adds a record for each user id, name_indexes is an array (or a single index) of indexes into names"""
+
+        records = np.empty(len(user_ids), RECORD_DTYPE)
+        records["section"] = section
+        records["user_id"] = user_ids
+        records["name"] = np.array([self._name_index(name) for name in names], np.uint16)[name_indexes]
+        records["value"] = values
+
+        self._arrays.append(records)
+
+    def defer(self, function: Callable[[], None]) -> None:
+        self._deferred.append(function)
+
+    def encode(self, written_at: float) -> bytes:
+        for function in self._deferred:
+            function()
+
+        self._deferred.clear()  # frees the copies they hold here rather than on the event loop
+
+        records = np.concatenate([np.array(self._records, RECORD_DTYPE), *self._arrays])
+        names = b"".join(name.encode() + b"\0" for name in self.names)
+        body = names + records.tobytes()
+
+        return _frame_header.pack(MAGIC, self.kind, written_at, zlib.crc32(body), len(names), len(records)) + body
+
+
+def decode_frames(data: bytes) -> Tuple[List[Tuple[int, float, List[str], np.ndarray]], bool]:
+    """Returns the frames in data as [(kind, written_at, names, records),..] and whether it ended with a torn frame"""
+
+    frames = []
+    position = 0
+
+    while position < len(data):
+        if len(data) - position < _frame_header.size:
+            return frames, True
+
+        magic, kind, written_at, crc, names_length, count = _frame_header.unpack_from(data, position)
+        start = position + _frame_header.size
+        end = start + names_length + count * RECORD_DTYPE.itemsize
+
+        if magic != MAGIC or end > len(data) or zlib.crc32(data[start:end]) != crc:
+            return frames, True
+
+        names = data[start : start + names_length].decode().split("\0")[:-1]
+        records = np.frombuffer(data, RECORD_DTYPE, count, start + names_length)
+
+        frames.append((kind, written_at, names, records))
+        position = end
+
+    return frames, False
+
+
+def merge_frames(frames: List[Tuple[int, float, List[str], np.ndarray]]) -> Tuple[List[str], np.ndarray]:
+    """Merges the frames' records into one array with one record per key (the last one), their name indexes are
+    changed to index the returned names"""
+
+    names = []
+    name_indexes = {}
+    parts = []
+
+    for _, _, frame_names, records in frames:
+        for name in frame_names:
+            if name not in name_indexes:
+                name_indexes[name] = len(names)
+                names.append(name)
+
+        remap = np.array([name_indexes[name] for name in frame_names], np.uint16)
+        records = records.copy()
+
+        if len(remap):
+            records["name"] = remap[records["name"]]
+
+        parts.append(records)
+
+    records = np.concatenate(parts) if parts else np.empty(0, RECORD_DTYPE)
+
+    if len(parts) > 1:  # a full frame's keys are unique, so only deltas can leave duplicates
+        order = np.lexsort((np.arange(len(records)), records["user_id"], records["name"], records["section"]))
+        records = records[order]
+
+        key = records[["section", "user_id", "name"]]
+        last = np.ones(len(records), bool)
+        last[:-1] = key[1:] != key[:-1]
+
+        records = records[last]
+
+    return names, records
+
+
+class SnapshotFile:
+    def __init__(self, path: str):
+        self.path = path
+
+        self.full_size = 0  # size of the full frame in the file, 0 if the file wasn't written yet
+        self.deltas_size = 0
+        self.sequence = 0  # of the last frame written
+
+        self._lock = threading.Lock()  # writes happen in an executor, a final snapshot can overlap a periodic one
+
+    @property
+    def should_compact(self) -> bool:
+        return self.full_size == 0 or self.deltas_size > self.full_size
+
+    def write(self, frame: SnapshotFrame) -> int:
+        """Encodes and writes a frame, blocking, returns its size"""
+
+        with self._lock:
+            if frame.sequence < self.sequence:  # collected before a frame which was already written, so it's outdated
+                return 0
+
+            self.sequence = frame.sequence
+
+            try:
+                data = frame.encode(time.time())
+
+                if frame.kind == FRAME_FULL:
+                    temp_path = self.path + ".tmp"
+
+                    with open(temp_path, "wb") as f:
+                        f.write(data)
+                        f.flush()
+                        os.fsync(f.fileno())
+
+                    os.replace(temp_path, self.path)
+
+                    self.full_size = len(data)
+                    self.deltas_size = 0
+                else:
+                    if self.full_size == 0:
+                        raise SnapshotError("A delta frame can't be written before a full frame")
+
+                    with open(self.path, "ab") as f:
+                        f.write(data)
+                        f.flush()
+                        os.fsync(f.fileno())
+
+                    self.deltas_size += len(data)
+
+                return len(data)
+            except BaseException:
+                self.full_size = 0  # the file may be missing changes now, so the next frame has to be a full one
+                raise
+
+    def load(self) -> Optional[Tuple[List[str], np.ndarray, bool]]:
+        """Reads the snapshot file, blocking, returns (names, records, torn) or None if there is no snapshot"""
+
+        try:
+            with open(self.path, "rb") as f:
+                data = f.read()
+        except FileNotFoundError:
+            return None
+
+        frames, torn = decode_frames(data)
+
+        if not frames or frames[0][0] != FRAME_FULL:
+            raise SnapshotError(f"{self.path} doesn't start with a full snapshot")
+
+        names, records = merge_frames(frames)
+
+        return names, records, torn
+
+
+class KarenSnapshots:
+    """Periodically snapshots karen's CooldownManager and Share to a SnapshotFile and restores them from it. Changes
+    to the Share have to be passed to track(), the CooldownManager keeps track of its changes itself."""
+
+    def __init__(self, path: str, cooldowns: CooldownManager, share: object):
+        self.file = SnapshotFile(path)
+        self.cooldowns = cooldowns
+        self.share = share
+
+        # {section: {(user_id, name), (user_id, name),..}}, share entries changed since the last snapshot
+        self.changes: DefaultDict[int, set] = defaultdict(set)
+        cooldowns.changes = set()
+
+        self.sequence = 0
+
+    def track(self, section: int, user_id: int, name: str = "") -> None:
+        self.changes[section].add((user_id, name))
+
+    def collect(self, full: bool) -> SnapshotFrame:
+        """Gathers what has to be written, this runs on the event loop so everything is copied into the frame"""
+
+        self.sequence += 1
+
+        changes, self.changes = self.changes, defaultdict(set)
+        cooldown_changes, self.cooldowns.changes = self.cooldowns.changes, set()
+
+        share = self.share
+
+        if full:
+            frame = SnapshotFrame(FRAME_FULL, self.sequence)
+
+            # only copies are made here, turning them into records happens when the frame is encoded
+            to_arrays = self.cooldowns.dump()
+            frame.defer(lambda: frame.add_arrays(SECTION_COOLDOWNS, *to_arrays()))
+
+            for section, counts in ((SECTION_MINE_COMMANDS, share.mine_commands), (SECTION_PILLAGES, share.pillages)):
+                frame.defer(functools.partial(self._add_counts, frame, section, counts.copy()))
+
+            for (user_id, effect), ends_at in share.effect_ends.items():
+                frame.add(SECTION_ACTIVE_EFFECTS, user_id, effect, ends_at)
+
+            return frame
+
+        frame = SnapshotFrame(FRAME_DELTA, self.sequence)
+
+        for command, user_id in cooldown_changes:
+            frame.add(SECTION_COOLDOWNS, user_id, command, self.cooldowns.get_started(command, user_id))
+
+        for section, counts in ((SECTION_MINE_COMMANDS, share.mine_commands), (SECTION_PILLAGES, share.pillages)):
+            for user_id, _ in changes[section]:
+                frame.add(section, user_id, "", counts.get(user_id, 0))
+
+        for user_id, effect in changes[SECTION_ACTIVE_EFFECTS]:
+            frame.add(SECTION_ACTIVE_EFFECTS, user_id, effect, share.effect_ends.get((user_id, effect), 0))
+
+        return frame
+
+    @staticmethod
+    def _add_counts(frame: SnapshotFrame, section: int, counts: Dict[int, int]) -> None:
+        user_ids = np.fromiter(counts.keys(), np.uint64, len(counts))
+        frame.add_arrays(section, [""], user_ids, 0, np.fromiter(counts.values(), np.float64, len(counts)))
+
+    async def write(self, full: bool = False) -> int:
+        """Writes a snapshot (a delta one if possible) off the event loop, returns its size"""
+
+        full = full or self.file.should_compact
+        frame = self.collect(full)
+
+        if not full and len(frame) == 0:
+            return 0
+
+        return await asyncio.get_event_loop().run_in_executor(None, self.file.write, frame)
+
+    def restore_records(self, names: List[str], records: np.ndarray, now: float) -> Dict[str, int]:
+        """Applies loaded records, skipping the ones which already ended, returns how many entries of each section
+        were restored"""
+
+        share = self.share
+        sections = records["section"]
+        restored = {}
+
+        # cooldowns which ended are skipped without looking at them one by one, as are commands which don't exist anymore
+        rates = np.array([self.cooldowns.rates.get(name, -1) for name in names] or [-1], np.float64)
+        cooldowns = records[sections == SECTION_COOLDOWNS]
+        cooldowns = cooldowns[(cooldowns["value"] > 0) & (cooldowns["value"] + rates[cooldowns["name"]] > now)]
+
+        self.cooldowns.load(names, cooldowns["user_id"], cooldowns["name"], cooldowns["value"])
+
+        restored["cooldowns"] = len(cooldowns)
+
+        effects = records[(sections == SECTION_ACTIVE_EFFECTS) & (records["value"] > now)]
+
+        for user_id, name, ends_at in zip(*(effects[field].tolist() for field in ("user_id", "name", "value"))):
+            share.active_effects[user_id].add(names[name])
+            share.effect_ends[(user_id, names[name])] = ends_at
+
+        restored["active_effects"] = len(effects)
+
+        for key, section, counts in (
+            ("mine_commands", SECTION_MINE_COMMANDS, share.mine_commands),
+            ("pillages", SECTION_PILLAGES, share.pillages),
+        ):
+            counters = records[(sections == section) & (records["value"] != 0)]
+            counts.update(zip(counters["user_id"].tolist(), counters["value"].astype(np.int64).tolist()))
+
+            restored[key] = len(counters)
+
+        return restored
+
+    async def restore(self) -> Optional[Tuple[Dict[str, int], bool]]:
+        """Restores the snapshot file if there is one, returns how many entries were restored and whether the file
+        ended with a torn frame"""
+
+        loop = asyncio.get_event_loop()
+        loaded = await loop.run_in_executor(None, self.file.load)
+
+        if loaded is None:
+            return None
+
+        names, records, torn = loaded
+
+        return self.restore_records(names, records, time.time()), torn